@@ -1,4 +1,5 @@
 import ccxt
+from market_cache import load_market_cache, save_market_cache
 
 # Initialize Bybit exchange
 exchange = ccxt.bybit({
@@ -8,8 +9,13 @@ exchange = ccxt.bybit({
     }
 })
 
-# Load markets
-markets = exchange.load_markets()
+# Load markets from the cache if it is fresh, otherwise load all markets and refresh the cache
+cached_markets = load_market_cache('bybit')
+if cached_markets is not None:
+    exchange.set_markets(list(cached_markets.values()))
+    markets = exchange.markets
+else:
+    markets = exchange.load_markets()
 
 # Filter for USDT perpetual futures
 usdt_perpetual = {
@@ -23,6 +29,9 @@ usdt_perpetual = {
     )
 }
 
+if cached_markets is None:
+    save_market_cache('bybit', usdt_perpetual)
+
 # Print total
 print(f"\n Total USDT Perpetual Futures on Bybit: {len(usdt_perpetual)}\n")
 
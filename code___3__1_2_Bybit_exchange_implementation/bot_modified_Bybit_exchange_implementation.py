@@ -73,6 +73,21 @@ fetch_errors = []  # Список ошибок при получении дан
 last_error_message_time = 0  # Время последнего сообщения об ошибке
 ERROR_MESSAGE_INTERVAL = 60  # Интервал между сообщениями об ошибках (сек)
 
+# Дедлайны опроса бирж: биржи опрашиваются параллельно, каждая в пределах своего дедлайна (сек)
+EXCHANGE_DEADLINES = {
+    'binance': float(os.getenv("BINANCE_FETCH_DEADLINE", 45)),
+    'bybit': float(os.getenv("BYBIT_FETCH_DEADLINE", 45))
+}
+REINIT_DEADLINES = {'binance': 240, 'bybit': 240}  # Дедлайны инициализации и реинициализации пар (сек)
+DEADLINE_MARGIN = 5  # Запас до дедлайна биржи на обработку собранных данных (сек)
+exchange_status = {'binance': 'ok', 'bybit': 'ok'}  # Результат последнего опроса: ok / timeout / error
+
+# Параметры сбора открытого интереса (OI)
+OI_COLLECT_DEADLINE = float(os.getenv("OI_COLLECT_DEADLINE", 25))  # Дедлайн сбора OI для одной биржи за цикл (сек)
+OI_MAX_CONCURRENCY = {'binance': 10, 'bybit': 10}  # Максимум одновременных запросов OI к бирже
+OI_WEIGHT_BUDGET = {'binance': 1200, 'bybit': 1200}  # Бюджет веса запросов OI в минуту (Binance: лимит IP 2400/мин)
+OI_REQUEST_WEIGHT = {'binance': 1, 'bybit': 1}  # Вес одного запроса fetch_open_interest
+
 # Инициализация ботов и диспетчеров
 price_bot = Bot(token=PRICE_TELEGRAM_TOKEN)
 debug_bot = Bot(token=DEBUG_BOT_TOKEN)
@@ -81,6 +96,30 @@ debug_dp = Dispatcher()
 price_router = Router()
 debug_router = Router()
 
+# Бюджет веса запросов (token bucket, weight за period секунд, пополняется равномерно)
+class RequestWeightBudget:
+    def __init__(self, weight, period=60.0):
+        self.capacity = weight
+        self.tokens = weight
+        self.refill_rate = weight / period
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, weight=1):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_rate)
+                self.updated = now
+                if self.tokens >= weight:
+                    self.tokens -= weight
+                    return
+                # Ждем ровно столько, сколько нужно для накопления недостающего веса
+                await asyncio.sleep((weight - self.tokens) / self.refill_rate)
+
+
+oi_budgets = {exchange: RequestWeightBudget(weight) for exchange, weight in OI_WEIGHT_BUDGET.items()}
+
 # Хранилища данных
 bot_data = {}  # Настройки пользователей: {chat_id: {settings}}
 user_data = {}  # Временные данные пользователей: {chat_id: {awaiting: setting_type}}
@@ -160,6 +199,79 @@ def global_timeout_retry(retries=3, delay=5):
     return decorator
 
 
+# Параллельный запуск операции operation(exchange, ex_obj) для всех бирж, у каждой свой дедлайн
+# Возвращает {exchange: (status, result)}, статус также сохраняется в exchange_status
+async def run_for_exchanges(operation, deadlines):
+    
+    async def run_one(exchange, ex_obj):
+        try:
+            result = await asyncio.wait_for(operation(exchange, ex_obj), timeout=deadlines[exchange])
+            return exchange, 'ok', result
+        except asyncio.TimeoutError:
+            logger.warning(f"{exchange}: {operation.__name__} exceeded deadline {deadlines[exchange]}s")
+            return exchange, 'timeout', None
+        except Exception as e:
+            logger.error(f"{exchange}: {operation.__name__} failed: {e.__class__.__name__}: {e}")
+            return exchange, 'error', None
+    
+    results = await asyncio.gather(*(run_one(exchange, ex_obj) for exchange, ex_obj in [('binance', binance_exchange), ('bybit', bybit_exchange)]))
+    for exchange, status, _ in results:
+        exchange_status[exchange] = status
+    return {exchange: (status, result) for exchange, status, result in results}
+
+
+# Строка для дебаг-чата о биржах, не ответивших вовремя (пустая, если все в порядке)
+def degraded_exchanges_summary():
+    degraded = [f"{exchange.capitalize()} ({status})" for exchange, status in exchange_status.items() if status != 'ok']
+    return f"\nDegraded: {', '.join(degraded)}" if degraded else ""
+
+
+# Получение значения OI из ответа ccxt (в унифицированной структуре это 'openInterestAmount')
+def extract_open_interest(oi_data):
+    if not oi_data:
+        return None
+    value = oi_data.get('openInterestAmount')
+    if value is None:
+        value = oi_data.get('openInterest')
+    return value
+
+
+# Сбор OI по списку пар: параллельно, в рамках бюджета веса биржи и с дедлайном.
+# Возвращает ({pair: oi или None}, {pair: ошибка}, пары, до которых не дошли к дедлайну)
+async def collect_open_interest(exchange, ex_obj, pairs, deadline=OI_COLLECT_DEADLINE):
+    semaphore = asyncio.Semaphore(OI_MAX_CONCURRENCY[exchange])
+    budget = oi_budgets[exchange]
+    oi_values = {}  # {pair: oi или None, если биржа не вернула значение}
+    oi_errors = {}  # {pair: исключение при запросе}
+
+    async def fetch_one(pair):
+        async with semaphore:
+            await budget.acquire(OI_REQUEST_WEIGHT[exchange])
+            try:
+                oi_data = await ex_obj.fetch_open_interest(pair)
+                oi_values[pair] = extract_open_interest(oi_data)
+            except Exception as e:
+                # Ошибки биржи и сети разбирает вызывающий код (например, -4108)
+                oi_errors[pair] = e
+
+    tasks = [asyncio.create_task(fetch_one(pair)) for pair in pairs]
+    if tasks:
+        try:
+            await asyncio.wait(tasks, timeout=max(deadline, 0))
+        finally:
+            # Не дождавшиеся дедлайна запросы отменяем, чтобы не задерживать цикл
+            # (в том числе если отменили весь опрос биржи)
+            pending = [task for task in tasks if not task.done()]
+            for task in pending:
+                task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    stale_pairs = [pair for pair in pairs if pair not in oi_values and pair not in oi_errors]
+    if stale_pairs:
+        logger.warning(f"{exchange}: OI deadline {deadline:.0f}s exceeded, {len(stale_pairs)} pairs left without OI")
+    return oi_values, oi_errors, stale_pairs
+
+
 # Получение списка игнорируемых пар из базы данных
 def get_ignored_pairs():
     db_path = BAN_PAIRS_DB_PATH
@@ -226,24 +338,23 @@ async def price_fetch_initial_prices():
     # Получаем список пар, которые нужно игнорировать из базы данных
     ignored_pairs = get_ignored_pairs()
     
-    # Проходим по каждой бирже (Binance и Bybit)
-    for exchange, ex_obj in [('binance', binance_exchange), ('bybit', bybit_exchange)]:
+    # Инициализация одной биржи (Binance и Bybit обрабатываются параллельно)
+    async def initialize_exchange(exchange, ex_obj):
+        deadline_at = asyncio.get_running_loop().time() + REINIT_DEADLINES[exchange] - DEADLINE_MARGIN
         # Получаем пары и их начальные цены с учетом фильтрации
         prices_data = await fetch_pairs_and_prices(ex_obj, exchange)
+        pairs = [pair for pair in prices_data if pair not in ignored_pairs]
         
-        # Инициализируем prices для данной биржи, исключая игнорируемые пары
-        prices[exchange] = {pair: [price] for pair, price in prices_data.items() if pair not in ignored_pairs}
+        # Для каждой пары получаем начальный открытый интерес (OI) до блокировки
+        oi_values, oi_errors, _ = await collect_open_interest(exchange, ex_obj, pairs, deadline_at - asyncio.get_running_loop().time())
         
         # Блокируем доступ к ценам для безопасного обновления
         async with prices_lock:
-            # Для каждой пары получаем начальный открытый интерес (OI)
-            for pair in list(prices[exchange].keys()):
-                try:
-                    # Запрашиваем OI для данной пары
-                    oi_data = await ex_obj.fetch_open_interest(pair)
-                    # Если OI есть, сохраняем его, иначе ставим 0
-                    open_interest[exchange][pair] = [oi_data['openInterest']] if oi_data.get('openInterest') else [0]
-                except ccxt.ExchangeError as e:
+            # Инициализируем prices для данной биржи, исключая игнорируемые пары
+            prices[exchange] = {pair: [prices_data[pair]] for pair in pairs}
+            for pair in pairs:
+                e = oi_errors.get(pair)
+                if e is not None:
                     # Обрабатываем ошибку -4108 (пара в доставке/расчетах)
                     if '-4108' in str(e):
                         logger.warning(f"Removing {pair} from {exchange} due to delivery/settlement: {e}")
@@ -252,6 +363,11 @@ async def price_fetch_initial_prices():
                     else:
                         # Логируем другие ошибки с OI для дальнейшего анализа
                         logger.error(f"Error fetching OI for {pair} on {exchange}: {e}")
+                    continue
+                # Если OI есть, сохраняем его, иначе ставим 0
+                open_interest[exchange][pair] = [oi_values.get(pair) or 0]
+    
+    await run_for_exchanges(initialize_exchange, REINIT_DEADLINES)
     
     # Записываем время окончания инициализации
     end_time = datetime.now().strftime("%H:%M:%S")
@@ -261,12 +377,77 @@ async def price_fetch_initial_prices():
         f"{start_time} -> {end_time} - Initial prices collected\n"
         f"Binance: {len(prices['binance'])} Fetched\n"  # Количество пар для Binance
         f"Bybit: {len(prices['bybit'])} Fetched"  # Количество пар для Bybit
+        f"{degraded_exchanges_summary()}"
     )
     print(summary_message)
     # Отправляем итоги в дебаг-чат
     await debug_bot.send_message(chat_id=DEBUG_CHAT_ID, text=summary_message)
 
 
+# Обновление цен и OI одной биржи, возвращает (количество обновленных пар, проблемные пары)
+async def price_fetch_exchange(exchange, ex_obj):
+    deadline_at = asyncio.get_running_loop().time() + EXCHANGE_DEADLINES[exchange] - DEADLINE_MARGIN
+    fetched_count = 0
+    problem_pairs = []
+    
+    # Получаем список отслеживаемых пар для данной биржи
+    tracked_pairs = list(prices[exchange].keys())
+    if not tracked_pairs:
+        return fetched_count, problem_pairs, 0  # Пропускаем, если нет пар для обработки
+
+    # Получаем текущие цены для всех пар разом
+    tickers = await ex_obj.fetch_tickers(tracked_pairs)
+    
+    # Обновляем открытый интерес до блокировки: параллельно, не дольше OI_COLLECT_DEADLINE и дедлайна биржи
+    oi_deadline = min(OI_COLLECT_DEADLINE, deadline_at - asyncio.get_running_loop().time())
+    oi_values, oi_errors, stale_pairs = await collect_open_interest(exchange, ex_obj, tracked_pairs, oi_deadline)
+    unreached_count = len(stale_pairs)
+    
+    # Блокируем доступ к данным для безопасного обновления
+    async with prices_lock:
+        for pair in tracked_pairs:
+            try:
+                if pair not in prices[exchange]:
+                    continue
+                # Получаем новую цену для пары
+                new_price = tickers.get(pair, {}).get('last')
+                if new_price is not None:
+                    # Добавляем новую цену в начало списка
+                    prices[exchange][pair].insert(0, new_price)
+                    # Ограничиваем длину списка до 30 значений
+                    if len(prices[exchange][pair]) > 30:
+                        prices[exchange][pair].pop()
+                    fetched_count += 1  # Увеличиваем счетчик успешных обновлений
+            
+                # Обновляем открытый интерес
+                if pair in oi_errors:
+                    e = oi_errors[pair]
+                    # Обрабатываем ошибку -4108
+                    if '-4108' in str(e):
+                        logger.warning(f"Skipping {pair} on {exchange} due to delivery/settlement: {e}")
+                        problem_pairs.append(pair)  # Добавляем в список проблемных
+                    else:
+                        # Логируем другие ошибки с OI
+                        logger.error(f"Error fetching OI for {pair} on {exchange}: {e}")
+                        problem_pairs.append(pair)
+                elif pair in oi_values and oi_values[pair] is None:
+                    # Логируем, если OI отсутствует в ответе
+                    logger.warning(f"No openInterest data for {pair} on {exchange}")
+                # Добавляем новый OI в начало списка; без значения (ошибка, пустой ответ, не дошли до дедлайна)
+                # ставим None, чтобы индекс в списке по-прежнему равнялся числу минут назад
+                open_interest[exchange].setdefault(pair, []).insert(0, oi_values.get(pair))
+                # Ограничиваем длину списка до 30 значений
+                if len(open_interest[exchange][pair]) > 30:
+                    open_interest[exchange][pair].pop()
+                
+            except Exception as e:
+                # Логируем любые другие ошибки обработки пары
+                logger.error(f"Error processing {pair} on {exchange}: {e}")
+                problem_pairs.append(pair)
+    
+    return fetched_count, problem_pairs, unreached_count
+
+
 # Обновление цен и OI
 @global_timeout_retry(retries=3, delay=5)
 async def price_fetch_and_compare_prices():
@@ -276,57 +457,14 @@ async def price_fetch_and_compare_prices():
         fetched_count = {'binance': 0, 'bybit': 0}
         # Список пар с проблемами для логирования
         problem_pairs = {'binance': [], 'bybit': []}
-
-        # Проходим по каждой бирже
-        for exchange, ex_obj in [('binance', binance_exchange), ('bybit', bybit_exchange)]:
-            # Получаем список отслеживаемых пар для данной биржи
-            tracked_pairs = list(prices[exchange].keys())
-            if not tracked_pairs:
-                continue  # Пропускаем, если нет пар для обработки
-
-            # Получаем текущие цены для всех пар разом
-            tickers = await ex_obj.fetch_tickers(tracked_pairs)
-            
-            # Блокируем доступ к данным для безопасного обновления
-            async with prices_lock:
-                for pair in tracked_pairs:
-                    try:
-                        # Получаем новую цену для пары
-                        new_price = tickers.get(pair, {}).get('last')
-                        if new_price is not None:
-                            # Добавляем новую цену в начало списка
-                            prices[exchange][pair].insert(0, new_price)
-                            # Ограничиваем длину списка до 30 значений
-                            if len(prices[exchange][pair]) > 30:
-                                prices[exchange][pair].pop()
-                            fetched_count[exchange] += 1  # Увеличиваем счетчик успешных обновлений
-                    
-                        # Обновляем открытый интерес
-                        try:
-                            oi = await ex_obj.fetch_open_interest(pair)
-                            if oi.get('openInterest') is not None:
-                                # Добавляем новый OI в начало списка
-                                open_interest[exchange][pair].insert(0, oi['openInterest'])
-                                # Ограничиваем длину списка до 30 значений
-                                if len(open_interest[exchange][pair]) > 30:
-                                    open_interest[exchange][pair].pop()
-                            else:
-                                # Логируем, если OI отсутствует в ответе
-                                logger.warning(f"No openInterest data for {pair} on {exchange}")
-                        except ccxt.ExchangeError as e:
-                            # Обрабатываем ошибку -4108
-                            if '-4108' in str(e):
-                                logger.warning(f"Skipping {pair} on {exchange} due to delivery/settlement: {e}")
-                                problem_pairs[exchange].append(pair)  # Добавляем в список проблемных
-                            else:
-                                # Логируем другие ошибки с OI
-                                logger.error(f"Error fetching OI for {pair} on {exchange}: {e}")
-                                problem_pairs[exchange].append(pair)
-                        
-                    except Exception as e:
-                        # Логируем любые другие ошибки обработки пары
-                        logger.error(f"Error processing {pair} on {exchange}: {e}")
-                        problem_pairs[exchange].append(pair)
+        # Сколько пар осталось без OI из-за дедлайна (списком не выводим: их могут быть сотни)
+        unreached_count = {'binance': 0, 'bybit': 0}
+
+        # Опрашиваем биржи параллельно, у каждой свой дедлайн
+        results = await run_for_exchanges(price_fetch_exchange, EXCHANGE_DEADLINES)
+        for exchange, (status, result) in results.items():
+            if status == 'ok':
+                fetched_count[exchange], problem_pairs[exchange], unreached_count[exchange] = result
         
         # Если были проблемные пары, формируем сообщение для логов
         if any(problem_pairs.values()):
@@ -337,6 +475,13 @@ async def price_fetch_and_compare_prices():
             )
             print(error_details)
             fetch_errors.append(error_details)  # Добавляем в глобальный список ошибок
+        if any(unreached_count.values()):
+            error_details = (
+                f"OI deadline reached, pairs left without OI: "
+                f"Binance {unreached_count['binance']} | Bybit {unreached_count['bybit']}"
+            )
+            print(error_details)
+            fetch_errors.append(error_details)
         
         # Возвращаем количество успешно обновленных пар
         return fetched_count
@@ -360,50 +505,62 @@ async def reinitialize_pairs():
     start_time = datetime.now().strftime("%H:%M:%S")
     ignored_pairs = get_ignored_pairs()
     logger.info(f"Starting reinitialization. Ignored pairs: {len(ignored_pairs)}")
+    reinit_changes = {'binance': (0, 0), 'bybit': (0, 0)}  # {exchange: (добавлено, удалено)}
     
-    for exchange, ex_obj in [('binance', binance_exchange), ('bybit', bybit_exchange)]:
-        try:
-            # Получаем новые пары и цены
-            new_prices = await fetch_pairs_and_prices(ex_obj, exchange)
-            logger.info(f"{exchange}: Retrieved {len(new_prices)} pairs from fetch_pairs_and_prices")
-            
-            # Блокируем доступ к данным для безопасного обновления
-            async with prices_lock:
-                # Обновляем prices, исключая игнорируемые пары
-                prices[exchange] = {pair: [price] for pair, price in new_prices.items() if pair not in ignored_pairs}
-                logger.info(f"{exchange}: After filtering ignored pairs: {len(prices[exchange])}")
-                
-                # Обновляем OI для каждой пары
-                for pair in list(prices[exchange].keys()):
-                    try:
-                        oi_data = await ex_obj.fetch_open_interest(pair)
-                        open_interest[exchange][pair] = [oi_data['openInterest']] if oi_data.get('openInterest') else [0]
-                    except ccxt.ExchangeError as e:
-                        if '-4108' in str(e):
-                            logger.warning(f"Removing {pair} from {exchange} due to delivery/settlement: {e}")
-                            del prices[exchange][pair]
-                        else:
-                            logger.error(f"Error fetching OI for {pair} on {exchange}: {e}")
-                
-                # Очистка cooldown для удаленных пар
-                for pair in list(prices_cooldown[exchange].keys()):
-                    if pair not in prices[exchange]:
-                        del prices_cooldown[exchange][pair]
-                for pair in list(oi_cooldown[exchange].keys()):
-                    if pair not in prices[exchange]:
-                        del oi_cooldown[exchange][pair]
-                logger.info(f"{exchange}: Final count after OI and cooldown: {len(prices[exchange])}")
+    # Реинициализация одной биржи (Binance и Bybit обрабатываются параллельно).
+    # История и cooldown сохранившихся пар не трогаются: добавляются новые листинги,
+    # удаляются делистингованные и игнорируемые пары
+    async def reinitialize_exchange(exchange, ex_obj):
+        deadline_at = asyncio.get_running_loop().time() + REINIT_DEADLINES[exchange] - DEADLINE_MARGIN
+        # Получаем новые пары и цены
+        new_prices = await fetch_pairs_and_prices(ex_obj, exchange)
+        logger.info(f"{exchange}: Retrieved {len(new_prices)} pairs from fetch_pairs_and_prices")
+        pairs = [pair for pair in new_prices if pair not in ignored_pairs]
+        added = [pair for pair in pairs if pair not in prices[exchange]]
+        removed = set(prices[exchange].keys()) - set(pairs)
         
-        except Exception as e:
-            logger.error(f"Failed to reinitialize {exchange}: {e}")
-            prices[exchange] = {}
-            open_interest[exchange] = {}
+        # OI запрашиваем только для новых пар, до блокировки
+        if added:
+            oi_values, oi_errors, _ = await collect_open_interest(exchange, ex_obj, added, deadline_at - asyncio.get_running_loop().time())
+        else:
+            oi_values, oi_errors = {}, {}
+        
+        # Блокируем доступ к данным для безопасного обновления
+        async with prices_lock:
+            for pair in removed:
+                prices[exchange].pop(pair, None)
+                open_interest[exchange].pop(pair, None)
+            
+            for pair in added:
+                e = oi_errors.get(pair)
+                if e is not None:
+                    if '-4108' in str(e):
+                        logger.warning(f"Skipping {pair} on {exchange} due to delivery/settlement: {e}")
+                        continue
+                    logger.error(f"Error fetching OI for {pair} on {exchange}: {e}")
+                else:
+                    open_interest[exchange][pair] = [oi_values.get(pair) or 0]
+                prices[exchange][pair] = [new_prices[pair]]
+            reinit_changes[exchange] = (len(added), len(removed))
+            
+            # Очистка cooldown для удаленных пар
+            for pair in list(prices_cooldown[exchange].keys()):
+                if pair not in prices[exchange]:
+                    del prices_cooldown[exchange][pair]
+            for pair in list(oi_cooldown[exchange].keys()):
+                if pair not in prices[exchange]:
+                    del oi_cooldown[exchange][pair]
+            logger.info(f"{exchange}: {len(prices[exchange])} pairs after reinitialization (+{len(added)} / -{len(removed)})")
+    
+    # Биржа, не успевшая к дедлайну, сохраняет прежний набор пар до следующей реинициализации
+    await run_for_exchanges(reinitialize_exchange, REINIT_DEADLINES)
     
     end_time = datetime.now().strftime("%H:%M:%S")
     summary_message = (
         f"{start_time} -> {end_time} - Re-initialization done\n"
-        f"Binance: {len(prices['binance'])} Fetched\n"
-        f"Bybit: {len(prices['bybit'])} Fetched"
+        f"Binance: {len(prices['binance'])} Fetched (+{reinit_changes['binance'][0]} / -{reinit_changes['binance'][1]})\n"
+        f"Bybit: {len(prices['bybit'])} Fetched (+{reinit_changes['bybit'][0]} / -{reinit_changes['bybit'][1]})"
+        f"{degraded_exchanges_summary()}"
     )
     print(summary_message)
     await debug_bot.send_message(chat_id=DEBUG_CHAT_ID, text=summary_message)
@@ -527,6 +684,9 @@ async def price_check_and_send_notifications():
                     if len(oi_list) > settings.get('oi_period', 5) and oi_cooldown[exchange][pair][chat_id]['OI'] == 0:
                         old_oi = oi_list[settings['oi_period']]
                         new_oi = oi_list[0]
+                        # Минута, в которую OI не получили, не сравнивается
+                        if old_oi is None or new_oi is None:
+                            continue
                         oi_change = (new_oi - old_oi) / old_oi * 100 if old_oi != 0 else 0
                         if abs(oi_change) >= settings.get('oi_threshold', 10):
                             await price_send_alert(exchange, pair, oi_change, old_oi, new_oi, oi_list, 'Change', settings, chat_id, is_oi=True)
@@ -1259,6 +1419,7 @@ async def main():
                     f"Bybit Prices: {price_fetched_count['bybit']} Fetched\n"
                     f"Queued: {total_messages_queued} | Sent: {total_messages_sent}\n"
                     f"Active Users: {active_users_count}"
+                    f"{degraded_exchanges_summary()}"
                 )
                 print(debug_message)
                 await debug_bot.send_message(chat_id=DEBUG_CHAT_ID, text=debug_message)
@@ -0,0 +1,162 @@
+import asyncio
+import argparse
+import os
+import random
+import time
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+# Рассылка всплеска сигналов через локальную замену Bot API: прежний последовательный цикл
+# против пула отправителей бота (process_message_queue с OutboundQueue).
+#
+#   python bench_delivery.py --messages 500 --chats 300 --latency 0.05 --paid-share 0.2
+#
+# Сервер отвечает на sendMessage с задержкой --latency и, как Telegram, возвращает 429,
+# если в секунду уходит больше GLOBAL_MESSAGES_PER_SECOND сообщений или в чат чаще раза в секунду.
+# Кроме общего времени выводится, когда получил последний сигнал оплативший пользователь.
+# С --digest пул склеивает сигналы чата в сводки (Digest Mode у всех пользователей).
+# С --flood-chats N первое сообщение в чаты 1..N получает 429 с retry_after --flood-retry секунд,
+# как при flood control на отдельный чат: такие чаты должны дождаться паузы, не задерживая остальные.
+
+# Бот читает токены при импорте; для замера достаточно заглушек
+os.environ.setdefault("PRICE_TELEGRAM_TOKEN", "0:benchmark")
+os.environ.setdefault("DEBUG_BOT_TOKEN", "1:benchmark")
+os.environ.setdefault("DEBUG_CHAT_ID", "0")
+import bot_modified_Search_Open_Interest as bot
+
+
+class FakeBotApi:
+    def __init__(self, latency, global_limit, flood_retry):
+        self.latency = latency
+        self.global_limit = global_limit
+        self.flood_retry = flood_retry
+        self.flood_pending = set()  # Чаты, первое сообщение в которые получит retry_after
+        self.sent = []  # [(время, chat_id)] принятых сообщений
+        self.rejected = 0
+        self.last_chat_time = {}
+
+    async def handle(self, request):
+        data = await request.post()
+        chat_id = int(data['chat_id'])
+        now = time.monotonic()
+        if chat_id in self.flood_pending:
+            self.flood_pending.discard(chat_id)
+            return web.json_response({
+                'ok': False, 'error_code': 429, 'description': f"Too Many Requests: retry after {self.flood_retry}",
+                'parameters': {'retry_after': self.flood_retry}
+            })
+        recent = sum(1 for sent_at, _ in self.sent[-self.global_limit:] if now - sent_at < 1)
+        if recent >= self.global_limit or now - self.last_chat_time.get(chat_id, -1) < 1:
+            self.rejected += 1
+            return web.json_response({
+                'ok': False, 'error_code': 429, 'description': "Too Many Requests: retry after 1",
+                'parameters': {'retry_after': 1}
+            })
+        self.sent.append((now, chat_id))
+        self.last_chat_time[chat_id] = now
+        await asyncio.sleep(self.latency)
+        return web.json_response({'ok': True, 'result': {
+            'message_id': len(self.sent), 'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'}, 'text': data.get('text', '')
+        }})
+
+
+# Прежняя рассылка: список, разбираемый pop(0) по одному сообщению, с ожиданием секунды между
+# сообщениями в один чат; сообщение под flood control возвращается в конец и отбрасывается до истечения паузы
+async def legacy_process_message_queue(queue):
+    flood_timeout = {}
+    while queue:
+        chat_id, message = queue.pop(0)
+        if chat_id in flood_timeout:
+            if time.time() < flood_timeout[chat_id]:
+                continue
+            else:
+                del flood_timeout[chat_id]
+        if bot.user_message_counts.get(chat_id, 0) < bot.USER_MESSAGES_PER_MINUTE:
+            bot.user_message_counts[chat_id] = bot.user_message_counts.get(chat_id, 0) + 1
+            time_since_last_message = time.time() - bot.last_message_time.get(chat_id, 0)
+            if time_since_last_message < 1:
+                await asyncio.sleep(1 - time_since_last_message)
+            status, retry_after = await bot.send_message(chat_id, message)
+            if status == 'retry':
+                flood_timeout[chat_id] = time.time() + retry_after
+                queue.append((chat_id, message))
+
+
+# Всплеск сигналов: messages сообщений по chats чатам, часть чатов получает несколько подряд
+def make_burst(messages, chats, seed):
+    rng = random.Random(seed)
+    return [(rng.randint(1, chats), f"Alert {i}") for i in range(messages)]
+
+
+def reset_state(burst, paid_chats, digest):
+    bot.outbound_queue = bot.OutboundQueue()
+    for chat_id, message in burst:
+        priority = bot.PRIORITY_PAID_PRICE if chat_id in paid_chats else bot.PRIORITY_TRIAL_PRICE
+        bot.outbound_queue.push(chat_id, message, priority, digest=digest)
+    bot.user_message_counts = {}
+    bot.last_message_time = {}
+    bot.blocked_users = set()
+    bot.total_messages_sent = 0
+    bot.send_budget = bot.RequestWeightBudget(bot.GLOBAL_MESSAGES_PER_SECOND, period=1.0, burst=1)
+
+
+async def run(process, api, burst, paid_chats, flood_chats, digest=False):
+    reset_state(burst, paid_chats, digest)
+    api.flood_pending = set(range(1, flood_chats + 1))
+    api.sent.clear()
+    api.rejected = 0
+    api.last_chat_time.clear()
+    start = time.monotonic()
+    await process()
+    elapsed = time.monotonic() - start
+    paid_done = max((sent_at - start for sent_at, chat_id in api.sent if chat_id in paid_chats), default=0)
+    return elapsed, paid_done, len(api.sent), api.rejected
+
+
+async def main(messages, chats, latency, port, seed, paid_share, digest, flood_chats, flood_retry):
+    api = FakeBotApi(latency, bot.GLOBAL_MESSAGES_PER_SECOND, flood_retry)
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', api.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    server = TelegramAPIServer.from_base(f"http://127.0.0.1:{port}")
+    bot.price_bot = Bot(token=os.environ["PRICE_TELEGRAM_TOKEN"], session=AiohttpSession(api=server))
+    bot.debug_bot = Bot(token=os.environ["DEBUG_BOT_TOKEN"], session=AiohttpSession(api=server))
+    burst = make_burst(messages, chats, seed)
+    paid_chats = set(range(1, int(chats * paid_share) + 1))
+    try:
+        results = {
+            'legacy loop': await run(lambda: legacy_process_message_queue(list(burst)), api, burst, paid_chats, flood_chats),
+            'sender pool': await run(bot.process_message_queue, api, burst, paid_chats, flood_chats, digest)
+        }
+    finally:
+        await bot.price_bot.session.close()
+        await bot.debug_bot.session.close()
+        await runner.cleanup()
+
+    print(f"{messages} messages to {chats} chats, API latency {latency * 1000:.0f} ms, "
+          f"{bot.SENDER_WORKERS} senders, limit {bot.GLOBAL_MESSAGES_PER_SECOND} msg/s, {len(paid_chats)} paid chats, "
+          f"{flood_chats} chats under retry_after {flood_retry} s")
+    for name, (elapsed, paid_done, delivered, rejected) in results.items():
+        print(f"  {name:<11}: {elapsed:7.2f} s | paid done {paid_done:6.2f} s | messages {delivered:>4} | "
+              f"{delivered / elapsed:5.1f} msg/s | 429 responses {rejected}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--chats', type=int, default=300)
+    parser.add_argument('--latency', type=float, default=0.05, help="Задержка ответа Bot API (сек)")
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--paid-share', type=float, default=0.2, help="Доля чатов оплативших пользователей")
+    parser.add_argument('--digest', action='store_true', help="Склеивать сигналы чата в сводки")
+    parser.add_argument('--flood-chats', type=int, default=0, help="Чатов, получающих retry_after на первое сообщение")
+    parser.add_argument('--flood-retry', type=int, default=5, help="retry_after для этих чатов (сек)")
+    args = parser.parse_args()
+    asyncio.run(main(args.messages, args.chats, args.latency, args.port, args.seed, args.paid_share, args.digest,
+                     args.flood_chats, args.flood_retry))
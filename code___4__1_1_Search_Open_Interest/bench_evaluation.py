@@ -0,0 +1,179 @@
+import asyncio
+import argparse
+import os
+import random
+import time
+
+# Время одного цикла проверки условий: матричная проверка бота против прежнего цикла пары x пользователи.
+#
+#   python bench_evaluation.py --pairs 1000 --users 10000
+#
+# Прежний цикл на всех пользователях идет минутами, поэтому он меряется на выборке
+# (--legacy-users) и пересчитывается линейно; на той же выборке сверяются отправленные сигналы.
+
+# Бот читает токены при импорте; для замера достаточно заглушек
+os.environ.setdefault("PRICE_TELEGRAM_TOKEN", "0:benchmark")
+os.environ.setdefault("DEBUG_BOT_TOKEN", "0:benchmark")
+os.environ.setdefault("DEBUG_CHAT_ID", "0")
+import bot_modified_Search_Open_Interest as bot
+
+
+# Прежняя проверка условий (до матрицы изменений): вложенный цикл по парам и пользователям
+async def legacy_check(minute_tick=True):
+    for exchange in ['binance', 'bybit']:
+        async with bot.prices_lock:
+            store = bot.prices[exchange]
+            oi_store = bot.open_interest[exchange]
+            for pair in store.keys():
+                if pair not in bot.prices_cooldown[exchange]:
+                    bot.prices_cooldown[exchange][pair] = {}
+                    bot.oi_cooldown[exchange][pair] = {}
+
+                for chat_id, settings in bot.bot_data.items():
+                    binance_enabled, bybit_enabled, blocked = bot.is_user_whitelisted_and_active(chat_id)
+                    if blocked or (exchange == 'binance' and not binance_enabled) or (exchange == 'bybit' and not bybit_enabled):
+                        continue
+
+                    alert_limit = settings.alert_limit
+                    notifications_sent = bot.notification_counters.get(chat_id, pair)
+                    if alert_limit is not None and notifications_sent >= alert_limit:
+                        continue
+
+                    if chat_id not in bot.prices_cooldown[exchange][pair]:
+                        bot.prices_cooldown[exchange][pair][chat_id] = {'Short': 0, 'Dump': 0}
+                    if chat_id not in bot.oi_cooldown[exchange][pair]:
+                        bot.oi_cooldown[exchange][pair][chat_id] = {'OI': 0}
+
+                    if minute_tick:
+                        for condition in ['Short', 'Dump']:
+                            if bot.prices_cooldown[exchange][pair][chat_id][condition] > 0:
+                                bot.prices_cooldown[exchange][pair][chat_id][condition] -= 1
+                        if bot.oi_cooldown[exchange][pair][chat_id]['OI'] > 0:
+                            bot.oi_cooldown[exchange][pair][chat_id]['OI'] -= 1
+
+                    price_triggered = False
+                    new_price = store.latest(pair)
+                    pump_index = settings.pump_index
+                    pump_threshold = settings.pump_threshold
+                    old_price = store.value_minutes_ago(pair, pump_index)
+                    if old_price and bot.prices_cooldown[exchange][pair][chat_id]['Short'] == 0:
+                        change_percent = (new_price - old_price) / old_price * 100
+                        if change_percent >= pump_threshold:
+                            await bot.price_send_alert(exchange, pair, change_percent, old_price, new_price, store, 'Short', settings, chat_id)
+                            bot.prices_cooldown[exchange][pair][chat_id]['Short'] = pump_index
+                            bot.notification_counters.increment(chat_id, pair)
+                            price_triggered = True
+                            continue
+
+                    d_index = settings.dump_index
+                    d_threshold = settings.dump_threshold
+                    old_price = store.value_minutes_ago(pair, d_index)
+                    if old_price and bot.prices_cooldown[exchange][pair][chat_id]['Dump'] == 0:
+                        change_percent = (new_price - old_price) / old_price * 100
+                        if change_percent <= -d_threshold:
+                            await bot.price_send_alert(exchange, pair, change_percent, old_price, new_price, store, 'Dump', settings, chat_id)
+                            bot.prices_cooldown[exchange][pair][chat_id]['Dump'] = d_index
+                            bot.notification_counters.increment(chat_id, pair)
+                            price_triggered = True
+                            continue
+
+                    if not price_triggered:
+                        oi_period = settings.oi_period
+                        oi_threshold = settings.oi_threshold
+                        old_oi = oi_store.value_minutes_ago(pair, oi_period)
+                        if old_oi is not None and bot.oi_cooldown[exchange][pair][chat_id]['OI'] == 0:
+                            new_oi = oi_store.latest(pair)
+                            oi_change = (new_oi - old_oi) / old_oi * 100 if old_oi != 0 else 0
+                            if abs(oi_change) >= oi_threshold:
+                                await bot.price_send_alert(exchange, pair, oi_change, old_oi, new_oi, oi_store, 'Change', settings, chat_id, is_oi=True)
+                                bot.oi_cooldown[exchange][pair][chat_id]['OI'] = oi_period
+                                bot.notification_counters.increment(chat_id, pair)
+
+
+# Синтетическая история: случайное блуждание цен и OI за 31 минуту, каждая двадцатая пара - волатильная
+def fill_history(pairs, seed):
+    rng = random.Random(seed)
+    now_ms = int(time.time() * 1000) // 60000 * 60000
+    for exchange in ['binance', 'bybit']:
+        bot.prices[exchange] = bot.SeriesStore()
+        bot.open_interest[exchange] = bot.SeriesStore()
+        for i in range(pairs):
+            pair = f"C{i}/USDT:USDT"
+            price = 1 + rng.random()
+            oi = 1000 + rng.random() * 1000
+            volatility = 0.008 if i % 20 == 0 else 0.001
+            for minute in range(bot.HISTORY_WINDOW_MINUTES, -1, -1):
+                price *= 1 + rng.gauss(0, volatility)
+                oi *= 1 + rng.gauss(0, 2 * volatility)
+                bot.prices[exchange].append(pair, now_ms - minute * 60000 + rng.randint(0, 3000), price)
+                bot.open_interest[exchange].append(pair, now_ms - minute * 60000 + rng.randint(0, 3000), oi)
+
+
+# Пользователи: доля default_share с настройками по умолчанию из /start, остальные - случайные
+def make_users(count, seed, default_share):
+    rng = random.Random(seed)
+    users = {}
+    for chat_id in range(1, count + 1):
+        if rng.random() < default_share:
+            users[chat_id] = bot.UserProfile()
+        else:
+            users[chat_id] = bot.UserProfile(
+                pump_index=rng.randint(1, 30), pump_threshold=rng.choice([2.0, 3.0, 5.0]),
+                dump_index=rng.randint(1, 30), dump_threshold=rng.choice([2.0, 3.0, 5.0]),
+                oi_period=rng.randint(1, 30), oi_threshold=rng.choice([5.0, 10.0])
+            )
+    return users
+
+
+def reset_state(users):
+    bot.bot_data.clear()
+    bot.bot_data.update(users)
+    bot.settings_groups.clear()
+    bot.user_settings_key.clear()
+    bot.threshold_index = None
+    for chat_id in users:
+        bot.index_user_settings(chat_id)
+    bot.prices_cooldown.update(binance={}, bybit={})
+    bot.oi_cooldown.update(binance={}, bybit={})
+    bot.notification_counters = bot.AlertCounters()
+    bot.outbound_queue = bot.OutboundQueue()
+    bot.total_messages_queued = 0
+
+
+async def timed(check, users):
+    reset_state(users)
+    start = time.perf_counter()
+    await check()
+    return time.perf_counter() - start, sorted(bot.outbound_queue.messages())
+
+
+async def main(pairs, users, legacy_users, seed, default_share):
+    # Доступ пользователей из базы здесь не проверяем: оба варианта получают один и тот же ответ
+    bot.is_user_whitelisted_and_active = lambda chat_id: (1, 1, 0)
+    fill_history(pairs, seed)
+    all_users = make_users(users, seed, default_share)
+    sample = dict(list(all_users.items())[:legacy_users])
+
+    legacy_time, legacy_alerts = await timed(legacy_check, sample)
+    sample_time, sample_alerts = await timed(bot.price_check_and_send_notifications, sample)
+    matrix_time, matrix_alerts = await timed(bot.price_check_and_send_notifications, all_users)
+
+    legacy_estimate = legacy_time * users / legacy_users
+    print(f"{pairs} pairs x {users} users ({len(bot.settings_groups)} distinct settings), 2 exchanges")
+    print(f"  legacy loop : {legacy_time:8.2f} s on {legacy_users} users -> ~{legacy_estimate:.1f} s for {users} users")
+    print(f"  matrix      : {sample_time:8.2f} s on {legacy_users} users, {matrix_time:.2f} s for {users} users ({len(matrix_alerts)} alerts)")
+    print(f"  speedup     : ~{legacy_estimate / matrix_time:.0f}x")
+    print(f"  same alerts on sample: {legacy_alerts == sample_alerts} ({len(sample_alerts)} alerts)")
+    await bot.price_bot.session.close()
+    await bot.debug_bot.session.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pairs', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--legacy-users', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--default-share', type=float, default=0.8, help="Доля пользователей с настройками по умолчанию")
+    args = parser.parse_args()
+    asyncio.run(main(args.pairs, args.users, min(args.legacy_users, args.users), args.seed, args.default_share))
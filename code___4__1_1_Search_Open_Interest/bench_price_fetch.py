@@ -0,0 +1,153 @@
+import asyncio
+import argparse
+import json
+import os
+import time
+import aiohttp
+
+# Сравнение полного пути цен (fetch_tickers: /ticker/24hr + унифицированный разбор ccxt)
+# с легким снимком цен (fetch_price_snapshot + apply_price_snapshot бота).
+#
+# С биржами:       python bench_price_fetch.py
+# Без сети:        python bench_price_fetch.py --offline 450
+#
+# Выводит размер ответа, вес запроса и время разбора одного цикла для каждого пути.
+
+# Бот читает токены при импорте; для замера достаточно заглушек
+os.environ.setdefault("PRICE_TELEGRAM_TOKEN", "0:benchmark")
+os.environ.setdefault("DEBUG_BOT_TOKEN", "0:benchmark")
+os.environ.setdefault("DEBUG_CHAT_ID", "0")
+import bot_modified_Search_Open_Interest as bot
+
+ENDPOINTS = {
+    'binance': {
+        'full': "https://fapi.binance.com/fapi/v1/ticker/24hr",
+        'lean': "https://fapi.binance.com/fapi/v1/ticker/price"
+    },
+    'bybit': {
+        'full': "https://api.bybit.com/v5/market/tickers?category=linear",
+        'lean': "https://api.bybit.com/v5/market/tickers?category=linear"
+    }
+}
+# Вес запросов без symbol по документации бирж (у Bybit лимит по числу запросов, вес 1)
+REQUEST_WEIGHT = {
+    'binance': {'full': 40, 'lean': 2},
+    'bybit': {'full': 1, 'lean': 1}
+}
+
+
+# Синтетические рынки и ответы бирж для замера без сети
+def synthetic_payloads(exchange, count):
+    markets = []
+    full = []
+    lean = []
+    now_ms = int(time.time() * 1000)
+    for i in range(count):
+        base = f"C{i}"
+        markets.append({
+            'id': f"{base}USDT", 'symbol': f"{base}/USDT:USDT", 'base': base, 'quote': 'USDT', 'settle': 'USDT',
+            'baseId': base, 'quoteId': 'USDT', 'settleId': 'USDT', 'type': 'swap', 'spot': False, 'margin': False,
+            'swap': True, 'future': False, 'option': False, 'contract': True, 'linear': True, 'inverse': False,
+            'expiry': None, 'active': True, 'contractSize': 1, 'precision': {'price': 0.0001, 'amount': 0.001}
+        })
+        price = f"{1 + i / 1000:.4f}"
+        if exchange == 'binance':
+            full.append({
+                'symbol': f"{base}USDT", 'priceChange': "0.0100", 'priceChangePercent': "1.000", 'weightedAvgPrice': price,
+                'lastPrice': price, 'lastQty': "10", 'openPrice': price, 'highPrice': price, 'lowPrice': price,
+                'volume': "100000", 'quoteVolume': "100000", 'openTime': now_ms - 86400000, 'closeTime': now_ms,
+                'firstId': 1, 'lastId': 1000, 'count': 1000
+            })
+            lean.append({'symbol': f"{base}USDT", 'price': price, 'time': now_ms})
+        else:
+            full.append({
+                'symbol': f"{base}USDT", 'lastPrice': price, 'indexPrice': price, 'markPrice': price,
+                'prevPrice24h': price, 'price24hPcnt': "0.01", 'highPrice24h': price, 'lowPrice24h': price,
+                'prevPrice1h': price, 'openInterest': "12345", 'openInterestValue': "12345", 'turnover24h': "100000",
+                'volume24h': "100000", 'fundingRate': "0.0001", 'nextFundingTime': str(now_ms), 'bid1Price': price,
+                'bid1Size': "1", 'ask1Price': price, 'ask1Size': "1"
+            })
+            lean = full
+    if exchange == 'bybit':
+        full = {'retCode': 0, 'result': {'category': 'linear', 'list': full}, 'time': now_ms}
+        lean = full
+    return markets, {'full': json.dumps(full).encode(), 'lean': json.dumps(lean).encode()}, {}
+
+
+# Ответы бирж по сети, вес берется из заголовка X-MBX-USED-WEIGHT-1M, если биржа его отдает
+async def live_payloads(exchange, ex_obj):
+    markets = list(bot.filter_usdt_perpetual(await ex_obj.load_markets()).values())
+    bodies = {}
+    weights = {}
+    async with aiohttp.ClientSession() as session:
+        for path, url in ENDPOINTS[exchange].items():
+            async with session.get(url) as response:
+                bodies[path] = await response.read()
+                used = response.headers.get('X-MBX-USED-WEIGHT-1M')
+            # Вес запроса - прирост использованного веса на повторном запросе
+            if used is not None:
+                async with session.get(url) as response:
+                    await response.read()
+                    weights[path] = int(response.headers['X-MBX-USED-WEIGHT-1M']) - int(used)
+    return markets, bodies, weights
+
+
+def measure(exchange, ex_obj, markets, bodies, repeats):
+    ex_obj.set_markets(markets)
+    bot.market_ids[exchange] = {market['id']: market['symbol'] for market in markets}
+    symbols = [market['symbol'] for market in markets]
+    results = {}
+
+    # Полный путь: JSON + унифицированные тикеры ccxt + запись в историю
+    start = time.perf_counter()
+    for i in range(repeats):
+        raw = json.loads(bodies['full'])
+        rows = raw if exchange == 'binance' else raw['result']['list']
+        tickers = ex_obj.parse_tickers(rows, symbols)
+        store = bot.SeriesStore()
+        for symbol in symbols:
+            store.add(symbol)
+        for symbol in symbols:
+            last = tickers.get(symbol, {}).get('last')
+            if last is not None:
+                store.append(symbol, tickers[symbol].get('timestamp') or i, last)
+    results['full'] = (time.perf_counter() - start) / repeats
+
+    # Легкий путь: JSON + разбор строк сразу в историю
+    start = time.perf_counter()
+    for i in range(repeats):
+        raw = json.loads(bodies['lean'])
+        rows = raw if exchange == 'binance' else raw['result']['list']
+        store = bot.SeriesStore()
+        for symbol in symbols:
+            store.add(symbol)
+        bot.prices[exchange] = store
+        bot.apply_price_snapshot(exchange, rows, i, {})
+    results['lean'] = (time.perf_counter() - start) / repeats
+    return results
+
+
+async def main(offline, repeats):
+    for exchange, ex_obj in [('binance', bot.binance_exchange), ('bybit', bot.bybit_exchange)]:
+        try:
+            if offline:
+                markets, bodies, weights = synthetic_payloads(exchange, offline)
+            else:
+                markets, bodies, weights = await live_payloads(exchange, ex_obj)
+            parse = measure(exchange, ex_obj, markets, bodies, repeats)
+        finally:
+            await ex_obj.close()
+        print(f"{exchange.capitalize()} ({len(markets)} pairs{', synthetic' if offline else ''}):")
+        for path in ('full', 'lean'):
+            weight = weights.get(path, REQUEST_WEIGHT[exchange][path])
+            print(f"  {path:>4}: {len(bodies[path]) / 1024:8.1f} KiB | weight {weight:>3} | parse {parse[path] * 1000:7.2f} ms")
+    await bot.price_bot.session.close()
+    await bot.debug_bot.session.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--offline', type=int, default=0, help="Количество синтетических пар вместо запросов к биржам")
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.offline, args.repeats))
@@ -0,0 +1,92 @@
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+# Память и скорость чтения настроек пользователей: прежние словари bot_data против UserProfile бота.
+#
+#   python bench_user_profiles.py --users 50000
+
+# Бот читает токены при импорте; для замера достаточно заглушек
+os.environ.setdefault("PRICE_TELEGRAM_TOKEN", "0:benchmark")
+os.environ.setdefault("DEBUG_BOT_TOKEN", "0:benchmark")
+os.environ.setdefault("DEBUG_CHAT_ID", "0")
+import bot_modified_Search_Open_Interest as bot
+
+
+# Значения полей профиля в строках whitelist (None - пустое поле, как у старых записей базы).
+# Поля, которых здесь нет, остаются пустыми и получают значение по умолчанию
+FIELD_VALUES = {
+    'pump_index': lambda rng: rng.randint(1, 30),
+    'pump_threshold': lambda rng: float(rng.randint(1, 20)),
+    'dump_index': lambda rng: rng.randint(1, 30),
+    'dump_threshold': lambda rng: float(rng.randint(1, 20)),
+    'alert_limit': lambda rng: rng.choice([None, 5, 20]),
+    'oi_period': lambda rng: rng.choice([None, 5, 15]),
+    'oi_threshold': lambda rng: rng.choice([None, 10.0, 25.0]),
+    'binance': lambda rng: 1,
+    'bybit': lambda rng: 1,
+    'blocked': lambda rng: 0,
+    'detection_mode': lambda rng: rng.choice([None, 'endpoint', 'max']),
+    'digest': lambda rng: rng.choice([None, 0, 1])
+}
+
+
+# Строки whitelist в порядке USER_PROFILE_COLUMNS
+def make_rows(count, seed):
+    rng = random.Random(seed)
+    rows = []
+    for _ in range(count):
+        rows.append(tuple(FIELD_VALUES.get(field, lambda rng: None)(rng) for field in bot.USER_PROFILE_COLUMNS))
+    return rows
+
+
+# Прежний формат bot_data: словарь со строковыми ключами на каждого пользователя
+def as_dict(row):
+    return {field: (value if value is not None else bot.UserProfile.DEFAULTS[field])
+            for field, value in zip(bot.USER_PROFILE_COLUMNS, row)}
+
+
+# Прирост памяти на построение bot_data (числа полей общие у обоих вариантов: разница - контейнеры профилей)
+def measure(build, rows):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    profiles = {chat_id: build(row) for chat_id, row in enumerate(rows, 1)}
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return profiles, used
+
+
+# Чтение полей, которые проверка условий берет у каждого подписчика группы
+def read_time(profiles, read):
+    start = time.perf_counter()
+    for settings in profiles.values():
+        read(settings)
+    return time.perf_counter() - start
+
+
+def main(users, seed):
+    rows = make_rows(users, seed)
+    dicts, dict_bytes = measure(as_dict, rows)
+    slotted, slotted_bytes = measure(bot.UserProfile.from_row, rows)
+    assert all(getattr(slotted[chat_id], field) == dicts[chat_id][field] for chat_id in dicts for field in bot.USER_PROFILE_COLUMNS)
+
+    dict_read = read_time(dicts, lambda s: (s['pump_index'], s['dump_index'], s['oi_period'], s.get('alert_limit', 20),
+                                            s['pump_threshold'], s['dump_threshold'], s['oi_threshold']))
+    slotted_read = read_time(slotted, lambda s: (s.pump_index, s.dump_index, s.oi_period, s.alert_limit,
+                                                 s.pump_threshold, s.dump_threshold, s.oi_threshold))
+
+    print(f"{users} users (Python {sys.version.split()[0]}):")
+    print(f"  dict        : {dict_bytes / 2**20:7.2f} MiB, {dict_bytes / users:6.0f} B/user, read {dict_read * 1000:6.1f} ms")
+    print(f"  UserProfile : {slotted_bytes / 2**20:7.2f} MiB, {slotted_bytes / users:6.0f} B/user, read {slotted_read * 1000:6.1f} ms")
+    print(f"  saved       : {(dict_bytes - slotted_bytes) / 2**20:7.2f} MiB ({1 - slotted_bytes / dict_bytes:.0%})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    main(args.users, args.seed)
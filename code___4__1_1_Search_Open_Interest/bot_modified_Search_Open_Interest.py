@@ -3,17 +3,23 @@ import ccxt.async_support as ccxt
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.filters import Command, CommandStart
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
 import time
 import datetime
 import logging
 import sqlite3
-import re
 import inspect
 from datetime import datetime, timedelta
-from collections import defaultdict
+from collections import deque
+import numpy as np
 import traceback
 import functools
+import json
+import struct
+import heapq
+import html
+import aiohttp
 from dotenv import load_dotenv
 import os
 
@@ -32,10 +38,8 @@ bybit_exchange = ccxt.bybit({
 })
 
 # Структуры данных для хранения цен и OI, разделенные по биржам
-prices = {'binance': {}, 'bybit': {}}  # Цены: {exchange: {pair: [price_list]}}
-prices_cooldown = {'binance': {}, 'bybit': {}}  # Cooldown для цен: {exchange: {pair: {chat_id: {'Short': n, 'Dump': n}}}}
-open_interest = {'binance': {}, 'bybit': {}}  # Открытый интерес: {exchange: {pair: [oi_list]}}
-oi_cooldown = {'binance': {}, 'bybit': {}}  # Cooldown для OI: {exchange: {pair: {chat_id: {'OI': n}}}}
+prices_cooldown = {'binance': {}, 'bybit': {}}  # Cooldown для цен: {exchange: {(pair, chat_id, 'Short'|'Dump'): подавлено до, начало минуты цикла}}
+oi_cooldown = {'binance': {}, 'bybit': {}}  # Cooldown для OI: {exchange: {(pair, chat_id): подавлено до, начало минуты цикла}}
 
 # Токены и настройки из .env
 PRICE_TELEGRAM_TOKEN = os.getenv("PRICE_TELEGRAM_TOKEN")
@@ -55,24 +59,125 @@ logger = logging.getLogger(__name__)
 WHITELIST_DB_PATH = "../databases_modified_whitelist_2/whitelist.db"
 BAN_PAIRS_DB_PATH = "/var/www/site/payment/ban_pairs.db"
 
+# Кэш доступа пользователей из whitelist (перечитывается только при изменении базы)
+entitlements = {}  # Активные пользователи: {chat_id: (Binance, Bybit, Blocked)}
+paid_users = set()  # Активные пользователи с оплаченным доступом (срок дольше пробного периода)
+entitlements_db = None  # Постоянное соединение: PRAGMA data_version меняется только после записи другими соединениями
+entitlements_version = None  # (data_version, mtime_ns, inode) базы при последней загрузке
+
 # Глобальные константы и переменные
 GLOBAL_MESSAGES_PER_SECOND = 30
 USER_MESSAGES_PER_MINUTE = 15
-message_queue = []  # Очередь сообщений для отправки
+SENDER_WORKERS = int(os.getenv("SENDER_WORKERS", 30))  # Параллельных отправителей сообщений
+CHAT_MESSAGE_INTERVAL = 1.0  # Минимальный интервал между сообщениями в один чат (сек), ограничение Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096  # Максимальная длина текста сообщения Telegram
+DIGEST_SEPARATOR = "\n\n"  # Между сигналами в сводке
+ALERT_TTL = int(os.getenv("ALERT_TTL", 300))  # Сколько секунд сигнал актуален: позже он отбрасывается, а не отправляется
+BROADCAST_TTL = 24 * 3600  # То же для рассылки /send_message
+OUTBOUND_JOURNAL_DB_PATH = os.getenv("OUTBOUND_JOURNAL_DB_PATH", "outbound_journal.db")  # Журнал неотправленных сообщений на диске
+OUTBOUND_JOURNAL_BATCH = 200  # Изменений журнала на одну транзакцию
+SEND_RETRY_DELAY = 5  # Пауза перед повтором после временной ошибки отправки (сек), удваивается подряд до SEND_RETRY_MAX
+SEND_RETRY_MAX = 60
+send_failures = {}  # Временные ошибки отправки подряд: {chat_id: count}
+DELIVERY_DEADLINE = 40  # Сколько секунд цикла отдается рассылке; остаток очереди уходит в следующем цикле
+TRIAL_DAYS = 30  # Длительность пробного периода (дней)
+# Классы приоритета исходящих сообщений: меньше - раньше
+PRIORITY_PAID_PRICE = 1  # Pump/Dump оплатившим
+PRIORITY_PAID_OI = 2  # OI оплатившим
+PRIORITY_TRIAL_PRICE = 3  # Pump/Dump на пробном периоде
+PRIORITY_TRIAL_OI = 4  # OI на пробном периоде
+PRIORITY_BROADCAST = 5  # Рассылка /send_message
 user_message_counts = {}  # Счетчик сообщений по пользователям
 total_messages_queued = 0  # Общее количество поставленных в очередь сообщений
 total_messages_sent = 0  # Общее количество отправленных сообщений
 blocked_users = set()  # Множество заблокированных пользователей
 last_message_time = {}  # Время последнего сообщения для каждого chat_id
-user_flood_timeout = {}  # Таймауты для пользователей из-за flood control
 blocked_user_ids_forbidden = set()  # Пользователи, заблокировавшие бота
 prices_lock = asyncio.Lock()  # Блокировка для асинхронного доступа к ценам
-notification_counters = defaultdict(lambda: defaultdict(int))  # Счетчики уведомлений: {chat_id: {pair: count}}
-last_counter_reset_date = datetime.now().date()  # Дата последнего сброса счетчиков
+ALERT_COUNTERS_DB_PATH = os.getenv("ALERT_COUNTERS_DB_PATH", "alert_counters.db")  # Дневные счетчики уведомлений на диске
 fetch_errors = []  # Список ошибок при получении данных
 last_error_message_time = 0  # Время последнего сообщения об ошибке
 ERROR_MESSAGE_INTERVAL = 60  # Интервал между сообщениями об ошибках (сек)
 
+# Параметры истории цен и OI
+HISTORY_WINDOW_MINUTES = 30  # Максимальный период с минутным разрешением (мин)
+HISTORY_LOOKUP_TOLERANCE_MS = 30000  # Допуск на дрожание момента опроса при поиске точки "N минут назад"
+HISTORY_MAX_LAG_MS = 90000  # Насколько точка может быть старше нужного момента (пропущенный/затянувшийся цикл)
+HISTORY_CAPACITY = 40  # Точек в кольцевом буфере пары: 30 минут + запас на повторы циклов
+
+# Второй уровень истории для периодов длиннее 30 минут: последняя точка каждого 5-минутного интервала за сутки.
+# Прореживается при записи, поэтому память на пару фиксирована: 40 + 300 точек на цену и столько же на OI
+COARSE_STEP_MINUTES = 5  # Шаг второго уровня (мин); длинные периоды задаются кратными ему
+COARSE_STEP_MS = COARSE_STEP_MINUTES * 60000
+LONG_HISTORY_MAX_MINUTES = 24 * 60  # Максимальный период сигналов (мин)
+COARSE_HISTORY_CAPACITY = LONG_HISTORY_MAX_MINUTES // COARSE_STEP_MINUTES + 12  # 288 интервалов + запас на прогрев
+COARSE_MAX_LAG_MS = COARSE_STEP_MS + HISTORY_MAX_LAG_MS  # Точка интервала может быть старше нужного момента на шаг
+SERIES_ROW_SPAN = 1 << 42  # Диапазон меток одной строки при общем поиске по всем строкам (мс, ~2109 год)
+
+# Снимок истории на диске, чтобы перезапуск не оставлял сигналы без истории
+HISTORY_SNAPSHOT_DIR = os.getenv("HISTORY_SNAPSHOT_DIR", "history_snapshot")
+HISTORY_SNAPSHOT_MAX_AGE_MS = HISTORY_WINDOW_MINUTES * 60000  # Более старые снимки и пары без свежих точек не загружаются
+coarse_snapshot_bucket = None  # 5-минутный интервал последней записи второго уровня
+COARSE_SNAPSHOT_MAX_AGE_MS = LONG_HISTORY_MAX_MINUTES * 60000  # То же для второго уровня
+SNAPSHOT_MAGIC = b'SERIES01'
+# Заголовок файла: magic, capacity, строк, байт индекса, время снимка (мс); далее timestamps, values, heads, counts
+# (int64/float64, C-порядок) и индекс {pair: row} в JSON
+SNAPSHOT_HEADER = struct.Struct('<8sIIIq36x')
+
+# Параметры сбора открытого интереса (OI)
+OI_COLLECT_DEADLINE = float(os.getenv("OI_COLLECT_DEADLINE", 25))  # Дедлайн сбора OI для одной биржи за цикл (сек)
+OI_MAX_CONCURRENCY = {'binance': 10, 'bybit': 10}  # Максимум одновременных запросов OI к бирже
+OI_WEIGHT_BUDGET = {'binance': 1200, 'bybit': 1200}  # Бюджет веса запросов OI в минуту (Binance: лимит IP 2400/мин)
+OI_REQUEST_WEIGHT = {'binance': 1, 'bybit': 1}  # Вес одного запроса fetch_open_interest
+oi_stale = {'binance': set(), 'bybit': set()}  # Пары, по которым OI не успел прийти до дедлайна
+OI_BULK_SOURCES = {'bybit'}  # Биржи, у которых OI приходит в общем ответе тикеров (info.openInterest)
+
+# Дедлайны опроса бирж: биржи опрашиваются параллельно, каждая в пределах своего дедлайна (сек)
+EXCHANGE_DEADLINES = {
+    'binance': float(os.getenv("BINANCE_FETCH_DEADLINE", 45)),
+    'bybit': float(os.getenv("BYBIT_FETCH_DEADLINE", 45))
+}
+REINIT_DEADLINES = {'binance': 120, 'bybit': 120}  # Дедлайны инициализации и реинициализации пар (сек)
+exchange_status = {'binance': 'ok', 'bybit': 'ok'}  # Результат последнего опроса: ok / timeout / error
+
+# Легкий опрос цен: эндпоинты последней цены без унифицированного разбора тикеров ccxt
+# (fetch_tickers остается запасным путем)
+LEAN_PRICE_FETCH = os.getenv("LEAN_PRICE_FETCH", "1") == "1"
+
+# Кэш рынков на диске: отфильтрованные USDT-перпетуалы, чтобы старт не ждал полного load_markets.
+# У каждой биржи свой файл (market_cache_binance.json, market_cache_bybit.json): бот и скрипты проверки
+# перезаписывают только свою биржу и не теряют чужие записи
+MARKET_CACHE_PATH = os.getenv("MARKET_CACHE_PATH", "market_cache.json")
+MARKET_CACHE_TTL = int(os.getenv("MARKET_CACHE_TTL", 24 * 3600))  # Максимальный возраст кэша для старта (сек)
+MARKET_REFRESH_INTERVAL = int(os.getenv("MARKET_REFRESH_INTERVAL", 3600))  # Период фонового обновления рынков (сек)
+market_cache = {}  # {exchange: {'updated': timestamp, 'markets': {symbol: market}}}
+market_changes = {'binance': None, 'bybit': None}  # Изменения рынков для реинициализации: {exchange: (added, removed)}
+
+# Прогрев истории при старте: минутные свечи и история OI, чтобы сигналы работали сразу после перезапуска
+BACKFILL_MINUTES = int(os.getenv("BACKFILL_MINUTES", HISTORY_WINDOW_MINUTES))  # Глубина прогрева (мин), 0 - без прогрева
+BACKFILL_DEADLINE = float(os.getenv("BACKFILL_DEADLINE", 240))  # Дедлайн прогрева одной биржи (сек)
+BACKFILL_MAX_CONCURRENCY = {'binance': 10, 'bybit': 10}  # Максимум одновременных запросов истории к бирже
+BACKFILL_WEIGHT_BUDGET = {'binance': 1200, 'bybit': 1200}  # Бюджет веса запросов истории в минуту
+BACKFILL_OI_TIMEFRAME = '5m'  # Минимальный период истории OI у Binance и Bybit
+BACKFILL_LONG_MINUTES = int(os.getenv("BACKFILL_LONG_MINUTES", LONG_HISTORY_MAX_MINUTES))  # Глубина прогрева второго уровня (мин), 0 - без него
+BACKFILL_OI_LIMIT = 200  # Точек истории OI за запрос (максимум Bybit; 200 x 5 мин ~ 16.6 ч)
+BACKFILL_PROGRESS_STEPS = 4  # Сколько раз за прогрев биржи сообщать о прогрессе в дебаг-чат
+
+# Потоковый режим получения цен (websocket вместо поминутного fetch_tickers)
+STREAM_MODE = os.getenv("STREAM_MODE", "0") == "1"
+STREAM_EVAL_INTERVAL = float(os.getenv("STREAM_EVAL_INTERVAL", 15))  # Период проверки условий внутри минуты (сек)
+STREAM_STALE_AFTER = 30  # Если поток молчит дольше (сек), цикл берет цены через REST
+STREAM_PING_INTERVAL = 20  # Интервал ping для Bybit (сек)
+BYBIT_STREAM_BATCH = 10  # Количество топиков в одном запросе подписки Bybit
+STREAM_URLS = {
+    'binance': os.getenv("BINANCE_STREAM_URL", "wss://fstream.binance.com/ws/!miniTicker@arr"),
+    'bybit': os.getenv("BYBIT_STREAM_URL", "wss://stream.bybit.com/v5/public/linear")
+}
+stream_prices = {'binance': {}, 'bybit': {}}  # Последние цены из потока: {exchange: {pair: (price, время получения, мс)}}
+stream_open_interest = {'binance': {}, 'bybit': {}}  # Последний OI из потока (только Bybit): {exchange: {pair: oi}}
+stream_last_message = {'binance': 0, 'bybit': 0}  # Время последнего кадра потока по биржам
+market_ids = {'binance': {}, 'bybit': {}}  # Идентификаторы бирж для потоков: {exchange: {market_id: pair}}
+
 # Инициализация ботов и диспетчеров
 price_bot = Bot(token=PRICE_TELEGRAM_TOKEN)
 debug_bot = Bot(token=DEBUG_BOT_TOKEN)
@@ -82,7 +187,35 @@ price_router = Router()
 debug_router = Router()
 
 # Хранилища данных
-bot_data = {}  # Настройки пользователей: {chat_id: {settings}}
+bot_data = {}  # Настройки пользователей: {chat_id: UserProfile}
+# Поля профиля и колонки whitelist, из которых они загружаются
+USER_PROFILE_COLUMNS = {
+    'pump_index': 'Pindex',
+    'pump_threshold': 'Ppercent',
+    'dump_index': 'Dindex',
+    'dump_threshold': 'Dpercent',
+    'alert_limit': 'Filter',
+    'oi_period': 'OIperiod',
+    'oi_threshold': 'OIpercent',
+    'binance': 'Binance',
+    'bybit': 'Bybit',
+    'blocked': 'Blocked',
+    'detection_mode': 'Mode',
+    'digest': 'Digest'
+}
+# Колонки whitelist, которых нет в базах первых версий: добавляются при старте
+WHITELIST_EXTRA_COLUMNS = {'Mode': "TEXT DEFAULT 'endpoint'", 'Digest': "INTEGER DEFAULT 0"}
+whitelist_missing_columns = set()  # Колонки, которые добавить не удалось: читаются как NULL (значение по умолчанию), не пишутся
+# Режимы Pump/Dump сигналов: надпись кнопки -> значение в профиле.
+# endpoint - изменение между началом и концом периода, max - наибольшее движение внутри периода
+DETECTION_MODES = {'End points': 'endpoint', 'Max move': 'max'}
+# Сводка: сигналы чата, еще ждущие отправки, склеиваются в одно сообщение (до TELEGRAM_MESSAGE_LIMIT символов)
+DIGEST_MODES = {'Off': 0, 'On': 1}
+SETTINGS_KEY_FIELDS = ('pump_index', 'pump_threshold', 'dump_index', 'dump_threshold', 'oi_period', 'oi_threshold', 'detection_mode')
+settings_groups = {}  # Пользователи с одинаковыми условиями: {(значения SETTINGS_KEY_FIELDS): {chat_id}}
+user_settings_key = {}  # Группа пользователя: {chat_id: ключ settings_groups}
+threshold_index = None  # Пороги групп по периодам: {'pump'|'dump'|'pump_max'|'dump_max'|'oi': {колонка: (пороги по возрастанию, ключи групп)}}; None - перестроить
+long_periods = {}  # Периоды длиннее 30 минут, заданные в настройках: {period: колонка матрицы}; строится вместе с threshold_index
 user_data = {}  # Временные данные пользователей: {chat_id: {awaiting: setting_type}}
 
 
@@ -160,6 +293,780 @@ def global_timeout_retry(retries=3, delay=5):
     return decorator
 
 
+# Хранилище рядов (цены или OI) одной биржи: кольцевые буферы в массивах numpy,
+# одна строка на пару, стабильный индекс пара -> строка, время точек - мс биржи
+class SeriesStore:
+
+    def __init__(self, capacity=HISTORY_CAPACITY, rows=512, coarse_capacity=COARSE_HISTORY_CAPACITY):
+        self.capacity = capacity
+        self.timestamps = np.zeros((rows, capacity), dtype=np.int64)
+        self.values = np.zeros((rows, capacity), dtype=np.float64)
+        self.heads = np.zeros(rows, dtype=np.int64)  # Ячейка последней точки в строке
+        self.counts = np.zeros(rows, dtype=np.int64)  # Количество точек в строке
+        self.index = {}  # {pair: row}
+        self.free_rows = list(range(rows - 1, -1, -1))
+        # Второй уровень (5 минут) со своим индексом строк; пополняется из append/update_latest
+        self.coarse = SeriesStore(coarse_capacity, rows, coarse_capacity=0) if coarse_capacity else None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, pair):
+        return pair in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    # Строка для новой пары (освобожденные строки переиспользуются, при нехватке массивы растут вдвое)
+    def add(self, pair):
+        row = self.index.get(pair)
+        if row is not None:
+            return row
+        if not self.free_rows:
+            rows = len(self.heads)
+            self.timestamps = np.concatenate([self.timestamps, np.zeros_like(self.timestamps)])
+            self.values = np.concatenate([self.values, np.zeros_like(self.values)])
+            self.heads = np.concatenate([self.heads, np.zeros_like(self.heads)])
+            self.counts = np.concatenate([self.counts, np.zeros_like(self.counts)])
+            self.free_rows = list(range(2 * rows - 1, rows - 1, -1))
+        row = self.free_rows.pop()
+        self.heads[row] = 0
+        self.counts[row] = 0
+        self.index[pair] = row
+        return row
+
+    def remove(self, pair):
+        row = self.index.pop(pair, None)
+        if row is not None:
+            self.counts[row] = 0
+            self.free_rows.append(row)
+        if self.coarse is not None:
+            self.coarse.remove(pair)
+
+    # Добавление точки за O(1); повтор той же метки обновляет значение, более старые точки не принимаются
+    def append(self, pair, timestamp, value):
+        row = self.add(pair)
+        if self.coarse is not None:
+            self.coarse.append_downsampled(pair, timestamp, value, COARSE_STEP_MS)
+        count = self.counts[row]
+        head = self.heads[row]
+        if count:
+            last_ts = self.timestamps[row, head]
+            if timestamp < last_ts:
+                return
+            if timestamp == last_ts:
+                self.values[row, head] = value
+                return
+            head = (head + 1) % self.capacity
+        self.timestamps[row, head] = timestamp
+        self.values[row, head] = value
+        self.heads[row] = head
+        self.counts[row] = min(count + 1, self.capacity)
+
+    # Прореживание при записи: в интервале step_ms хранится одна точка - последняя пришедшая
+    def append_downsampled(self, pair, timestamp, value, step_ms):
+        row = self.add(pair)
+        if self.counts[row]:
+            head = self.heads[row]
+            last_ts = self.timestamps[row, head]
+            if last_ts <= timestamp and last_ts // step_ms == timestamp // step_ms:
+                self.timestamps[row, head] = timestamp
+                self.values[row, head] = value
+                return
+        self.append(pair, timestamp, value)
+
+    # Обновление последней точки без добавления новой (цены из потока внутри минуты).
+    # Возвращает, записана ли точка (более старая, чем последняя, не принимается)
+    def update_latest(self, pair, timestamp, value):
+        row = self.index.get(pair)
+        if row is None:
+            return False
+        if not self.counts[row]:
+            self.append(pair, timestamp, value)
+            return True
+        head = self.heads[row]
+        if timestamp < self.timestamps[row, head]:
+            return False
+        self.timestamps[row, head] = timestamp
+        self.values[row, head] = value
+        if self.coarse is not None:
+            self.coarse.append_downsampled(pair, timestamp, value, COARSE_STEP_MS)
+        return True
+
+    def latest(self, pair):
+        row = self.index.get(pair)
+        if row is None or not self.counts[row]:
+            return None
+        return float(self.values[row, self.heads[row]])
+
+    # Точка на lag шагов назад за O(1): (timestamp, value) или None
+    def lag(self, pair, lag):
+        row = self.index.get(pair)
+        if row is None or lag >= self.counts[row]:
+            return None
+        slot = (self.heads[row] - lag) % self.capacity
+        return int(self.timestamps[row, slot]), float(self.values[row, slot])
+
+    # Точка в момент timestamp или непосредственно перед ним (бинарный поиск по кольцу)
+    def at_or_before(self, pair, timestamp):
+        row = self.index.get(pair)
+        if row is None:
+            return None
+        count = int(self.counts[row])
+        head = int(self.heads[row])
+        row_ts = self.timestamps[row]
+        # Логический индекс 0 - самая старая точка, count - 1 - последняя
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if row_ts[(head - count + 1 + mid) % self.capacity] <= timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return None
+        slot = (head - count + lo) % self.capacity
+        return int(row_ts[slot]), float(self.values[row, slot])
+
+    # Значение period минут назад относительно последней точки пары, None если такой точки нет
+    def value_minutes_ago(self, pair, period):
+        row = self.index.get(pair)
+        if row is None or self.counts[row] < 2:
+            return None
+        latest_ts = int(self.timestamps[row, self.heads[row]])
+        target = latest_ts - period * 60000
+        sample = self.at_or_before(pair, target + HISTORY_LOOKUP_TOLERANCE_MS)
+        if sample is None or sample[0] == latest_ts or sample[0] < target - HISTORY_MAX_LAG_MS:
+            return None
+        return sample[1]
+
+    # Поиск точек "N минут назад" для всех пар и периодов lags (по умолчанию 1..30) за один проход NumPy
+    # (те же правила, что в value_minutes_ago; max_lag_ms - допустимое отставание точки).
+    # Возвращает (pairs, values[pairs, capacity] в хронологическом порядке, counts, latest,
+    # sample_index[pairs, lags] - позиция найденной точки в values, valid[pairs, lags])
+    def lookup_samples(self, lags=None, max_lag_ms=HISTORY_MAX_LAG_MS):
+        lags = np.arange(1, HISTORY_WINDOW_MINUTES + 1) if lags is None else np.asarray(lags, dtype=np.int64)
+        pairs = list(self.index.keys())
+        rows = np.fromiter(self.index.values(), dtype=np.int64, count=len(pairs))
+        positions = np.arange(len(pairs), dtype=np.int64)
+        heads = self.heads[rows]
+        counts = self.counts[rows]
+        # Раскладываем кольца в хронологическом порядке
+        logical = np.arange(self.capacity)
+        slots = (heads[:, None] - counts[:, None] + 1 + logical[None, :]) % self.capacity
+        ts = np.take_along_axis(self.timestamps[rows], slots, axis=1)
+        values = np.take_along_axis(self.values[rows], slots, axis=1)
+        
+        latest_index = np.maximum(counts - 1, 0)
+        latest_ts = ts[positions, latest_index]
+        latest = np.where(counts > 0, values[positions, latest_index], np.nan)
+        target = latest_ts[:, None] - lags[None, :] * 60000
+        # Все строки - один отсортированный массив: к меткам строки i прибавляется i * SERIES_ROW_SPAN,
+        # пустые ячейки получают последнюю метку диапазона строки. Тогда один searchsorted дает для каждой
+        # строки и периода количество точек не позже target + допуск = позицию искомой точки + 1
+        offsets = positions[:, None] * SERIES_ROW_SPAN
+        keyed = np.where(logical[None, :] < counts[:, None], ts, SERIES_ROW_SPAN - 1) + offsets
+        bounds = np.clip(target + HISTORY_LOOKUP_TOLERANCE_MS, 0, SERIES_ROW_SPAN - 2) + offsets
+        found = np.searchsorted(keyed.ravel(), bounds.ravel(), side='right').reshape(bounds.shape) - positions[:, None] * self.capacity
+        sample_index = np.maximum(found - 1, 0)
+        sample_ts = np.take_along_axis(ts, sample_index, axis=1)
+        valid = (counts[:, None] >= 2) & (found > 0) & (sample_ts != latest_ts[:, None]) & (sample_ts >= target - max_lag_ms)
+        return pairs, values, counts, latest, sample_index, valid
+
+    # Изменение между концами окна: (pairs, latest[pairs], old[pairs, lags], change[pairs, lags] в %), где нет точки - NaN
+    def change_matrix(self, lags=None, max_lag_ms=HISTORY_MAX_LAG_MS):
+        pairs, values, counts, latest, sample_index, valid = self.lookup_samples(lags, max_lag_ms)
+        old = np.where(valid, np.take_along_axis(values, sample_index, axis=1), np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            change = (latest[:, None] - old) / old * 100
+        return pairs, latest, old, change
+
+    # Наибольшее движение внутри окна (режим "Max move"): рост от минимума к более позднему максимуму
+    # и падение от максимума к более позднему минимуму, а не только между концами окна.
+    # Все окна заканчиваются последней точкой, поэтому скользящие максимум/минимум превращаются в суффиксные:
+    # один проход справа налево (accumulate) дает лучшее движение для каждого начала окна - O(1) на точку сразу
+    # для всех периодов. Возвращает (pairs, rise_from, rise_to, rise[%], fall_from, fall_to, fall[%]) - [pairs, lags]
+    def excursion_matrix(self, lags=None, max_lag_ms=HISTORY_MAX_LAG_MS):
+        pairs, values, counts, latest, sample_index, valid = self.lookup_samples(lags, max_lag_ms)
+        logical = np.arange(self.capacity)
+        points = np.where(logical[None, :] < counts[:, None], values, np.nan)
+        results = [pairs]
+        for extreme in (np.fmax, np.fmin):
+            # Лучший уровень после точки k и движение к нему от точки k
+            reverse = points[:, ::-1]
+            best_after = extreme.accumulate(reverse, axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                move = best_after / reverse - 1
+            # Лучшее движение среди начал >= k и позиция его начала (последнее обновление накопленного максимума/минимума)
+            best_move = extreme.accumulate(move, axis=1)
+            start = np.maximum.accumulate(np.where(move == best_move, logical[None, :], -1), axis=1)
+            window_start = self.capacity - 1 - sample_index
+            start = np.take_along_axis(start, window_start, axis=1)
+            start_ok = valid & (start >= 0)
+            start = np.maximum(start, 0)
+            move_from = np.where(start_ok, np.take_along_axis(reverse, start, axis=1), np.nan)
+            move_to = np.where(start_ok, np.take_along_axis(best_after, start, axis=1), np.nan)
+            move = np.where(start_ok, np.take_along_axis(best_move, window_start, axis=1) * 100, np.nan)
+            results += [move_from, move_to, move]
+        return tuple(results)
+
+    # Матрица изменений по обоим уровням: колонки 1..30 минут, затем long_lags со второго уровня
+    # (строки второго уровня выравниваются по парам первого)
+    def tiered_change_matrix(self, long_lags=()):
+        pairs, latest, old, change = self.change_matrix()
+        if long_lags and self.coarse is not None:
+            coarse_pairs, _, coarse_old, coarse_change = self.coarse.change_matrix(long_lags, COARSE_MAX_LAG_MS)
+            coarse_old, coarse_change = align_rows(coarse_pairs, pairs, (coarse_old, coarse_change))
+            old = np.hstack([old, coarse_old])
+            change = np.hstack([change, coarse_change])
+        return pairs, latest, old, change
+
+    # То же для движений внутри окна. На втором уровне хранится последняя цена каждых 5 минут,
+    # поэтому для длинных периодов экстремумы внутри 5-минутных интервалов не видны
+    def tiered_excursion_matrix(self, long_lags=()):
+        pairs, *arrays = self.excursion_matrix()
+        if long_lags and self.coarse is not None:
+            coarse_pairs, *coarse_arrays = self.coarse.excursion_matrix(long_lags, COARSE_MAX_LAG_MS)
+            coarse_arrays = align_rows(coarse_pairs, pairs, coarse_arrays)
+            arrays = [np.hstack([array, coarse_array]) for array, coarse_array in zip(arrays, coarse_arrays)]
+        return (pairs, *arrays)
+
+    # Запись снимка: временный файл + fsync + rename, чтобы падение не оставило файл недописанным
+    def save(self, path, saved_ms):
+        SeriesStore.write_snapshot(path, saved_ms, self.capacity, (self.timestamps, self.values, self.heads, self.counts), self.index)
+
+    # Копия состояния для записи снимка без блокировки (массивы и индекс дальше меняются опросом)
+    def snapshot_state(self):
+        return self.capacity, tuple(np.array(array) for array in (self.timestamps, self.values, self.heads, self.counts)), dict(self.index)
+
+    @staticmethod
+    def write_snapshot(path, saved_ms, capacity, arrays, index):
+        index_blob = json.dumps(index).encode()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, capacity, len(arrays[2]), len(index_blob), saved_ms))
+            for array in arrays:
+                f.write(np.ascontiguousarray(array).tobytes())
+            f.write(index_blob)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    # Загрузка снимка без копирования: массивы - представления memmap в режиме copy-on-write.
+    # None, если снимок другого формата или старше max_age_ms; пары без свежих точек отбрасываются.
+    # Второй уровень загружается отдельно (restore_history) и подключается через store.coarse
+    @classmethod
+    def load(cls, path, now_ms, max_age_ms, capacity=HISTORY_CAPACITY):
+        with open(path, 'rb') as f:
+            header = f.read(SNAPSHOT_HEADER.size)
+        if len(header) < SNAPSHOT_HEADER.size:
+            return None
+        magic, saved_capacity, rows, index_bytes, saved_ms = SNAPSHOT_HEADER.unpack(header)
+        if magic != SNAPSHOT_MAGIC or saved_capacity != capacity or now_ms - saved_ms > max_age_ms:
+            return None
+        data = np.memmap(path, dtype=np.uint8, mode='c')
+        offset = SNAPSHOT_HEADER.size
+        store = cls.__new__(cls)
+        store.capacity = capacity
+        store.coarse = None
+        arrays = []
+        for dtype, shape in ((np.int64, (rows, capacity)), (np.float64, (rows, capacity)), (np.int64, (rows,)), (np.int64, (rows,))):
+            size = int(np.prod(shape)) * 8
+            arrays.append(data[offset:offset + size].view(dtype).reshape(shape))
+            offset += size
+        store.timestamps, store.values, store.heads, store.counts = arrays
+        saved_index = json.loads(bytes(data[offset:offset + index_bytes]))
+        
+        store.index = {}
+        for pair, row in saved_index.items():
+            if store.counts[row] and now_ms - store.timestamps[row, store.heads[row]] <= max_age_ms:
+                store.index[pair] = row
+        used_rows = set(store.index.values())
+        store.free_rows = [row for row in range(rows - 1, -1, -1) if row not in used_rows]
+        for row in store.free_rows:
+            store.counts[row] = 0
+        return store
+
+    # Вставка готовой истории (например, прогрева) с сохранением уже накопленных точек.
+    # points - [(timestamp, value)], при совпадении метки приоритет у существующей точки.
+    # Работает только с этим уровнем: второй уровень прогревается своими точками через store.coarse.merge
+    def merge(self, pair, points):
+        row = self.index.get(pair)
+        if row is None or not points:
+            return
+        count = int(self.counts[row])
+        head = int(self.heads[row])
+        merged = dict(points)
+        for i in range(count):
+            slot = (head - count + 1 + i) % self.capacity
+            merged[int(self.timestamps[row, slot])] = float(self.values[row, slot])
+        ordered = sorted(merged.items())[-self.capacity:]
+        for slot, (timestamp, value) in enumerate(ordered):
+            self.timestamps[row, slot] = timestamp
+            self.values[row, slot] = value
+        self.heads[row] = len(ordered) - 1
+        self.counts[row] = len(ordered)
+
+
+prices = {'binance': SeriesStore(), 'bybit': SeriesStore()}  # Цены: {exchange: SeriesStore}
+open_interest = {'binance': SeriesStore(), 'bybit': SeriesStore()}  # Открытый интерес: {exchange: SeriesStore}
+
+
+# Бюджет веса запросов (token bucket, weight за period секунд, пополняется равномерно;
+# burst - сколько веса можно потратить сразу, по умолчанию весь weight)
+class RequestWeightBudget:
+    def __init__(self, weight, period=60.0, burst=None):
+        self.capacity = weight if burst is None else burst
+        self.tokens = self.capacity
+        self.refill_rate = weight / period
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, weight=1):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_rate)
+                self.updated = now
+                if self.tokens >= weight:
+                    self.tokens -= weight
+                    return
+                # Ждем ровно столько, сколько нужно для накопления недостающего веса
+                await asyncio.sleep((weight - self.tokens) / self.refill_rate)
+
+
+oi_budgets = {exchange: RequestWeightBudget(weight) for exchange, weight in OI_WEIGHT_BUDGET.items()}
+backfill_budgets = {exchange: RequestWeightBudget(weight) for exchange, weight in BACKFILL_WEIGHT_BUDGET.items()}
+# Общий лимит отправки сообщений бота: равномерно, без всплеска в начале секунды
+send_budget = RequestWeightBudget(GLOBAL_MESSAGES_PER_SECOND, period=1.0, burst=1)
+
+
+# Журнал очереди исходящих сообщений в SQLite (WAL): поставленные сообщения дописываются строками,
+# отправленные и устаревшие удаляются по Id. Изменения копятся в памяти и пишутся одной транзакцией
+# на OUTBOUND_JOURNAL_BATCH изменений или по checkpoint; без open журнал ничего не пишет
+class OutboundJournal:
+
+    def __init__(self, path=None, batch=OUTBOUND_JOURNAL_BATCH):
+        self.path = path
+        self.batch = batch
+        self.db = None
+        self.next_id = 1
+        self.appended = []  # Строки, поставленные после последнего checkpoint
+        self.acked = []  # Id строк, подтвержденных после последнего checkpoint
+
+    # Подключение к базе. Возвращает неустаревшие сообщения в порядке постановки:
+    # [(Id, chat_id, priority, digest, expires_at, message)]
+    def open(self, now):
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS outbound_journal (Id INTEGER PRIMARY KEY, TelegramID INTEGER, Priority INTEGER, Digest INTEGER, ExpiresAt REAL, Message TEXT)')
+        with self.db:
+            self.db.execute('DELETE FROM outbound_journal WHERE ExpiresAt <= ?', (now,))
+        rows = self.db.execute('SELECT Id, TelegramID, Priority, Digest, ExpiresAt, Message FROM outbound_journal ORDER BY Id').fetchall()
+        self.next_id = rows[-1][0] + 1 if rows else 1
+        return rows
+
+    def close(self):
+        if self.db is not None:
+            self.checkpoint()
+            self.db.close()
+            self.db = None
+
+    def append(self, chat_id, priority, digest, expires_at, message):
+        if self.db is None:
+            return None
+        row_id = self.next_id
+        self.next_id += 1
+        self.appended.append((row_id, chat_id, priority, int(digest), expires_at, message))
+        if len(self.appended) + len(self.acked) >= self.batch:
+            self.checkpoint()
+        return row_id
+
+    def ack(self, ids):
+        if self.db is None or not ids:
+            return
+        self.acked.extend(ids)
+        if len(self.appended) + len(self.acked) >= self.batch:
+            self.checkpoint()
+
+    # Запись накопленных изменений одной транзакцией (при ошибке остаются до следующей попытки)
+    def checkpoint(self):
+        if self.db is None or not (self.appended or self.acked):
+            return
+        try:
+            with self.db:
+                self.db.executemany('INSERT INTO outbound_journal (Id, TelegramID, Priority, Digest, ExpiresAt, Message) VALUES (?, ?, ?, ?, ?, ?)', self.appended)
+                self.db.executemany('DELETE FROM outbound_journal WHERE Id = ?', [(row_id,) for row_id in self.acked])
+        except sqlite3.Error as e:
+            logger.error(f"Failed to checkpoint outbound journal: {e}")
+            return
+        self.appended = []
+        self.acked = []
+
+
+# Очередь исходящих сообщений. У каждого чата своя deque (сообщения чата уходят строго по порядку),
+# чаты стоят в одной из двух куч: ready - можно писать сейчас, по классу приоритета первого сообщения
+# и порядку постановки; delayed - по времени, раньше которого писать нельзя (интервал чата или retry_after).
+# Выданный отправителю чат не стоит ни в одной куче, пока не вызван release: в чат идет одно сообщение за раз.
+# С журналом сообщение удаляется с диска только после ack, поэтому переживает перезапуск бота;
+# сообщение старше своего TTL не отправляется
+class OutboundQueue:
+
+    def __init__(self, chat_interval=CHAT_MESSAGE_INTERVAL, journal=None):
+        self.chat_interval = chat_interval
+        self.journal = journal
+        self.chats = {}  # {chat_id: deque[(priority, message, digest, expires_at, journal_ids)]}
+        self.ready = []  # Куча (priority, seq, chat_id)
+        self.delayed = []  # Куча (not_before, priority, seq, chat_id)
+        self.not_before = {}  # {chat_id: время, раньше которого в чат не пишем}
+        self.scheduled = {}  # {chat_id: seq актуальной записи в ready/delayed}, остальные записи чата в кучах устарели
+        self.in_flight = set()  # Чаты, сообщение которых сейчас отправляется
+        self.seq = 0
+        self.size = 0
+        self.expired = 0  # Сообщения, отброшенные по TTL
+
+    def __len__(self):
+        return self.size
+
+    # Сообщения из журнала прошлого запуска (число восстановленных строк)
+    def restore(self, now):
+        rows = self.journal.open(now)
+        for row_id, chat_id, priority, digest, expires_at, message in rows:
+            self.enqueue(chat_id, message, priority, bool(digest), expires_at, row_id)
+        return len(rows)
+
+    def checkpoint(self):
+        if self.journal is not None:
+            self.journal.checkpoint()
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+
+    # digest=True: сообщение дописывается к последнему ждущему сообщению-сводке чата, если влезает в лимит
+    def push(self, chat_id, message, priority, digest=False, ttl=ALERT_TTL):
+        expires_at = time.time() + ttl
+        row_id = self.journal.append(chat_id, priority, digest, expires_at, message) if self.journal is not None else None
+        self.enqueue(chat_id, message, priority, digest, expires_at, row_id)
+
+    def enqueue(self, chat_id, message, priority, digest, expires_at, row_id):
+        ids = () if row_id is None else (row_id,)
+        queued = self.chats.setdefault(chat_id, deque())
+        if digest and queued and queued[-1][2]:
+            last_priority, last_message, _, last_expires_at, last_ids = queued[-1]
+            if len(last_message) + len(DIGEST_SEPARATOR) + len(message) <= TELEGRAM_MESSAGE_LIMIT:
+                # Сводка актуальна, пока актуален самый свежий сигнал в ней
+                queued[-1] = (min(last_priority, priority), last_message + DIGEST_SEPARATOR + message, True,
+                              max(last_expires_at, expires_at), last_ids + ids)
+                # Сводка во главе очереди стала важнее: чат переносится в куче на новый приоритет
+                if priority < last_priority and len(queued) == 1 and chat_id in self.scheduled:
+                    self.schedule(chat_id, time.time())
+                return
+        queued.append((priority, message, digest, expires_at, ids))
+        self.size += 1
+        if chat_id not in self.scheduled and chat_id not in self.in_flight:
+            self.schedule(chat_id, time.time())
+
+    def schedule(self, chat_id, now):
+        priority = self.chats[chat_id][0][0]
+        self.seq += 1
+        not_before = self.not_before.get(chat_id, 0)
+        if not_before > now:
+            heapq.heappush(self.delayed, (not_before, priority, self.seq, chat_id))
+        else:
+            heapq.heappush(self.ready, (priority, self.seq, chat_id))
+        self.scheduled[chat_id] = self.seq
+
+    # Следующее сообщение к отправке: (chat_id, entry) или None, если все чаты ждут.
+    # Устаревшие сообщения в начале очереди чата по пути отбрасываются
+    def pop(self, now):
+        while self.delayed and self.delayed[0][0] <= now:
+            _, priority, seq, chat_id = heapq.heappop(self.delayed)
+            heapq.heappush(self.ready, (priority, seq, chat_id))
+        while self.ready:
+            _, seq, chat_id = heapq.heappop(self.ready)
+            if self.scheduled.get(chat_id) != seq:
+                continue
+            del self.scheduled[chat_id]
+            queued = self.chats[chat_id]
+            while queued and queued[0][3] <= now:
+                self.ack(queued.popleft())
+                self.size -= 1
+                self.expired += 1
+            if not queued:
+                del self.chats[chat_id]
+                continue
+            self.in_flight.add(chat_id)
+            entry = queued.popleft()
+            self.size -= 1
+            return chat_id, entry
+        return None
+
+    # Сообщение доставлено (или отправлять его бесполезно): больше не хранится в журнале
+    def ack(self, entry):
+        if self.journal is not None:
+            self.journal.ack(entry[4])
+
+    # Отправка в чат завершена: следующее сообщение чата - не раньше интервала (или retry_after)
+    def release(self, chat_id, now, delay=None):
+        self.in_flight.discard(chat_id)
+        self.not_before[chat_id] = now + (self.chat_interval if delay is None else delay)
+        if self.chats.get(chat_id):
+            self.schedule(chat_id, now)
+        else:
+            self.chats.pop(chat_id, None)
+
+    # Сообщение не отправлено сейчас (flood control, лимит сообщений в минуту): возвращается
+    # в начало очереди своего чата и ждет delay секунд
+    def defer(self, chat_id, entry, delay):
+        self.chats.setdefault(chat_id, deque()).appendleft(entry)
+        self.size += 1
+        self.release(chat_id, time.time(), delay)
+
+    # Время, когда освободится ближайший ожидающий чат
+    def next_release(self):
+        return self.delayed[0][0] if self.delayed else None
+
+    # Забываем интервалы чатов, которые уже истекли
+    def prune(self, now):
+        self.not_before = {chat_id: until for chat_id, until in self.not_before.items() if until > now}
+
+    # Все ожидающие сообщения: [(chat_id, message)]
+    def messages(self):
+        return [(chat_id, entry[1]) for chat_id, queued in self.chats.items() for entry in queued]
+
+
+outbound_queue = OutboundQueue(journal=OutboundJournal(OUTBOUND_JOURNAL_DB_PATH))  # Сообщения пользователям
+
+
+# Дневные счетчики уведомлений по (chat_id, pair): значения в массиве int32, смена дня за O(1).
+# Измененные счетчики пачкой пишутся в SQLite (checkpoint), чтобы лимит Filter переживал перезапуск
+class AlertCounters:
+
+    def __init__(self, path=None, capacity=4096):
+        self.path = path
+        self.counts = np.zeros(capacity, dtype=np.int32)
+        self.index = {}  # {(chat_id, pair): ячейка}
+        self.day = datetime.now().date().isoformat()
+        self.dirty = set()  # Ключи, измененные после последнего checkpoint
+        self.db = None
+
+    # Подключение к базе и загрузка счетчиков текущего дня (без вызова счетчики живут только в памяти)
+    def open(self):
+        self.db = sqlite3.connect(self.path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS alert_counters (Day TEXT, TelegramID INTEGER, Pair TEXT, Count INTEGER, PRIMARY KEY (TelegramID, Pair))')
+        with self.db:
+            self.db.execute('DELETE FROM alert_counters WHERE Day != ?', (self.day,))
+        for chat_id, pair, count in self.db.execute('SELECT TelegramID, Pair, Count FROM alert_counters WHERE Day = ?', (self.day,)):
+            slot = self.slot(chat_id, pair)
+            self.counts[slot] = count
+        return len(self.index)
+
+    def close(self):
+        if self.db is not None:
+            self.checkpoint()
+            self.db.close()
+            self.db = None
+
+    # Ячейка счетчика (новые ячейки берутся подряд, при нехватке массив растет вдвое)
+    def slot(self, chat_id, pair):
+        key = (chat_id, pair)
+        slot = self.index.get(key)
+        if slot is None:
+            slot = len(self.index)
+            if slot >= len(self.counts):
+                self.counts = np.concatenate([self.counts, np.zeros_like(self.counts)])
+            self.counts[slot] = 0
+            self.index[key] = slot
+        return slot
+
+    def get(self, chat_id, pair):
+        slot = self.index.get((chat_id, pair))
+        return 0 if slot is None else int(self.counts[slot])
+
+    def increment(self, chat_id, pair):
+        slot = self.slot(chat_id, pair)
+        self.counts[slot] += 1
+        self.dirty.add((chat_id, pair))
+
+    # Смена дня: новый пустой индекс, массив переиспользуется (ячейки обнуляются при выдаче)
+    def rollover(self, day):
+        if day == self.day:
+            return False
+        self.day = day
+        self.index = {}
+        self.dirty = set()
+        if self.db is not None:
+            # Строки прошлых дней при ошибке остаются в базе: open читает только текущий день, checkpoint их перезаписывает
+            try:
+                with self.db:
+                    self.db.execute('DELETE FROM alert_counters WHERE Day != ?', (day,))
+            except sqlite3.Error as e:
+                logger.error(f"Failed to clear old alert counters: {e}")
+        return True
+
+    # Запись измененных счетчиков одной транзакцией
+    def checkpoint(self):
+        if self.db is None or not self.dirty:
+            return
+        rows = [(self.day, chat_id, pair, int(self.counts[self.index[(chat_id, pair)]])) for chat_id, pair in self.dirty]
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO alert_counters (Day, TelegramID, Pair, Count) VALUES (?, ?, ?, ?)', rows)
+        self.dirty = set()
+
+
+notification_counters = AlertCounters(ALERT_COUNTERS_DB_PATH)  # Счетчики уведомлений за день
+
+
+# Снимок истории цен и OI всех бирж. Под prices_lock только копируются массивы, файлы пишутся в потоке,
+# не задерживая рассылку и обработку потока тикеров. Второй уровень (*_5m.bin) меняется раз в
+# COARSE_STEP_MINUTES, поэтому пишется после закрытия 5-минутного интервала и при остановке (force=True)
+async def snapshot_history(force=False):
+    global coarse_snapshot_bucket
+    saved_ms = int(time.time() * 1000)
+    bucket = saved_ms // COARSE_STEP_MS
+    write_coarse = force or bucket != coarse_snapshot_bucket
+    jobs = []
+    async with prices_lock:
+        for kind, stores in (('prices', prices), ('open_interest', open_interest)):
+            for exchange, store in stores.items():
+                jobs.append((os.path.join(HISTORY_SNAPSHOT_DIR, f"{kind}_{exchange}.bin"), store.snapshot_state()))
+                if write_coarse and store.coarse is not None:
+                    jobs.append((os.path.join(HISTORY_SNAPSHOT_DIR, f"{kind}_{exchange}_5m.bin"), store.coarse.snapshot_state()))
+    try:
+        await asyncio.to_thread(write_snapshot_files, jobs, saved_ms)
+    except OSError as e:
+        logger.error(f"Failed to snapshot history: {e}")
+        return
+    if write_coarse:
+        coarse_snapshot_bucket = bucket
+
+
+def write_snapshot_files(jobs, saved_ms):
+    os.makedirs(HISTORY_SNAPSHOT_DIR, exist_ok=True)
+    for path, (capacity, arrays, index) in jobs:
+        SeriesStore.write_snapshot(path, saved_ms, capacity, arrays, index)
+
+
+# Чтение одного файла снимка: None, если файла нет, он устарел или поврежден
+def load_snapshot_file(path, now_ms, max_age_ms, capacity):
+    try:
+        return SeriesStore.load(path, now_ms, max_age_ms, capacity)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError) as e:
+        logger.error(f"Failed to load history snapshot {path}: {e}")
+        return None
+
+
+# Загрузка истории из снимка при старте (свежие пары; остальное заполнят реинициализация и прогрев).
+# Уровни загружаются независимо: после простоя дольше 30 минут второй уровень еще пригоден
+def restore_history():
+    global prices, open_interest
+    now_ms = int(time.time() * 1000)
+    restored = []
+    for kind, stores in (('prices', prices), ('open_interest', open_interest)):
+        for exchange in stores:
+            base_path = os.path.join(HISTORY_SNAPSHOT_DIR, f"{kind}_{exchange}")
+            store = load_snapshot_file(f"{base_path}.bin", now_ms, HISTORY_SNAPSHOT_MAX_AGE_MS, HISTORY_CAPACITY)
+            if store is not None:
+                store.coarse = stores[exchange].coarse
+                stores[exchange] = store
+                restored.append(f"{kind} {exchange}: {len(store)}")
+            coarse = load_snapshot_file(f"{base_path}_5m.bin", now_ms, COARSE_SNAPSHOT_MAX_AGE_MS, COARSE_HISTORY_CAPACITY)
+            if coarse is not None:
+                stores[exchange].coarse = coarse
+                restored.append(f"{kind} {exchange} 5m: {len(coarse)}")
+    if restored:
+        logger.info(f"History restored from snapshot ({', '.join(restored)})")
+    return restored
+
+
+# Получение значения OI из ответа ccxt (в унифицированной структуре это 'openInterestAmount')
+def extract_open_interest(oi_data):
+    if not oi_data:
+        return None
+    value = oi_data.get('openInterestAmount')
+    if value is None:
+        value = oi_data.get('openInterest')
+    return value
+
+
+# Сбор OI по списку пар: параллельно, в рамках бюджета веса биржи и с дедлайном
+async def collect_open_interest(exchange, ex_obj, pairs, deadline=OI_COLLECT_DEADLINE):
+    semaphore = asyncio.Semaphore(OI_MAX_CONCURRENCY[exchange])
+    budget = oi_budgets[exchange]
+    oi_values = {}  # {pair: oi или None, если биржа не вернула значение}
+    oi_errors = {}  # {pair: исключение при запросе}
+
+    async def fetch_one(pair):
+        async with semaphore:
+            await budget.acquire(OI_REQUEST_WEIGHT[exchange])
+            try:
+                oi_data = await ex_obj.fetch_open_interest(pair)
+                oi_values[pair] = extract_open_interest(oi_data)
+            except Exception as e:
+                # Ошибки биржи и сети разбирает вызывающий код (например, -4108)
+                oi_errors[pair] = e
+
+    tasks = [asyncio.create_task(fetch_one(pair)) for pair in pairs]
+    if tasks:
+        try:
+            await asyncio.wait(tasks, timeout=deadline)
+        finally:
+            # Не дождавшиеся дедлайна запросы отменяем, чтобы не задерживать цикл
+            # (в том числе если отменили весь опрос биржи)
+            pending = [task for task in tasks if not task.done()]
+            for task in pending:
+                task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    
+    stale_pairs = [pair for pair in pairs if pair not in oi_values and pair not in oi_errors]
+    if stale_pairs:
+        logger.warning(f"{exchange}: OI deadline {deadline}s exceeded, {len(stale_pairs)} pairs marked stale")
+    return oi_values, oi_errors, stale_pairs
+
+
+# OI из общего ответа тикеров для бирж, которые его туда кладут; None - если биржа так не умеет
+def extract_bulk_open_interest(exchange, tickers):
+    if exchange not in OI_BULK_SOURCES:
+        return None
+    bulk_oi = {}
+    for pair, ticker in tickers.items():
+        value = (ticker.get('info') or {}).get('openInterest')
+        if value not in (None, ''):
+            bulk_oi[pair] = float(value)
+    return bulk_oi
+
+
+# Параллельный запуск операции operation(exchange, ex_obj) для всех бирж, у каждой свой дедлайн
+# Возвращает {exchange: (status, result)}, статус также сохраняется в exchange_status
+async def run_for_exchanges(operation, deadlines):
+    
+    async def run_one(exchange, ex_obj):
+        try:
+            result = await asyncio.wait_for(operation(exchange, ex_obj), timeout=deadlines[exchange])
+            return exchange, 'ok', result
+        except asyncio.TimeoutError:
+            logger.warning(f"{exchange}: {operation.__name__} exceeded deadline {deadlines[exchange]}s")
+            return exchange, 'timeout', None
+        except Exception as e:
+            logger.error(f"{exchange}: {operation.__name__} failed: {e.__class__.__name__}: {e}")
+            return exchange, 'error', None
+    
+    results = await asyncio.gather(*(run_one(exchange, ex_obj) for exchange, ex_obj in [('binance', binance_exchange), ('bybit', bybit_exchange)]))
+    for exchange, status, _ in results:
+        exchange_status[exchange] = status
+    return {exchange: (status, result) for exchange, status, result in results}
+
+
+# Строка для дебаг-чата о биржах, не ответивших вовремя (пустая, если все в порядке)
+def degraded_exchanges_summary():
+    degraded = [f"{exchange.capitalize()} ({status})" for exchange, status in exchange_status.items() if status != 'ok']
+    return f"\nDegraded: {', '.join(degraded)}" if degraded else ""
+
+
 # Получение списка игнорируемых пар из базы данных
 def get_ignored_pairs():
     db_path = BAN_PAIRS_DB_PATH
@@ -179,12 +1086,9 @@ def get_ignored_pairs():
 
 
 # Функция для получения пар и цен с биржи
-async def fetch_pairs_and_prices(exchange, exchange_name):
-    
-    markets = await exchange.load_markets()
-    logger.info(f"{exchange_name}: Loaded {len(markets)} markets")
-    
-    usdt_perpetual = {
+# Отбор USDT-перпетуалов из рынков ccxt
+def filter_usdt_perpetual(markets):
+    return {
         symbol: market for symbol, market in markets.items()
         if (
             market.get('quote') == 'USDT' and
@@ -194,7 +1098,94 @@ async def fetch_pairs_and_prices(exchange, exchange_name):
             market.get('linear') is True
         )
     }
+
+
+# Чтение кэша рынков с диска (пустой словарь, если файла нет или он поврежден)
+def market_cache_path(exchange_name):
+    return f"{os.path.splitext(MARKET_CACHE_PATH)[0]}_{exchange_name}.json"
+
+
+def load_market_cache(exchange_name):
+    path = market_cache_path(exchange_name)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Market cache {path} is unreadable, ignoring it: {e}")
+        return None
+
+
+# Сохранение перпетуалов биржи в ее файл кэша (без 'info', через временный файл, чтобы не оставить файл
+# недописанным; имя временного файла с pid, чтобы не столкнуться со скриптом проверки)
+def save_market_cache(exchange_name, usdt_perpetual):
+    market_cache[exchange_name] = {
+        'updated': time.time(),
+        'markets': {symbol: {k: v for k, v in market.items() if k != 'info'} for symbol, market in usdt_perpetual.items()}
+    }
+    path = market_cache_path(exchange_name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(market_cache[exchange_name], f, default=str)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.error(f"Failed to save market cache {path}: {e}")
+
+
+# Перпетуалы биржи: из памяти ccxt, при старте - из свежего кэша на диске, иначе полной загрузкой рынков
+async def load_perpetual_markets(exchange, exchange_name):
+    if not exchange.markets:
+        if exchange_name not in market_cache:
+            cached = load_market_cache(exchange_name)
+            if cached is not None:
+                market_cache[exchange_name] = cached
+        cached = market_cache.get(exchange_name)
+        if cached and time.time() - cached['updated'] < MARKET_CACHE_TTL:
+            # load_markets/fetch_tickers после set_markets больше не ходят за рынками
+            exchange.set_markets(list(cached['markets'].values()))
+            logger.info(f"{exchange_name}: Loaded {len(cached['markets'])} markets from cache ({time.time() - cached['updated']:.0f}s old)")
+    if not exchange.markets:
+        markets = await exchange.load_markets()
+        logger.info(f"{exchange_name}: Loaded {len(markets)} markets")
+        save_market_cache(exchange_name, filter_usdt_perpetual(markets))
+    return filter_usdt_perpetual(exchange.markets)
+
+
+# Фоновое обновление рынков одной биржи: кэш переписывается, реинициализации передаются только изменения
+async def refresh_markets(exchange_name, exchange):
+    before = set(filter_usdt_perpetual(exchange.markets or {}))
+    markets = await exchange.load_markets(reload=True)
+    usdt_perpetual = filter_usdt_perpetual(markets)
+    save_market_cache(exchange_name, usdt_perpetual)
+    added = set(usdt_perpetual) - before
+    removed = before - set(usdt_perpetual)
+    if added or removed:
+        logger.info(f"{exchange_name}: Markets changed: +{sorted(added)} / -{sorted(removed)}")
+        market_changes[exchange_name] = (added, removed)
+
+
+# Цикл фонового обновления рынков (раз в MARKET_REFRESH_INTERVAL для каждой биржи)
+async def market_refresh_loop():
+    while True:
+        for exchange_name, exchange in [('binance', binance_exchange), ('bybit', bybit_exchange)]:
+            cached = market_cache.get(exchange_name)
+            if cached and time.time() - cached['updated'] < MARKET_REFRESH_INTERVAL:
+                continue
+            try:
+                await refresh_markets(exchange_name, exchange)
+            except Exception as e:
+                logger.error(f"{exchange_name}: market refresh failed: {e.__class__.__name__}: {e}")
+        await asyncio.sleep(60)
+
+
+async def fetch_pairs_and_prices(exchange, exchange_name):
+    
+    usdt_perpetual = await load_perpetual_markets(exchange, exchange_name)
     logger.info(f"{exchange_name}: Filtered {len(usdt_perpetual)} USDT perpetual pairs")
+    # Запоминаем соответствие id биржи -> символ ccxt для разбора кадров websocket
+    market_ids[exchange_name] = {market['id']: symbol for symbol, market in usdt_perpetual.items()}
     
     # Убираем нормализацию для Binance, оставляем символы как есть
     normalized_symbols = list(usdt_perpetual.keys())
@@ -212,7 +1203,140 @@ async def fetch_pairs_and_prices(exchange, exchange_name):
     result = {symbol: tickers.get(symbol, {}).get('last') for symbol in normalized_symbols if tickers.get(symbol, {}).get('last') is not None}
     logger.info(f"{exchange_name}: Final pairs with prices: {len(result)}")
     
-    return result
+    # Заодно забираем OI из того же ответа, если биржа его отдает (Bybit)
+    bulk_oi = extract_bulk_open_interest(exchange_name, tickers)
+    if bulk_oi is not None:
+        logger.info(f"{exchange_name}: Open interest from bulk tickers: {len(bulk_oi)}")
+    
+    return result, bulk_oi
+
+
+# Разбор кадра потока тикеров: обновляет последние цены пар. Цена хранится с локальным временем получения:
+# метка биржи (E у Binance, ts у Bybit) зависит от ее часов, а у воспроизведенных кадров она из прошлого,
+# и история отбросила бы такие точки как устаревшие
+def handle_stream_frame(exchange, payload):
+    ids = market_ids[exchange]
+    latest = stream_prices[exchange]
+    received_ms = int(time.time() * 1000)
+    updated = 0
+    if exchange == 'binance':
+        # !miniTicker@arr: список мини-тикеров по всем изменившимся символам
+        if not isinstance(payload, list):
+            return 0
+        for item in payload:
+            pair = ids.get(item.get('s'))
+            if pair is not None and item.get('c') is not None:
+                latest[pair] = (float(item['c']), received_ms)
+                updated += 1
+    else:
+        # tickers.{symbol}: snapshot или delta, в delta есть только изменившиеся поля
+        if not isinstance(payload, dict) or not str(payload.get('topic', '')).startswith('tickers.'):
+            return 0
+        data = payload.get('data') or {}
+        pair = ids.get(data.get('symbol'))
+        if pair is not None and data.get('lastPrice'):
+            latest[pair] = (float(data['lastPrice']), received_ms)
+            updated += 1
+        if pair is not None and data.get('openInterest'):
+            stream_open_interest[exchange][pair] = float(data['openInterest'])
+    return updated
+
+
+# Подписка на тикеры Bybit пачками (у Bybit нет общего потока по всем символам)
+async def subscribe_bybit_tickers(ws, symbols_ids):
+    for i in range(0, len(symbols_ids), BYBIT_STREAM_BATCH):
+        batch = symbols_ids[i:i + BYBIT_STREAM_BATCH]
+        await ws.send_json({'op': 'subscribe', 'args': [f"tickers.{market_id}" for market_id in batch]})
+
+
+# Поток тикеров биржи с автоматическим переподключением
+async def run_ticker_stream(exchange):
+    backoff = 1
+    while True:
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.ws_connect(STREAM_URLS[exchange]) as ws:
+                    logger.info(f"{exchange}: ticker stream connected to {STREAM_URLS[exchange]}")
+                    subscribed = set()
+                    last_ping = time.time()
+                    backoff = 1
+                    while True:
+                        if exchange == 'bybit':
+                            # Досписываемся на новые листинги после реинициализации
+                            new_ids = [market_id for market_id in market_ids['bybit'] if market_id not in subscribed]
+                            if new_ids:
+                                await subscribe_bybit_tickers(ws, new_ids)
+                                subscribed.update(new_ids)
+                            if time.time() - last_ping >= STREAM_PING_INTERVAL:
+                                await ws.send_json({'op': 'ping'})
+                                last_ping = time.time()
+                        try:
+                            msg = await ws.receive(timeout=STREAM_PING_INTERVAL)
+                        except asyncio.TimeoutError:
+                            continue
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            if handle_stream_frame(exchange, json.loads(msg.data)):
+                                stream_last_message[exchange] = time.time()
+                        elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.CLOSING, aiohttp.WSMsgType.ERROR):
+                            break
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"{exchange}: ticker stream error: {e}")
+        logger.warning(f"{exchange}: ticker stream disconnected, reconnecting in {backoff}s")
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, 60)
+
+
+# Свежий ли поток тикеров биржи
+def is_stream_fresh(exchange):
+    return STREAM_MODE and time.time() - stream_last_message[exchange] < STREAM_STALE_AFTER
+
+
+# Цены из потока в формате ответа fetch_tickers (используются только 'last' и info.openInterest)
+def stream_tickers(exchange):
+    stream_oi = stream_open_interest[exchange]
+    return {
+        pair: {'last': price, 'timestamp': timestamp, 'info': {'openInterest': stream_oi.get(pair)}}
+        for pair, (price, timestamp) in stream_prices[exchange].items()
+    }
+
+
+# Обновление последней цены в истории по данным потока (новая поминутная точка не добавляется)
+async def apply_stream_prices():
+    updated_count = {'binance': 0, 'bybit': 0}
+    async with prices_lock:
+        for exchange in ['binance', 'bybit']:
+            if not is_stream_fresh(exchange):
+                continue
+            store = prices[exchange]
+            for pair, (price, timestamp) in stream_prices[exchange].items():
+                if store.update_latest(pair, timestamp, price):
+                    updated_count[exchange] += 1
+    return updated_count
+
+
+# Граница минуты, до которой должен уложиться текущий цикл (считается один раз в начале цикла)
+def next_minute_boundary():
+    return (int(time.time()) // 60 + 1) * 60
+
+
+# Проверки по ценам из потока с заданным интервалом до границы минуты цикла.
+# Если цикл затянулся за нее, сразу возвращаемся к минутному циклу, а не ждем еще минуту
+async def stream_evaluate_until_next_minute(boundary):
+    while True:
+        remaining = boundary - time.time()
+        if remaining <= 0:
+            return
+        if remaining <= STREAM_EVAL_INTERVAL:
+            await asyncio.sleep(remaining)
+            return
+        await asyncio.sleep(STREAM_EVAL_INTERVAL)
+        updated_count = await apply_stream_prices()
+        logger.debug(f"Stream prices applied: Binance {updated_count['binance']} | Bybit {updated_count['bybit']}")
+        await price_check_and_send_notifications()
+        # Рассылка не заходит за границу минуты: остаток уйдет в следующем цикле
+        await process_message_queue(deadline=min(DELIVERY_DEADLINE, boundary - time.time()))
 
 
 # Инициализация начальных цен и OI
@@ -226,32 +1350,42 @@ async def price_fetch_initial_prices():
     # Получаем список пар, которые нужно игнорировать из базы данных
     ignored_pairs = get_ignored_pairs()
     
-    # Проходим по каждой бирже (Binance и Bybit)
-    for exchange, ex_obj in [('binance', binance_exchange), ('bybit', bybit_exchange)]:
+    # Инициализация одной биржи (Binance и Bybit обрабатываются параллельно)
+    async def initialize_exchange(exchange, ex_obj):
         # Получаем пары и их начальные цены с учетом фильтрации
-        prices_data = await fetch_pairs_and_prices(ex_obj, exchange)
+        prices_data, bulk_oi = await fetch_pairs_and_prices(ex_obj, exchange)
+        pairs = [pair for pair in prices_data if pair not in ignored_pairs]
         
-        # Инициализируем prices для данной биржи, исключая игнорируемые пары
-        prices[exchange] = {pair: [price] for pair, price in prices_data.items() if pair not in ignored_pairs}
+        # Для каждой пары получаем начальный открытый интерес (OI): из тикеров или отдельными запросами
+        if bulk_oi is not None:
+            oi_values, oi_errors = bulk_oi, {}
+        else:
+            oi_values, oi_errors, _ = await collect_open_interest(exchange, ex_obj, pairs)
         
         # Блокируем доступ к ценам для безопасного обновления
         async with prices_lock:
-            # Для каждой пары получаем начальный открытый интерес (OI)
-            for pair in list(prices[exchange].keys()):
-                try:
-                    # Запрашиваем OI для данной пары
-                    oi_data = await ex_obj.fetch_open_interest(pair)
-                    # Если OI есть, сохраняем его, иначе ставим 0
-                    open_interest[exchange][pair] = [oi_data['openInterest']] if oi_data.get('openInterest') else [0]
-                except ccxt.ExchangeError as e:
+            # Инициализируем prices для данной биржи, исключая игнорируемые пары
+            now_ms = int(time.time() * 1000)
+            prices[exchange] = SeriesStore()
+            open_interest[exchange] = SeriesStore()
+            for pair in pairs:
+                prices[exchange].append(pair, now_ms, prices_data[pair])
+            for pair in pairs:
+                e = oi_errors.get(pair)
+                if e is not None:
                     # Обрабатываем ошибку -4108 (пара в доставке/расчетах)
                     if '-4108' in str(e):
                         logger.warning(f"Removing {pair} from {exchange} due to delivery/settlement: {e}")
                         # Удаляем проблемную пару из отслеживания
-                        del prices[exchange][pair]
+                        prices[exchange].remove(pair)
                     else:
                         # Логируем другие ошибки с OI для дальнейшего анализа
                         logger.error(f"Error fetching OI for {pair} on {exchange}: {e}")
+                    continue
+                # Если OI есть, сохраняем его, иначе ставим 0
+                open_interest[exchange].append(pair, now_ms, oi_values.get(pair) or 0)
+    
+    await run_for_exchanges(initialize_exchange, REINIT_DEADLINES)
     
     # Записываем время окончания инициализации
     end_time = datetime.now().strftime("%H:%M:%S")
@@ -261,12 +1395,133 @@ async def price_fetch_initial_prices():
         f"{start_time} -> {end_time} - Initial prices collected\n"
         f"Binance: {len(prices['binance'])} Fetched\n"  # Количество пар для Binance
         f"Bybit: {len(prices['bybit'])} Fetched"  # Количество пар для Bybit
+        f"{degraded_exchanges_summary()}"
     )
     print(summary_message)
     # Отправляем итоги в дебаг-чат
     await debug_bot.send_message(chat_id=DEBUG_CHAT_ID, text=summary_message)
 
 
+# Снимок последних цен по всем парам биржи в сыром виде (строки ответа биржи).
+# Binance: /fapi/v1/ticker/price (вес 2 против 40 у /ticker/24hr);
+# Bybit: /v5/market/tickers без разбора ccxt (легче эндпоинта нет, зато в нем же OI)
+async def fetch_price_snapshot(exchange, ex_obj):
+    if exchange == 'binance':
+        return await ex_obj.fapiPublicGetTickerPrice()
+    response = await ex_obj.publicGetV5MarketTickers({'category': 'linear'})
+    return response['result']['list']
+
+
+# Разбор снимка сразу в историю цен (вызывается под prices_lock), для Bybit заодно заполняет oi_values.
+# Возвращает количество обновленных пар
+def apply_price_snapshot(exchange, rows, cycle_ts, oi_values):
+    store = prices[exchange]
+    ids = market_ids[exchange]
+    fetched_count = 0
+    if exchange == 'binance':
+        for row in rows:
+            pair = ids.get(row['symbol'])
+            if pair is not None and pair in store:
+                store.append(pair, int(row.get('time') or cycle_ts), float(row['price']))
+                fetched_count += 1
+    else:
+        for row in rows:
+            pair = ids.get(row['symbol'])
+            if pair is None or pair not in store:
+                continue
+            if row.get('lastPrice'):
+                store.append(pair, cycle_ts, float(row['lastPrice']))
+                fetched_count += 1
+            if row.get('openInterest'):
+                oi_values[pair] = float(row['openInterest'])
+    return fetched_count
+
+
+# Обновление цен и OI одной биржи, возвращает (количество обновленных пар, проблемные пары)
+async def price_fetch_exchange(exchange, ex_obj):
+    fetched_count = 0
+    problem_pairs = []
+    
+    # Получаем список отслеживаемых пар для данной биржи
+    tracked_pairs = list(prices[exchange].keys())
+    if not tracked_pairs:
+        return fetched_count, problem_pairs  # Пропускаем, если нет пар для обработки
+    # Метка цикла - для точек, у которых биржа не прислала свою (тикеры Bybit, OI)
+    cycle_ts = int(time.time() * 1000)
+
+    # Получаем текущие цены для всех пар разом: из потока, если он жив, иначе легким снимком цен,
+    # а при его ошибке - полными тикерами ccxt
+    tickers = None
+    price_rows = None
+    if is_stream_fresh(exchange):
+        tickers = stream_tickers(exchange)
+    elif LEAN_PRICE_FETCH and market_ids[exchange]:
+        try:
+            price_rows = await fetch_price_snapshot(exchange, ex_obj)
+        except Exception as e:
+            logger.warning(f"{exchange}: lean price snapshot failed, falling back to fetch_tickers: {e.__class__.__name__}: {e}")
+    if tickers is None and price_rows is None:
+        tickers = await ex_obj.fetch_tickers(tracked_pairs)
+    
+    # OI берем из того же ответа тикеров, если биржа его отдает (из снимка - при разборе под блокировкой),
+    # иначе собираем вне блокировки: параллельно и с дедлайном
+    bulk_oi = extract_bulk_open_interest(exchange, tickers) if tickers is not None else None
+    if bulk_oi is not None:
+        oi_values, oi_errors, stale_pairs = bulk_oi, {}, []
+    elif price_rows is not None and exchange in OI_BULK_SOURCES:
+        oi_values, oi_errors, stale_pairs = {}, {}, []
+    else:
+        oi_values, oi_errors, stale_pairs = await collect_open_interest(exchange, ex_obj, tracked_pairs)
+    stale_set = set(stale_pairs)
+    
+    # Блокируем доступ к данным для безопасного обновления (внутри нет await - отмена по дедлайну
+    # не может оставить историю обновленной наполовину)
+    async with prices_lock:
+        oi_stale[exchange] = stale_set
+        if price_rows is not None:
+            fetched_count = apply_price_snapshot(exchange, price_rows, cycle_ts, oi_values)
+        for pair in tracked_pairs:
+            try:
+                # Пара могла быть удалена реинициализацией, пока мы ждали OI
+                if pair not in prices[exchange]:
+                    continue
+                # Получаем новую цену для пары (снимок цен уже разобран выше)
+                ticker = tickers.get(pair, {}) if tickers is not None else {}
+                new_price = ticker.get('last')
+                if new_price is not None:
+                    # Добавляем новую цену с временем биржи (из потока - со временем получения; устаревшие точки история отбросит сама)
+                    prices[exchange].append(pair, ticker.get('timestamp') or cycle_ts, new_price)
+                    fetched_count += 1  # Увеличиваем счетчик успешных обновлений
+            
+                # Обновляем открытый интерес
+                if pair in stale_set:
+                    # OI не успел прийти: точку пропускаем, сравнение пойдет по реальному времени
+                    pass
+                elif pair in oi_errors:
+                    e = oi_errors[pair]
+                    # Обрабатываем ошибку -4108
+                    if '-4108' in str(e):
+                        logger.warning(f"Skipping {pair} on {exchange} due to delivery/settlement: {e}")
+                        problem_pairs.append(pair)  # Добавляем в список проблемных
+                    else:
+                        # Логируем другие ошибки с OI
+                        logger.error(f"Error fetching OI for {pair} on {exchange}: {e}")
+                        problem_pairs.append(pair)
+                elif oi_values.get(pair) is not None:
+                    # Добавляем новый OI
+                    open_interest[exchange].append(pair, cycle_ts, oi_values[pair])
+                else:
+                    # Логируем, если OI отсутствует в ответе
+                    logger.warning(f"No openInterest data for {pair} on {exchange}")
+                
+            except Exception as e:
+                # Логируем любые другие ошибки обработки пары
+                logger.error(f"Error processing {pair} on {exchange}: {e}")
+                problem_pairs.append(pair)
+    
+    return fetched_count, problem_pairs
+
+
 # Обновление цен и OI
 @global_timeout_retry(retries=3, delay=5)
 async def price_fetch_and_compare_prices():
@@ -277,56 +1532,11 @@ async def price_fetch_and_compare_prices():
         # Список пар с проблемами для логирования
         problem_pairs = {'binance': [], 'bybit': []}
 
-        # Проходим по каждой бирже
-        for exchange, ex_obj in [('binance', binance_exchange), ('bybit', bybit_exchange)]:
-            # Получаем список отслеживаемых пар для данной биржи
-            tracked_pairs = list(prices[exchange].keys())
-            if not tracked_pairs:
-                continue  # Пропускаем, если нет пар для обработки
-
-            # Получаем текущие цены для всех пар разом
-            tickers = await ex_obj.fetch_tickers(tracked_pairs)
-            
-            # Блокируем доступ к данным для безопасного обновления
-            async with prices_lock:
-                for pair in tracked_pairs:
-                    try:
-                        # Получаем новую цену для пары
-                        new_price = tickers.get(pair, {}).get('last')
-                        if new_price is not None:
-                            # Добавляем новую цену в начало списка
-                            prices[exchange][pair].insert(0, new_price)
-                            # Ограничиваем длину списка до 30 значений
-                            if len(prices[exchange][pair]) > 30:
-                                prices[exchange][pair].pop()
-                            fetched_count[exchange] += 1  # Увеличиваем счетчик успешных обновлений
-                    
-                        # Обновляем открытый интерес
-                        try:
-                            oi = await ex_obj.fetch_open_interest(pair)
-                            if oi.get('openInterest') is not None:
-                                # Добавляем новый OI в начало списка
-                                open_interest[exchange][pair].insert(0, oi['openInterest'])
-                                # Ограничиваем длину списка до 30 значений
-                                if len(open_interest[exchange][pair]) > 30:
-                                    open_interest[exchange][pair].pop()
-                            else:
-                                # Логируем, если OI отсутствует в ответе
-                                logger.warning(f"No openInterest data for {pair} on {exchange}")
-                        except ccxt.ExchangeError as e:
-                            # Обрабатываем ошибку -4108
-                            if '-4108' in str(e):
-                                logger.warning(f"Skipping {pair} on {exchange} due to delivery/settlement: {e}")
-                                problem_pairs[exchange].append(pair)  # Добавляем в список проблемных
-                            else:
-                                # Логируем другие ошибки с OI
-                                logger.error(f"Error fetching OI for {pair} on {exchange}: {e}")
-                                problem_pairs[exchange].append(pair)
-                        
-                    except Exception as e:
-                        # Логируем любые другие ошибки обработки пары
-                        logger.error(f"Error processing {pair} on {exchange}: {e}")
-                        problem_pairs[exchange].append(pair)
+        # Опрашиваем биржи параллельно, у каждой свой дедлайн
+        results = await run_for_exchanges(price_fetch_exchange, EXCHANGE_DEADLINES)
+        for exchange, (status, result) in results.items():
+            if status == 'ok':
+                fetched_count[exchange], problem_pairs[exchange] = result
         
         # Если были проблемные пары, формируем сообщение для логов
         if any(problem_pairs.values()):
@@ -360,50 +1570,201 @@ async def reinitialize_pairs():
     start_time = datetime.now().strftime("%H:%M:%S")
     ignored_pairs = get_ignored_pairs()
     logger.info(f"Starting reinitialization. Ignored pairs: {len(ignored_pairs)}")
+    reinit_changes = {'binance': (0, 0), 'bybit': (0, 0)}  # {exchange: (добавлено, удалено)}
+    # Изменения, найденные фоновым обновлением рынков, учитываются этой реинициализацией
+    for exchange in market_changes:
+        market_changes[exchange] = None
     
-    for exchange, ex_obj in [('binance', binance_exchange), ('bybit', bybit_exchange)]:
-        try:
-            # Получаем новые пары и цены
-            new_prices = await fetch_pairs_and_prices(ex_obj, exchange)
-            logger.info(f"{exchange}: Retrieved {len(new_prices)} pairs from fetch_pairs_and_prices")
-            
-            # Блокируем доступ к данным для безопасного обновления
-            async with prices_lock:
-                # Обновляем prices, исключая игнорируемые пары
-                prices[exchange] = {pair: [price] for pair, price in new_prices.items() if pair not in ignored_pairs}
-                logger.info(f"{exchange}: After filtering ignored pairs: {len(prices[exchange])}")
-                
-                # Обновляем OI для каждой пары
-                for pair in list(prices[exchange].keys()):
-                    try:
-                        oi_data = await ex_obj.fetch_open_interest(pair)
-                        open_interest[exchange][pair] = [oi_data['openInterest']] if oi_data.get('openInterest') else [0]
-                    except ccxt.ExchangeError as e:
-                        if '-4108' in str(e):
-                            logger.warning(f"Removing {pair} from {exchange} due to delivery/settlement: {e}")
-                            del prices[exchange][pair]
-                        else:
-                            logger.error(f"Error fetching OI for {pair} on {exchange}: {e}")
-                
-                # Очистка cooldown для удаленных пар
-                for pair in list(prices_cooldown[exchange].keys()):
-                    if pair not in prices[exchange]:
-                        del prices_cooldown[exchange][pair]
-                for pair in list(oi_cooldown[exchange].keys()):
-                    if pair not in prices[exchange]:
-                        del oi_cooldown[exchange][pair]
-                logger.info(f"{exchange}: Final count after OI and cooldown: {len(prices[exchange])}")
+    # Реинициализация одной биржи (Binance и Bybit обрабатываются параллельно).
+    # История и cooldown сохранившихся пар не трогаются: добавляются новые листинги,
+    # удаляются делистингованные и игнорируемые пары
+    async def reinitialize_exchange(exchange, ex_obj):
+        # Получаем новые пары и цены
+        new_prices, bulk_oi = await fetch_pairs_and_prices(ex_obj, exchange)
+        logger.info(f"{exchange}: Retrieved {len(new_prices)} pairs from fetch_pairs_and_prices")
+        pairs = [pair for pair in new_prices if pair not in ignored_pairs]
+        added = [pair for pair in pairs if pair not in prices[exchange]]
+        removed = set(prices[exchange].keys()) - set(pairs)
         
-        except Exception as e:
-            logger.error(f"Failed to reinitialize {exchange}: {e}")
-            prices[exchange] = {}
-            open_interest[exchange] = {}
+        # OI нужен только новым парам: из тикеров или параллельными запросами
+        if bulk_oi is not None:
+            oi_values, oi_errors = bulk_oi, {}
+        elif added:
+            oi_values, oi_errors, _ = await collect_open_interest(exchange, ex_obj, added)
+        else:
+            oi_values, oi_errors = {}, {}
+        
+        # Блокируем доступ к данным для безопасного обновления
+        async with prices_lock:
+            for pair in removed:
+                prices[exchange].remove(pair)
+                open_interest[exchange].remove(pair)
+            # Второй уровень из снимка может хранить пары, которых уже нет на первом
+            for store in (prices[exchange], open_interest[exchange]):
+                if store.coarse is not None:
+                    for pair in set(store.coarse.keys()) - set(pairs):
+                        store.coarse.remove(pair)
+            
+            now_ms = int(time.time() * 1000)
+            for pair in added:
+                e = oi_errors.get(pair)
+                if e is not None:
+                    if '-4108' in str(e):
+                        logger.warning(f"Skipping {pair} on {exchange} due to delivery/settlement: {e}")
+                        continue
+                    logger.error(f"Error fetching OI for {pair} on {exchange}: {e}")
+                else:
+                    open_interest[exchange].append(pair, now_ms, oi_values.get(pair) or 0)
+                prices[exchange].append(pair, now_ms, new_prices[pair])
+            reinit_changes[exchange] = (len(added), len(removed))
+            
+            # Очистка cooldown удаленных пар и истекших записей, которые с тех пор не проверялись
+            now = time.time()
+            for cooldowns in (prices_cooldown[exchange], oi_cooldown[exchange]):
+                for key in [key for key, until in cooldowns.items() if key[0] not in prices[exchange] or until <= now]:
+                    del cooldowns[key]
+            logger.info(f"{exchange}: {len(prices[exchange])} pairs after reinitialization (+{len(added)} / -{len(removed)})")
+    
+    # Биржа, не успевшая к дедлайну, сохраняет прежний набор пар до следующей реинициализации
+    await run_for_exchanges(reinitialize_exchange, REINIT_DEADLINES)
     
     end_time = datetime.now().strftime("%H:%M:%S")
     summary_message = (
         f"{start_time} -> {end_time} - Re-initialization done\n"
-        f"Binance: {len(prices['binance'])} Fetched\n"
-        f"Bybit: {len(prices['bybit'])} Fetched"
+        f"Binance: {len(prices['binance'])} Fetched (+{reinit_changes['binance'][0]} / -{reinit_changes['binance'][1]})\n"
+        f"Bybit: {len(prices['bybit'])} Fetched (+{reinit_changes['bybit'][0]} / -{reinit_changes['bybit'][1]})"
+        f"{degraded_exchanges_summary()}"
+    )
+    print(summary_message)
+    await debug_bot.send_message(chat_id=DEBUG_CHAT_ID, text=summary_message)
+
+
+# Прогрев истории при старте: последние BACKFILL_MINUTES минутных свечей и история OI для всех отслеживаемых пар.
+# История OI у бирж есть только с шагом 5 минут, поэтому до накопления живых точек OI-сигналы
+# срабатывают для периодов, попадающих на эти точки.
+# Второй уровень прогревается 5-минутными свечами за BACKFILL_LONG_MINUTES и той же историей OI
+# (последние BACKFILL_OI_LIMIT точек: у Bybit это меньше суток)
+def history_covers(store, pair, minutes, step_ms):
+    latest = store.lag(pair, 0)
+    return latest is not None and store.at_or_before(pair, latest[0] - minutes * 60000 + step_ms) is not None
+
+
+def downsample(points, step_ms):
+    buckets = {}
+    for timestamp, value in sorted(points):
+        buckets[timestamp // step_ms] = (timestamp, value)
+    return list(buckets.values())
+
+
+async def backfill_history():
+    if BACKFILL_MINUTES <= 0:
+        return
+    start_time = datetime.now().strftime("%H:%M:%S")
+    await debug_bot.send_message(chat_id=DEBUG_CHAT_ID, text=f"{start_time} - History backfill started ({BACKFILL_MINUTES} min)")
+    results = {}  # {exchange: строка итога}
+    
+    # Прогрев одной биржи (Binance и Bybit обрабатываются параллельно)
+    async def backfill_exchange(exchange, ex_obj):
+        started = time.monotonic()
+        # Пары, у которых история уже покрывает глубину прогрева (например, из снимка), пропускаем
+        coarse = prices[exchange].coarse
+        need_long = set()
+        if BACKFILL_LONG_MINUTES > 0 and coarse is not None:
+            need_long = {pair for pair in prices[exchange].keys() if not history_covers(coarse, pair, BACKFILL_LONG_MINUTES, COARSE_STEP_MS)}
+        pairs = [pair for pair in prices[exchange].keys()
+                 if pair in need_long or prices[exchange].value_minutes_ago(pair, BACKFILL_MINUTES) is None]
+        semaphore = asyncio.Semaphore(BACKFILL_MAX_CONCURRENCY[exchange])
+        budget = backfill_budgets[exchange]
+        now_ms = int(time.time() * 1000)
+        since = now_ms - (BACKFILL_MINUTES + 1) * 60000
+        long_since = now_ms - BACKFILL_LONG_MINUTES * 60000 - COARSE_STEP_MS
+        price_points = {}  # {pair: [(timestamp, close)]}
+        oi_points = {}  # {pair: [(timestamp, oi)]}
+        long_price_points = {}  # {pair: [(timestamp, close)]} для второго уровня
+        long_oi_points = {}  # {pair: [(timestamp, oi)]} для второго уровня
+        errors = []
+        progress = {'done': 0, 'reported': 0}
+        
+        async def fetch_one(pair):
+            long = pair in need_long
+            async with semaphore:
+                await budget.acquire(4 if long else 2)
+                try:
+                    candles = await ex_obj.fetch_ohlcv(pair, '1m', since=since, limit=BACKFILL_MINUTES + 1)
+                    # Цена на момент закрытия свечи; незакрытую текущую свечу пропускаем
+                    price_points[pair] = [(c[0] + 60000, c[4]) for c in candles if c[0] + 60000 <= now_ms and c[4] is not None]
+                    if long:
+                        candles = await ex_obj.fetch_ohlcv(pair, '5m', since=long_since, limit=BACKFILL_LONG_MINUTES // COARSE_STEP_MINUTES + 1)
+                        long_price_points[pair] = [(c[0] + COARSE_STEP_MS, c[4]) for c in candles
+                                                   if c[0] + COARSE_STEP_MS <= now_ms and c[4] is not None]
+                except Exception as e:
+                    errors.append(f"{pair} OHLCV: {e.__class__.__name__}")
+                try:
+                    # Без since биржи отдают последние точки; с since Bybit отдал бы самые старые 200
+                    if long:
+                        history = await ex_obj.fetch_open_interest_history(pair, BACKFILL_OI_TIMEFRAME, limit=BACKFILL_OI_LIMIT)
+                    else:
+                        history = await ex_obj.fetch_open_interest_history(pair, BACKFILL_OI_TIMEFRAME, since=since)
+                    points = [(h['timestamp'], extract_open_interest(h)) for h in history
+                              if h.get('timestamp') and extract_open_interest(h) is not None]
+                    oi_points[pair] = [point for point in points if point[0] >= since]
+                    if long:
+                        long_oi_points[pair] = [point for point in points if point[0] >= long_since]
+                except Exception as e:
+                    errors.append(f"{pair} OI history: {e.__class__.__name__}")
+            
+            progress['done'] += 1
+            step = progress['done'] * BACKFILL_PROGRESS_STEPS // len(pairs)
+            if step > progress['reported'] and progress['done'] < len(pairs):
+                progress['reported'] = step
+                try:
+                    await debug_bot.send_message(
+                        chat_id=DEBUG_CHAT_ID,
+                        text=f"{exchange.capitalize()} backfill: {progress['done']}/{len(pairs)} pairs ({time.monotonic() - started:.0f}s)"
+                    )
+                except Exception as e:
+                    logger.error(f"Failed to send backfill progress: {e}")
+        
+        tasks = [asyncio.create_task(fetch_one(pair)) for pair in pairs]
+        if tasks:
+            try:
+                await asyncio.wait(tasks, timeout=BACKFILL_DEADLINE)
+            finally:
+                pending = [task for task in tasks if not task.done()]
+                for task in pending:
+                    task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            if pending:
+                logger.warning(f"{exchange}: backfill deadline {BACKFILL_DEADLINE}s exceeded, {len(pending)} pairs left without history")
+        if errors:
+            logger.warning(f"{exchange}: backfill errors for {len(errors)} requests (first 5: {errors[:5]})")
+        
+        # Пары, удаленные за время прогрева, не восстанавливаем: merge работает только с существующими строками
+        async with prices_lock:
+            for pair, points in price_points.items():
+                prices[exchange].merge(pair, points)
+            for pair, points in oi_points.items():
+                open_interest[exchange].merge(pair, points)
+            for stores, long_points in ((prices, long_price_points), (open_interest, long_oi_points)):
+                if stores[exchange].coarse is not None:
+                    for pair, points in long_points.items():
+                        stores[exchange].coarse.merge(pair, downsample(points, COARSE_STEP_MS))
+        
+        results[exchange] = (
+            f"{exchange.capitalize()}: prices {len(price_points)}/{len(pairs)}, "
+            f"OI {len(oi_points)}/{len(pairs)}, 5m {len(long_price_points)}/{len(need_long)}, {time.monotonic() - started:.1f}s"
+        )
+    
+    exchanges = [('binance', binance_exchange), ('bybit', bybit_exchange)]
+    outcomes = await asyncio.gather(*(backfill_exchange(exchange, ex_obj) for exchange, ex_obj in exchanges), return_exceptions=True)
+    for (exchange, _), outcome in zip(exchanges, outcomes):
+        if isinstance(outcome, Exception):
+            logger.error(f"{exchange}: backfill failed: {outcome.__class__.__name__}: {outcome}")
+    
+    end_time = datetime.now().strftime("%H:%M:%S")
+    summary_message = (
+        f"{start_time} -> {end_time} - History backfill done\n"
+        + "\n".join(results.get(exchange, f"{exchange.capitalize()}: failed") for exchange in ('binance', 'bybit'))
     )
     print(summary_message)
     await debug_bot.send_message(chat_id=DEBUG_CHAT_ID, text=summary_message)
@@ -411,33 +1772,76 @@ async def reinitialize_pairs():
 
 # Проверка статуса пользователя
 def is_user_whitelisted_and_active(chat_id):
-    db = sqlite3.connect(WHITELIST_DB_PATH)
-    cursor = db.cursor()
-    cursor.execute('SELECT Binance, Bybit, Blocked FROM whitelist WHERE TelegramID = ? AND Active = 1', (chat_id,))
-    result = cursor.fetchone()
-    db.close()
-    return result if result else (0, 0, 1)  # По умолчанию отключено и заблокировано, если нет записи
+    return entitlements.get(chat_id, (0, 0, 1))  # По умолчанию отключено и заблокировано, если нет записи
+
+
+# Оплаченный доступ: отдельного признака в базе нет, оплата продлевает EndDate дальше пробного периода
+def is_paid_period(start_date, end_date):
+    try:
+        start = datetime.strptime(start_date, '%Y-%m-%d %H:%M:%S')
+        end = datetime.strptime(end_date, '%Y-%m-%d %H:%M:%S')
+    except (TypeError, ValueError):
+        return False
+    return end - start > timedelta(days=TRIAL_DAYS, hours=1)
+
+
+# Класс приоритета сигнала: оплатившие раньше пробных, Pump/Dump раньше OI
+def alert_priority(chat_id, is_oi):
+    if chat_id in paid_users:
+        return PRIORITY_PAID_OI if is_oi else PRIORITY_PAID_PRICE
+    return PRIORITY_TRIAL_OI if is_oi else PRIORITY_TRIAL_PRICE
+
+
+# Перечитывание кэша доступа одним запросом, если базу изменили (бот или сайт оплаты) с прошлой загрузки
+def refresh_entitlements():
+    global entitlements, paid_users, entitlements_db, entitlements_version
+    try:
+        stat = os.stat(WHITELIST_DB_PATH)
+        # Базу заменили новым файлом - старое соединение смотрит на прежний
+        if entitlements_db is not None and entitlements_version and entitlements_version[2] != stat.st_ino:
+            entitlements_db.close()
+            entitlements_db = None
+        if entitlements_db is None:
+            entitlements_db = sqlite3.connect(WHITELIST_DB_PATH)
+        data_version = entitlements_db.execute('PRAGMA data_version').fetchone()[0]
+        version = (data_version, stat.st_mtime_ns, stat.st_ino)
+        if version == entitlements_version:
+            return
+        rows = entitlements_db.execute('SELECT TelegramID, Binance, Bybit, Blocked, StartDate, EndDate FROM whitelist WHERE Active = 1').fetchall()
+        entitlements = {int(row[0]): tuple(row[1:4]) for row in rows}
+        paid_users = {int(row[0]) for row in rows if is_paid_period(row[4], row[5])}
+        entitlements_version = version
+        logger.info(f"Entitlements reloaded: {len(entitlements)} active users")
+    except (sqlite3.Error, OSError, ValueError) as e:
+        # Оставляем прежний кэш и переподключаемся при следующей проверке
+        logger.error(f"Failed to refresh entitlements: {e}")
+        if entitlements_db is not None:
+            entitlements_db.close()
+        entitlements_db = None
+        entitlements_version = None
 
 
 # Отправка уведомления
 @global_timeout_retry(retries=3, delay=5)
-async def price_send_alert(exchange, pair, change_percent, old_value, new_value, value_list, condition_type, settings, chat_id, is_oi=False):
-    global message_queue, total_messages_queued, notification_counters
+async def price_send_alert(exchange, pair, change_percent, old_value, new_value, store, condition_type, settings, chat_id, is_oi=False):
+    global total_messages_queued
     exchange_emojis = {'binance': '💎', 'bybit': '🌙'}
     emoji = exchange_emojis[exchange]
     
     if is_oi:
         signal_name = 'OI Change'
-        period = f"{settings['oi_period']} min"
+        period = format_period(settings.oi_period)
         value_type = 'OI'
     else:
         value_type = 'Price'
         if condition_type == 'Short':
             signal_name = 'Pump Signal'
-            period = f"{settings['pump_index']} min"
+            period = format_period(settings.pump_index)
         elif condition_type == 'Dump':
             signal_name = 'Dump Signal'
-            period = f"{settings['dump_index']} min"
+            period = format_period(settings.dump_index)
+        if settings.detection_mode == 'max':
+            signal_name += ' (max move)'
     
     raw_symbol = pair.replace(':USDT', '').replace('/', '')
     url_symbol = raw_symbol
@@ -447,7 +1851,7 @@ async def price_send_alert(exchange, pair, change_percent, old_value, new_value,
     
     formatted_old_value = f"{old_value:.8f}".rstrip('0').rstrip('.')
     formatted_new_value = f"{new_value:.8f}".rstrip('0').rstrip('.')
-    alert_number = notification_counters[chat_id][pair] + 1
+    alert_number = notification_counters.get(chat_id, pair) + 1
     
     message = (
         f"{emoji} <b>{hyperlink}</b> | {value_type} {signal_name}\n"
@@ -456,108 +1860,256 @@ async def price_send_alert(exchange, pair, change_percent, old_value, new_value,
         f"{formatted_old_value} -> <b>{formatted_new_value}</b>\n"
         f"🔇 Alert Number: <b>{alert_number}</b>"
     )
-    message_queue.append((chat_id, message))
+    outbound_queue.push(chat_id, message, alert_priority(chat_id, is_oi), digest=bool(settings.digest))
     total_messages_queued += 1
 
 
-# Проверка изменений и отправка уведомлений
+# Допустимый период сигнала: 1-30 минут с шагом 1 или до суток с шагом второго уровня истории
+def is_valid_period(period):
+    if not isinstance(period, int) or period < 1:
+        return False
+    return period <= HISTORY_WINDOW_MINUTES or (period <= LONG_HISTORY_MAX_MINUTES and period % COARSE_STEP_MINUTES == 0)
+
+
+# Колонка матрицы изменений для периода настроек пользователя (None, если период вне истории)
+def lag_column(period):
+    if isinstance(period, int) and 1 <= period <= HISTORY_WINDOW_MINUTES:
+        return period - 1
+    return long_periods.get(period)
+
+
+# Режим из ответа пользователя (надпись кнопки или значение) и обратно - надпись для сообщений
+def parse_detection_mode(text):
+    for label, mode in DETECTION_MODES.items():
+        if text.strip().lower() in (label.lower(), mode):
+            return mode
+    raise ValueError("Unknown detection mode")
+
+
+def detection_mode_label(mode):
+    for label, value in DETECTION_MODES.items():
+        if value == mode:
+            return label
+    return mode
+
+
+def parse_digest_mode(text):
+    for label, mode in DIGEST_MODES.items():
+        if text.strip().lower() in (label.lower(), str(mode)):
+            return mode
+    raise ValueError("Unknown digest mode")
+
+
+def digest_mode_label(mode):
+    for label, value in DIGEST_MODES.items():
+        if value == mode:
+            return label
+    return str(mode)
+
+
+# Подпись периода в сигналах: до 30 минут - минуты, кратные часу - часы
+def format_period(period):
+    if isinstance(period, int) and period > HISTORY_WINDOW_MINUTES and period % 60 == 0:
+        return f"{period // 60} h"
+    return f"{period} min"
+
+
+# Проверка cooldown: истекшая запись удаляется при первой же проверке
+def cooldown_active(cooldowns, key, now):
+    until = cooldowns.get(key)
+    if until is None:
+        return False
+    if until <= now:
+        del cooldowns[key]
+        return False
+    return True
+
+
+# Подавление повторных сигналов на minutes минут (cooldown равен периоду сигнала)
+def start_cooldown(cooldowns, key, now, minutes):
+    cooldowns[key] = now + minutes * 60
+
+
+# Перестановка строк массивов (по парам source_pairs) в порядок pairs; у отсутствующих пар - NaN
+def align_rows(source_pairs, pairs, arrays):
+    if source_pairs == pairs:
+        return list(arrays)
+    position = {pair: i for i, pair in enumerate(source_pairs)}
+    rows = np.array([position.get(pair, -1) for pair in pairs], dtype=np.int64)
+    missing = rows < 0
+    aligned = []
+    for array in arrays:
+        if len(source_pairs):
+            mask = missing.reshape((-1,) + (1,) * (array.ndim - 1))
+            aligned.append(np.where(mask, np.nan, array[rows]))
+        else:
+            aligned.append(np.full((len(pairs),) + array.shape[1:], np.nan))
+    return aligned
+
+
+# Выравнивание матрицы OI по строкам матрицы цен (у пары может не быть истории OI - тогда NaN)
+def align_matrix(matrix, pairs):
+    matrix_pairs, *arrays = matrix
+    return tuple(align_rows(matrix_pairs, pairs, arrays))
+
+
+# Индекс порогов: для каждого периода группы отсортированы по порогу Pump, Dump и OI.
+# Заодно назначает колонки длинным периодам: второй уровень считается только для периодов из настроек
+def build_threshold_index():
+    global long_periods
+    periods = {period for key in settings_groups for period in (key[0], key[2], key[4])}
+    long_periods = {
+        period: HISTORY_WINDOW_MINUTES + i
+        for i, period in enumerate(sorted(period for period in periods if is_valid_period(period) and period > HISTORY_WINDOW_MINUTES))
+    }
+    index = {'pump': {}, 'dump': {}, 'pump_max': {}, 'dump_max': {}, 'oi': {}}
+    for key in settings_groups:
+        pump_index, pump_threshold, dump_index, dump_threshold, oi_period, oi_threshold, detection_mode = key
+        suffix = '_max' if detection_mode == 'max' else ''
+        for kind, period, threshold in (('pump' + suffix, pump_index, pump_threshold), ('dump' + suffix, dump_index, dump_threshold), ('oi', oi_period, oi_threshold)):
+            column = lag_column(period)
+            if column is not None and threshold is not None:
+                index[kind].setdefault(column, []).append((threshold, key))
+    for kind in index:
+        for column, entries in index[kind].items():
+            entries.sort(key=lambda entry: entry[0])
+            index[kind][column] = (np.array([threshold for threshold, _ in entries], dtype=np.float64), [key for _, key in entries])
+    return index
+
+
+# Кандидаты для всех групп сразу: {ключ группы: индексы пар, где выполнено хотя бы одно условие группы}.
+# Для пары и периода подходящие группы - префикс отсортированных порогов до searchsorted(изменение);
+# пары, которые почти не двигались, не доходят ни до одной группы
+# excursion - движения внутри окна (excursion_matrix без pairs) для групп в режиме max
+def match_groups(price_matrix, oi_matrix, excursion=None):
+    pairs, latest, old, change = price_matrix
+    oi_latest, oi_old, oi_change = oi_matrix
+    with np.errstate(invalid='ignore'):
+        # Pump: change >= порог; Dump: -change >= порог; OI: |change| >= порог (при нулевом старом OI изменение 0)
+        measures = {
+            'pump': np.where(old != 0, change, np.nan),
+            'dump': np.where(old != 0, -change, np.nan),
+            'oi': np.where(np.isnan(oi_old), np.nan, np.abs(np.where(oi_old != 0, oi_change, 0)))
+        }
+        if excursion is not None:
+            rise_from, rise_to, rise, fall_from, fall_to, fall = excursion
+            measures['pump_max'] = np.where(rise_from != 0, rise, np.nan)
+            measures['dump_max'] = np.where(fall_from != 0, -fall, np.nan)
+    matches = {}
+    for kind, measure in measures.items():
+        for column, (thresholds, keys) in threshold_index[kind].items():
+            values = np.nan_to_num(measure[:, column], nan=-np.inf)
+            counts = np.searchsorted(thresholds, values, side='right')
+            for i in np.flatnonzero(counts):
+                for key in keys[:counts[i]]:
+                    matches.setdefault(key, set()).add(i)
+    return {key: sorted(candidates) for key, candidates in matches.items()}
+
+
+# Проверка кандидатов группы для одного подписчика: приоритет Pump -> Dump -> OI,
+# cooldown и лимит уведомлений пользователя
+async def resolve_user_alerts(exchange, chat_id, settings, candidates, price_matrix, oi_matrix, now, excursion=None):
+    pairs, latest, old, change = price_matrix
+    oi_latest, oi_old, oi_change = oi_matrix
+    max_mode = settings.detection_mode == 'max' and excursion is not None
+    if max_mode:
+        rise_from, rise_to, rise, fall_from, fall_to, fall = excursion
+    pump_column = lag_column(settings.pump_index)
+    dump_column = lag_column(settings.dump_index)
+    oi_column = lag_column(settings.oi_period)
+    
+    alert_limit = settings.alert_limit
+    for i in candidates:
+        pair = pairs[i]
+        if alert_limit is not None and notification_counters.get(chat_id, pair) >= alert_limit:
+            continue
+        new_price = float(latest[i])
+        
+        # Проверка цен (приоритет)
+        # В режиме max сравниваются начало и конец наибольшего движения внутри периода
+        if pump_column is not None and not cooldown_active(prices_cooldown[exchange], (pair, chat_id, 'Short'), now):
+            if max_mode:
+                old_price, move_price, change_percent = float(rise_from[i, pump_column]), float(rise_to[i, pump_column]), float(rise[i, pump_column])
+            else:
+                old_price, move_price, change_percent = float(old[i, pump_column]), new_price, float(change[i, pump_column])
+            if old_price and change_percent >= settings.pump_threshold:
+                await price_send_alert(exchange, pair, change_percent, old_price, move_price, prices[exchange], 'Short', settings, chat_id)
+                start_cooldown(prices_cooldown[exchange], (pair, chat_id, 'Short'), now, settings.pump_index)
+                notification_counters.increment(chat_id, pair)
+                continue
+        
+        if dump_column is not None and not cooldown_active(prices_cooldown[exchange], (pair, chat_id, 'Dump'), now):
+            if max_mode:
+                old_price, move_price, change_percent = float(fall_from[i, dump_column]), float(fall_to[i, dump_column]), float(fall[i, dump_column])
+            else:
+                old_price, move_price, change_percent = float(old[i, dump_column]), new_price, float(change[i, dump_column])
+            if old_price and change_percent <= -settings.dump_threshold:
+                await price_send_alert(exchange, pair, change_percent, old_price, move_price, prices[exchange], 'Dump', settings, chat_id)
+                start_cooldown(prices_cooldown[exchange], (pair, chat_id, 'Dump'), now, settings.dump_index)
+                notification_counters.increment(chat_id, pair)
+                continue
+        
+        # Проверка OI (только если не сработало уведомление о цене)
+        if oi_column is not None and not np.isnan(oi_old[i, oi_column]) and not cooldown_active(oi_cooldown[exchange], (pair, chat_id), now):
+            old_oi = float(oi_old[i, oi_column])
+            new_oi = float(oi_latest[i])
+            oi_value_change = float(oi_change[i, oi_column]) if old_oi != 0 else 0
+            if abs(oi_value_change) >= settings.oi_threshold:
+                await price_send_alert(exchange, pair, oi_value_change, old_oi, new_oi, open_interest[exchange], 'Change', settings, chat_id, is_oi=True)
+                start_cooldown(oi_cooldown[exchange], (pair, chat_id), now, settings.oi_period)
+                notification_counters.increment(chat_id, pair)
+
+
+# Проверка изменений и отправка уведомлений.
+# Изменения цен и OI считаются матрицей пары x период (1-30 мин и длинные периоды из настроек) за один проход NumPy,
+# затем для каждого периода по отсортированным порогам находятся группы одинаковых настроек,
+# у которых выполнено условие.
+# Cooldown хранится как момент окончания, поэтому промежуточные проверки потокового режима его не сдвигают
 async def price_check_and_send_notifications():
     
-    global notification_counters, last_counter_reset_date
-    current_date = datetime.now().date()
-    if current_date != last_counter_reset_date:
-        notification_counters = defaultdict(lambda: defaultdict(int))
-        last_counter_reset_date = current_date
+    global threshold_index
+    notification_counters.rollover(datetime.now().date().isoformat())
+    refresh_entitlements()
+    # Cooldown отсчитывается от начала минуты цикла, а не от момента после опроса бирж: длительность
+    # опроса плавает, а cooldown на N минут должен истекать ровно к проверке через N циклов
+    now = time.time() // 60 * 60
     
     for exchange in ['binance', 'bybit']:
         async with prices_lock:
-            for pair, price_list in prices[exchange].items():
-                if pair not in prices_cooldown[exchange]:
-                    prices_cooldown[exchange][pair] = {}
-                    oi_cooldown[exchange][pair] = {}
-                
-                for chat_id, settings in bot_data.items():
+            if not len(prices[exchange]):
+                continue
+            # Индекс строится до матриц: он определяет, какие длинные периоды считать по второму уровню
+            if threshold_index is None:
+                threshold_index = build_threshold_index()
+            price_matrix = prices[exchange].tiered_change_matrix(list(long_periods))
+            oi_matrix = align_matrix(open_interest[exchange].tiered_change_matrix(list(long_periods)), price_matrix[0])
+            # Движения внутри окна нужны только если есть группы в режиме max
+            excursion = None
+            if threshold_index['pump_max'] or threshold_index['dump_max']:
+                excursion = align_matrix(prices[exchange].tiered_excursion_matrix(list(long_periods)), price_matrix[0])
+            
+            # Условия сверяются по отсортированным порогам групп, сигналы раздаются подписчикам групп
+            for key, candidates in match_groups(price_matrix, oi_matrix, excursion).items():
+                for chat_id in list(settings_groups.get(key, ())):
                     binance_enabled, bybit_enabled, blocked = is_user_whitelisted_and_active(chat_id)
                     if blocked or (exchange == 'binance' and not binance_enabled) or (exchange == 'bybit' and not bybit_enabled):
                         continue
-                    
-                    alert_limit = settings.get('alert_limit', 20)
-                    notifications_sent = notification_counters[chat_id][pair]
-                    if alert_limit is not None and notifications_sent >= alert_limit:
-                        continue
-                    
-                    # Инициализация cooldown для пользователя
-                    if chat_id not in prices_cooldown[exchange][pair]:
-                        prices_cooldown[exchange][pair][chat_id] = {'Short': 0, 'Dump': 0}
-                    if chat_id not in oi_cooldown[exchange][pair]:
-                        oi_cooldown[exchange][pair][chat_id] = {'OI': 0}
-                    
-                    # Уменьшение cooldown
-                    for condition in ['Short', 'Dump']:
-                        if prices_cooldown[exchange][pair][chat_id][condition] > 0:
-                            prices_cooldown[exchange][pair][chat_id][condition] -= 1
-                    if oi_cooldown[exchange][pair][chat_id]['OI'] > 0:
-                        oi_cooldown[exchange][pair][chat_id]['OI'] -= 1
-                    
-                    # Проверка цен (приоритет)
-                    price_triggered = False
-                    new_price = price_list[0]
-                    pump_index = settings['pump_index']
-                    pump_threshold = settings['pump_threshold']
-                    if len(price_list) > pump_index and prices_cooldown[exchange][pair][chat_id]['Short'] == 0:
-                        old_price = price_list[pump_index]
-                        change_percent = (new_price - old_price) / old_price * 100
-                        if change_percent >= pump_threshold:
-                            await price_send_alert(exchange, pair, change_percent, old_price, new_price, price_list, 'Short', settings, chat_id)
-                            prices_cooldown[exchange][pair][chat_id]['Short'] = pump_index
-                            notification_counters[chat_id][pair] += 1
-                            price_triggered = True
-                            continue
-                    
-                    d_index = settings['dump_index']
-                    d_threshold = settings['dump_threshold']
-                    if len(price_list) > d_index and prices_cooldown[exchange][pair][chat_id]['Dump'] == 0:
-                        old_price = price_list[d_index]
-                        change_percent = (new_price - old_price) / old_price * 100
-                        if change_percent <= -d_threshold:
-                            await price_send_alert(exchange, pair, change_percent, old_price, new_price, price_list, 'Dump', settings, chat_id)
-                            prices_cooldown[exchange][pair][chat_id]['Dump'] = d_index
-                            notification_counters[chat_id][pair] += 1
-                            price_triggered = True
-                            continue
-                    
-                    # Проверка OI (только если не сработало уведомление о цене)
-                    if not price_triggered:
-                        oi_list = open_interest[exchange].get(pair, [])
-                        oi_period = settings['oi_period']
-                        oi_threshold = settings['oi_threshold']
-                        if len(oi_list) > oi_period and oi_cooldown[exchange][pair][chat_id]['OI'] == 0:
-                            old_oi = oi_list[oi_period]
-                            new_oi = oi_list[0]
-                            oi_change = (new_oi - old_oi) / old_oi * 100 if old_oi != 0 else 0
-                            if abs(oi_change) >= oi_threshold:
-                                await price_send_alert(exchange, pair, oi_change, old_oi, new_oi, oi_list, 'Change', settings, chat_id, is_oi=True)
-                                oi_cooldown[exchange][pair][chat_id]['OI'] = oi_period
-                                notification_counters[chat_id][pair] += 1
-
-
-# Отправка сообщения пользователю
-async def send_message(chat_id, message):
-    global total_messages_sent, last_message_time, user_flood_timeout, blocked_user_ids_forbidden
-    if chat_id in user_flood_timeout:
-        if time.time() < user_flood_timeout[chat_id]:
-            print(f"Skipping message to {chat_id} due to flood wait.")
-            return
-        else:
-            del user_flood_timeout[chat_id]
-    
-    current_time = time.time()
-    last_time = last_message_time.get(chat_id, 0)
-    time_since_last_message = current_time - last_time
-    if time_since_last_message < 1:
-        time_to_wait = 1 - time_since_last_message
-        await asyncio.sleep(time_to_wait)
+                    await resolve_user_alerts(exchange, chat_id, bot_data[chat_id], candidates, price_matrix, oi_matrix, now, excursion)
     
+    # Счетчики, увеличенные за проверку, сохраняем одной транзакцией
+    try:
+        notification_counters.checkpoint()
+    except sqlite3.Error as e:
+        logger.error(f"Failed to checkpoint alert counters: {e}")
+    # Сигналы попадают в журнал до начала рассылки
+    outbound_queue.checkpoint()
+
+
+# Отправка сообщения пользователю (интервал между сообщениями в чат выдерживает очередь).
+# Возвращает (результат, пауза): ('sent', None) - доставлено; ('failed', None) - повтор не поможет;
+# ('retry', сек) - flood control или временная ошибка (сеть, сервер Telegram), сообщение нужно повторить
+async def send_message(chat_id, message):
+    global total_messages_sent, last_message_time, blocked_user_ids_forbidden
     try:
         await price_bot.send_message(
             chat_id=chat_id,
@@ -565,39 +2117,83 @@ async def send_message(chat_id, message):
             parse_mode='HTML',
             disable_web_page_preview=True
         )
-        total_messages_sent += 1
-        last_message_time[chat_id] = time.time()
-    except Exception as e:
-        error_str = str(e)
-        if 'retry_after' in error_str.lower():
-            match = re.search(r'retry_after=(\d+)', error_str)
-            retry_after = int(match.group(1)) if match else 30
-            print(f"Flood control exceeded for chat_id {chat_id}. Retry in {retry_after} seconds.")
-            user_flood_timeout[chat_id] = time.time() + retry_after
-            message_queue.append((chat_id, message))
-        elif "bot was blocked by the user" in error_str.lower():
-            blocked_user_ids_forbidden.add(chat_id)
-        else:
-            error_message = f"Error.Concurrent sending to {chat_id}: {error_str}"
-            print(error_message)
+    except TelegramRetryAfter as e:
+        print(f"Flood control exceeded for chat_id {chat_id}. Retry in {e.retry_after} seconds.")
+        return 'retry', e.retry_after
+    except TelegramForbiddenError:
+        # Бот заблокирован пользователем или аккаунт удален: повтор не поможет
+        blocked_user_ids_forbidden.add(chat_id)
+        return 'failed', None
+    except TelegramBadRequest as e:
+        # Чат не найден или сообщение не принято: повтор не поможет
+        error_message = f"Error.Concurrent sending to {chat_id}: {e}"
+        print(error_message)
+        try:
             await debug_bot.send_message(chat_id=DEBUG_CHAT_ID, text=error_message)
-
-
-# Обработка очереди сообщений
-async def process_message_queue():
-    global message_queue, user_message_counts, blocked_users, user_flood_timeout, blocked_user_ids_forbidden
-    while message_queue:
-        chat_id, message = message_queue.pop(0)
-        if chat_id in user_flood_timeout:
-            if time.time() < user_flood_timeout[chat_id]:
+        except Exception as debug_error:
+            logger.error(f"Failed to report send error to the debug chat: {debug_error}")
+        return 'failed', None
+    except Exception as e:
+        # Сеть, ошибки сервера Telegram, таймауты: сообщение остается в очереди
+        failures = send_failures.get(chat_id, 0) + 1
+        send_failures[chat_id] = failures
+        delay = min(SEND_RETRY_DELAY * 2 ** (failures - 1), SEND_RETRY_MAX)
+        logger.warning(f"Temporary error sending to {chat_id}: {e.__class__.__name__}: {e}. Retry in {delay} seconds")
+        return 'retry', delay
+    total_messages_sent += 1
+    last_message_time[chat_id] = time.time()
+    send_failures.pop(chat_id, None)
+    return 'sent', None
+
+
+# Рассылка outbound_queue пулом из SENDER_WORKERS отправителей. Очередь отдает сообщения по классу
+# приоритета, выдерживая интервал чата, поэтому ожидание одного чата не задерживает остальные.
+# Общий темп ограничивает send_budget (GLOBAL_MESSAGES_PER_SECOND). Сообщения под retry_after ждут
+# в очереди своего времени; чего не успели до дедлайна, остается в очереди до следующего вызова
+async def process_message_queue(deadline=DELIVERY_DEADLINE):
+    global user_message_counts, blocked_users, blocked_user_ids_forbidden
+    stop_at = time.time() + deadline
+    
+    async def sender():
+        while True:
+            now = time.time()
+            item = outbound_queue.pop(now)
+            if item is None:
+                # Нечего отправлять сейчас: ждем ближайший чат, если он освободится до дедлайна
+                # (чаты, которые сейчас отправляются, дальше ведут их отправители)
+                wake_at = outbound_queue.next_release()
+                if wake_at is None or wake_at > stop_at:
+                    return
+                await asyncio.sleep(wake_at - now)
+                continue
+            chat_id, entry = item
+            if user_message_counts.get(chat_id, 0) >= USER_MESSAGES_PER_MINUTE:
+                # Лимит чата на эту минуту исчерпан: сообщение ждет следующей минуты (или истечения TTL)
+                blocked_users.add(chat_id)
+                outbound_queue.defer(chat_id, entry, 60 - now % 60)
                 continue
+            await send_budget.acquire()
+            try:
+                status, delay = await send_message(chat_id, entry[1])
+            except Exception as e:
+                # Непредвиденная ошибка: доставлено ли сообщение, неизвестно, повторяем
+                logger.error(f"Failed to deliver message to {chat_id}: {e}")
+                status, delay = 'retry', SEND_RETRY_DELAY
+            if status == 'retry':
+                # В журнале сообщение остается, в лимит чата не засчитывается
+                outbound_queue.defer(chat_id, entry, delay)
             else:
-                del user_flood_timeout[chat_id]
-        if user_message_counts.get(chat_id, 0) < USER_MESSAGES_PER_MINUTE:
-            user_message_counts[chat_id] = user_message_counts.get(chat_id, 0) + 1
-            await send_message(chat_id, message)
-        else:
-            blocked_users.add(chat_id)
+                if status == 'sent':
+                    user_message_counts[chat_id] = user_message_counts.get(chat_id, 0) + 1
+                outbound_queue.ack(entry)
+                outbound_queue.release(chat_id, time.time())
+            if time.time() > stop_at:
+                return
+    
+    if outbound_queue and deadline > 0:
+        await asyncio.gather(*(sender() for _ in range(SENDER_WORKERS)))
+        outbound_queue.prune(time.time())
+        outbound_queue.checkpoint()
     
     if blocked_user_ids_forbidden:
         summary_message = (
@@ -608,37 +2204,107 @@ async def process_message_queue():
         blocked_user_ids_forbidden.clear()
 
 
+# Профиль пользователя: настройки сигналов и доступ к биржам.
+# __slots__ вместо словаря: на десятки тысяч пользователей нет отдельного dict у каждого,
+# а проверка условий читает атрибуты вместо поиска по строковым ключам
+class UserProfile:
+    __slots__ = tuple(USER_PROFILE_COLUMNS)
+    # Значения для нового пользователя и пустых полей базы
+    DEFAULTS = {
+        'pump_index': 3,
+        'pump_threshold': 5,
+        'dump_index': 2,
+        'dump_threshold': 8,
+        'alert_limit': 100,
+        'oi_period': 5,
+        'oi_threshold': 10,
+        'binance': 1,
+        'bybit': 1,
+        'blocked': 0,
+        'detection_mode': 'endpoint',
+        'digest': 0
+    }
+
+    def __init__(self, **values):
+        for field, default in self.DEFAULTS.items():
+            setattr(self, field, values.get(field, default))
+
+    # Строка whitelist с колонками USER_PROFILE_COLUMNS в том же порядке; NULL - значение по умолчанию
+    @classmethod
+    def from_row(cls, row):
+        return cls(**{field: value for field, value in zip(USER_PROFILE_COLUMNS, row) if value is not None})
+
+    def __repr__(self):
+        return f"UserProfile({', '.join(f'{field}={getattr(self, field)!r}' for field in self.__slots__)})"
+
+
+# Колонки профиля для SELECT из whitelist (недобавленные колонки заменяются на NULL)
+def profile_select_columns():
+    return ', '.join(f"NULL AS {column}" if column in whitelist_missing_columns else column for column in USER_PROFILE_COLUMNS.values())
+
+
+# Единый загрузчик профиля из базы для всех обработчиков (None, если пользователя нет в whitelist)
+def fetch_user_profile(cursor, chat_id):
+    cursor.execute(f"SELECT {profile_select_columns()} FROM whitelist WHERE TelegramID = ?", (chat_id,))
+    row = cursor.fetchone()
+    return UserProfile.from_row(row) if row else None
+
+
+# Обновление группы пользователя в settings_groups после изменения bot_data[chat_id]
+def index_user_settings(chat_id):
+    global threshold_index
+    old_key = user_settings_key.pop(chat_id, None)
+    if old_key is not None:
+        group = settings_groups[old_key]
+        group.discard(chat_id)
+        if not group:
+            del settings_groups[old_key]
+            threshold_index = None
+    settings = bot_data.get(chat_id)
+    if settings is not None:
+        key = tuple(getattr(settings, field) for field in SETTINGS_KEY_FIELDS)
+        if key not in settings_groups:
+            settings_groups[key] = set()
+            threshold_index = None
+        settings_groups[key].add(chat_id)
+        user_settings_key[chat_id] = key
+
+
+# Добавление в whitelist колонок из WHITELIST_EXTRA_COLUMNS, если база создана до их появления.
+# База общая с сервисом оплаты, поэтому ошибка миграции не останавливает бота: колонка попадает
+# в whitelist_missing_columns, и ее настройка работает со значением по умолчанию
+def ensure_whitelist_columns(db):
+    whitelist_missing_columns.clear()
+    try:
+        existing = {row[1] for row in db.execute('PRAGMA table_info(whitelist)')}
+    except sqlite3.Error as e:
+        logger.error(f"Failed to read whitelist columns, using defaults for {', '.join(WHITELIST_EXTRA_COLUMNS)}: {e}")
+        whitelist_missing_columns.update(WHITELIST_EXTRA_COLUMNS)
+        return whitelist_missing_columns
+    for column, definition in WHITELIST_EXTRA_COLUMNS.items():
+        if column in existing:
+            continue
+        try:
+            with db:
+                db.execute(f'ALTER TABLE whitelist ADD COLUMN {column} {definition}')
+            logger.info(f"Added column {column} to whitelist")
+        except sqlite3.Error as e:
+            logger.error(f"Failed to add column {column} to whitelist, using its default: {e}")
+            whitelist_missing_columns.add(column)
+    return whitelist_missing_columns
+
+
 # Загрузка данных пользователей из базы
 def load_user_data():
     try:
         db = sqlite3.connect(WHITELIST_DB_PATH)
         cursor = db.cursor()
-        cursor.execute("SELECT TelegramID, Pindex, Ppercent, Dindex, Dpercent, Filter, Binance, Bybit, Blocked, OIperiod, OIpercent FROM whitelist WHERE Active = 1")
+        cursor.execute(f"SELECT TelegramID, {profile_select_columns()} FROM whitelist WHERE Active = 1")
         rows = cursor.fetchall()
         for row in rows:
             telegram_id = int(row[0])
-            p_index = row[1]
-            p_percent = row[2]
-            d_index = row[3]
-            d_percent = row[4]
-            alert_limit = row[5] if row[5] is not None else 100
-            binance = row[6]
-            bybit = row[7]
-            blocked = row[8]
-            oi_period = row[9] if row[9] is not None else 5
-            oi_threshold = row[10] if row[10] is not None else 10.0
-            bot_data[telegram_id] = {
-                'pump_index': p_index,
-                'pump_threshold': p_percent,
-                'dump_index': d_index,
-                'dump_threshold': d_percent,
-                'alert_limit': alert_limit,
-                'binance': binance,
-                'bybit': bybit,
-                'blocked': blocked,
-                'oi_period': oi_period,
-                'oi_threshold': oi_threshold
-            }
+            bot_data[telegram_id] = UserProfile.from_row(row[1:])
+            index_user_settings(telegram_id)
         db.close()
         print(f"Loaded user data for {len(rows)} users.")
     except sqlite3.Error as e:
@@ -658,44 +2324,29 @@ async def price_start(message: Message):
         referral_code = args[0] if args else None
         db = sqlite3.connect(WHITELIST_DB_PATH)
         cursor = db.cursor()
-        cursor.execute('SELECT Active, StartDate, EndDate, Pindex, Ppercent, Dindex, Dpercent, Binance, Bybit, Blocked, OIperiod, OIpercent FROM whitelist WHERE TelegramID = ?', (chat_id,))
+        cursor.execute('SELECT Active, StartDate, EndDate FROM whitelist WHERE TelegramID = ?', (chat_id,))
         result = cursor.fetchone()
         
         if result:
-            active, start_date_db, end_date_db, p_index, p_percent, d_index, d_percent, binance, bybit, blocked, oi_period, oi_threshold = result
+            active, start_date, end_date = result
             is_new_user = False
-            start_date = start_date_db
-            end_date = end_date_db
         else:
-            trial_days = 30
+            trial_days = TRIAL_DAYS
             start_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             end_date = (datetime.now() + timedelta(days=trial_days)).strftime('%Y-%m-%d %H:%M:%S')
-            p_index, p_percent = 3, 5
-            d_index, d_percent = 2, 8
             active = 1
-            binance = 1
-            bybit = 1
-            blocked = 0
-            oi_period, oi_threshold = 5, 10
+            profile = UserProfile()
             cursor.execute('''
                 INSERT INTO whitelist (TelegramID, Username, Referral, Active, StartDate, EndDate, Pindex, Ppercent, Dindex, Dpercent, Binance, Bybit, Blocked, OIperiod, OIpercent)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (chat_id, username, referral_code, active, start_date, end_date, p_index, p_percent, d_index, d_percent, binance, bybit, blocked, oi_period, oi_threshold))
+            ''', (chat_id, username, referral_code, active, start_date, end_date, profile.pump_index, profile.pump_threshold,
+                  profile.dump_index, profile.dump_threshold, profile.binance, profile.bybit, profile.blocked,
+                  profile.oi_period, profile.oi_threshold))
             db.commit()
             is_new_user = True
         
-        bot_data[chat_id] = {
-            'pump_index': p_index,
-            'pump_threshold': p_percent,
-            'dump_index': d_index,
-            'dump_threshold': d_percent,
-            'alert_limit': 100,
-            'binance': binance,
-            'bybit': bybit,
-            'blocked': blocked,
-            'oi_period': oi_period,
-            'oi_threshold': oi_threshold
-        }
+        bot_data[chat_id] = fetch_user_profile(cursor, chat_id)
+        index_user_settings(chat_id)
         
         welcome_message = (
             "Welcome to the Pump Bot!\n\n"
@@ -758,34 +2409,19 @@ async def price_show_bot_settings(message: Message):
         cursor.execute('SELECT Active FROM whitelist WHERE TelegramID = ?', (chat_id,))
         status_check = cursor.fetchone()
         active = int(status_check[0]) if status_check else 0
-        cursor.execute('SELECT Pindex, Ppercent, Dindex, Dpercent, Filter, OIperiod, OIpercent FROM whitelist WHERE TelegramID = ?', (chat_id,))
-        user_settings = cursor.fetchone()
-        
-        if user_settings:
-            p_index, p_percent, d_index, d_percent, alert_limit, oi_period, oi_threshold = user_settings
-            alert_limit = alert_limit if alert_limit is not None else 100
-        else:
-            p_index, p_percent = 3, 5
-            d_index, d_percent = 2, 8
-            alert_limit = 100
-            oi_period, oi_threshold = 5, 10
-        
-        bot_data[chat_id] = {
-            'pump_index': p_index,
-            'pump_threshold': p_percent,
-            'dump_index': d_index,
-            'dump_threshold': d_percent,
-            'alert_limit': alert_limit,
-            'oi_period': oi_period,
-            'oi_threshold': oi_threshold
-        }
+        profile = fetch_user_profile(cursor, chat_id) or UserProfile()
+        bot_data[chat_id] = profile
+        index_user_settings(chat_id)
         
         first_message = (
             f"<b>How to change settings:</b>\n"
             f"Press the button for the setting you want to change, then send the desired amount.\n\n"
-            f"<i>Signal Periods</i>: 1 to 30 (minutes)\n"
+            f"<i>Signal Periods</i>: 1 to 30 (minutes), or up to 1440 (24 hours) in steps of 5\n"
             f"<i>Signal Percentages</i>: 1% to 100%\n"
-            f"<i>Alert Limit</i>: 1 to 20 or 'all' for unlimited alerts per pair per day.\n\n"
+            f"<i>Alert Limit</i>: 1 to 20 or 'all' for unlimited alerts per pair per day.\n"
+            f"<i>Detection Mode</i>: 'End points' compares the price at the start and the end of the period, "
+            f"'Max move' alerts on the largest Pump/Dump move within the period.\n"
+            f"<i>Digest Mode</i>: 'On' merges alerts that arrive together into one message.\n\n"
             f"Examples:\n\n"
             f"- Notify me if a coin's price increases by 10% in 2 minutes:\n"
             f"🟢 Pump Period: 2\n"
@@ -801,7 +2437,8 @@ async def price_show_bot_settings(message: Message):
                 [KeyboardButton(text="🟢 Pump Period"), KeyboardButton(text="➗ Pump Percentage")],
                 [KeyboardButton(text="🔴 Dump Period"), KeyboardButton(text="➗ Dump Percentage")],
                 [KeyboardButton(text="📈 OI Period"), KeyboardButton(text="➗ OI Percentage")],
-                [KeyboardButton(text="🔔 Alert Limit")],
+                [KeyboardButton(text="🔔 Alert Limit"), KeyboardButton(text="📐 Detection Mode")],
+                [KeyboardButton(text="📦 Digest Mode")],
                 [KeyboardButton(text="Back")]
             ],
             resize_keyboard=True,
@@ -809,13 +2446,15 @@ async def price_show_bot_settings(message: Message):
         )
         second_message = (
             f"<b>Your current notification settings are:</b>\n\n"
-            f"🟢 Pump Period: <b>{p_index}</b> min\n"
-            f"➗ Pump Percentage: <b>{p_percent}%</b>\n\n"
-            f"🔴 Dump Period: <b>{d_index}</b> min\n"
-            f"➗ Dump Percentage: <b>{d_percent}%</b>\n\n"
-            f"📈 OI Period: <b>{oi_period}</b> min\n"
-            f"➗ OI Percentage: <b>{oi_threshold}%</b>\n\n"
-            f"🔔 Alert Limit: <b>{'Not set' if alert_limit == 100 else ('Unlimited' if alert_limit is None else f'{alert_limit} per day')}</b>"
+            f"🟢 Pump Period: <b>{format_period(profile.pump_index)}</b>\n"
+            f"➗ Pump Percentage: <b>{profile.pump_threshold}%</b>\n\n"
+            f"🔴 Dump Period: <b>{format_period(profile.dump_index)}</b>\n"
+            f"➗ Dump Percentage: <b>{profile.dump_threshold}%</b>\n\n"
+            f"📈 OI Period: <b>{format_period(profile.oi_period)}</b>\n"
+            f"➗ OI Percentage: <b>{profile.oi_threshold}%</b>\n\n"
+            f"🔔 Alert Limit: <b>{'Not set' if profile.alert_limit == 100 else ('Unlimited' if profile.alert_limit is None else f'{profile.alert_limit} per day')}</b>\n\n"
+            f"📐 Detection Mode: <b>{detection_mode_label(profile.detection_mode)}</b>\n\n"
+            f"📦 Digest Mode: <b>{digest_mode_label(profile.digest)}</b>"
         )
         await message.reply(second_message, reply_markup=keyboard, parse_mode='HTML')
         
@@ -953,7 +2592,8 @@ async def price_handle_cancel(message: Message):
         keyboard=[
             [KeyboardButton(text="🟢 Pump Period"), KeyboardButton(text="➗ Pump Percentage")],
             [KeyboardButton(text="🔴 Dump Period"), KeyboardButton(text="➗ Dump Percentage")],
-            [KeyboardButton(text="🔔 Alert Limit")],
+            [KeyboardButton(text="🔔 Alert Limit"), KeyboardButton(text="📐 Detection Mode")],
+            [KeyboardButton(text="📦 Digest Mode")],
             [KeyboardButton(text="Back")]
         ],
         resize_keyboard=True,
@@ -984,14 +2624,11 @@ async def price_handle_send_message(message: Message):
     if not message_to_send:
         await message.reply("Don't forget a text. Format: /send_message *text*")
         return
+    # Рассылка идет через общую очередь последним классом: не отнимает лимит Telegram у сигналов.
+    # Очередь отправляет с parse_mode HTML, а текст рассылки - простой
     for user_chat_id in bot_data.keys():
-        try:
-            await price_bot.send_message(chat_id=user_chat_id, text=message_to_send)
-        except Exception as e:
-            error_message = f"⚠️ Failed to send message to {user_chat_id}: {e} ⚠️"
-            print(error_message)
-            await debug_bot.send_message(chat_id=DEBUG_CHAT_ID, text=error_message)
-    await message.reply("Message sent.")
+        outbound_queue.push(user_chat_id, html.escape(message_to_send), PRIORITY_BROADCAST, ttl=BROADCAST_TTL)
+    await message.reply(f"Message queued for {len(bot_data)} users.")
 
 
 # Ожидание ввода Pump Period
@@ -1005,10 +2642,10 @@ async def awaiting_pump_index(message: Message):
         resize_keyboard=True,
         one_time_keyboard=True
     )
-    current_value = bot_data.get(chat_id, {}).get('pump_index', 'Not set')
+    current_value = getattr(bot_data.get(chat_id), 'pump_index', 'Not set')
     await message.reply(
         f"Your current 🟢 <b>Pump Period</b> is <b>{current_value}</b>\n"
-        "Please, set your new 🟢 <b>Pump Period</b> (1-30 minutes):",
+        "Please, set your new 🟢 <b>Pump Period</b> (1-30 minutes, or 35-1440 in steps of 5):",
         parse_mode='HTML',
         reply_markup=keyboard
     )
@@ -1025,7 +2662,7 @@ async def awaiting_pump_threshold(message: Message):
         resize_keyboard=True,
         one_time_keyboard=True
     )
-    current_value = bot_data.get(chat_id, {}).get('pump_threshold', 'Not set')
+    current_value = getattr(bot_data.get(chat_id), 'pump_threshold', 'Not set')
     await message.reply(
         f"Your current ➗ <b>Pump Percentage</b> is <b>{current_value}%</b>\n"
         "Please, set your new ➗ <b>Pump Percentage</b> (1-100%):",
@@ -1045,10 +2682,10 @@ async def awaiting_dump_index(message: Message):
         resize_keyboard=True,
         one_time_keyboard=True
     )
-    current_value = bot_data.get(chat_id, {}).get('dump_index', 'Not set')
+    current_value = getattr(bot_data.get(chat_id), 'dump_index', 'Not set')
     await message.reply(
         f"Your current 🔴 <b>Dump Period</b> is <b>{current_value}</b>\n"
-        "Please, set your new 🔴 <b>Dump Period</b> (1-30 minutes):",
+        "Please, set your new 🔴 <b>Dump Period</b> (1-30 minutes, or 35-1440 in steps of 5):",
         parse_mode='HTML',
         reply_markup=keyboard
     )
@@ -1065,7 +2702,7 @@ async def awaiting_dump_threshold(message: Message):
         resize_keyboard=True,
         one_time_keyboard=True
     )
-    current_value = bot_data.get(chat_id, {}).get('dump_threshold', 'Not set')
+    current_value = getattr(bot_data.get(chat_id), 'dump_threshold', 'Not set')
     await message.reply(
         f"Your current ➗ <b>Dump Percentage</b> is <b>{current_value}%</b>\n"
         "Please, set your new ➗ <b>Dump Percentage</b> (1-100%):",
@@ -1085,7 +2722,7 @@ async def awaiting_alert_limit(message: Message):
         resize_keyboard=True,
         one_time_keyboard=True
     )
-    current_value = bot_data.get(chat_id, {}).get('alert_limit', 100)
+    current_value = getattr(bot_data.get(chat_id), 'alert_limit', 100)
     display_value = 'Not set' if current_value == 100 else current_value
     await message.reply(
         f"Your current 🔔 is {display_value}\n"
@@ -1096,6 +2733,48 @@ async def awaiting_alert_limit(message: Message):
     )
 
 
+# Выбор режима Pump/Dump сигналов
+@price_router.message(F.text == "📐 Detection Mode")
+@telegram_error_handler
+async def awaiting_detection_mode(message: Message):
+    chat_id = message.chat.id
+    user_data[chat_id] = {'awaiting': 'detection_mode'}
+    keyboard = ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text=label) for label in DETECTION_MODES], [KeyboardButton(text="Cancel")]],
+        resize_keyboard=True,
+        one_time_keyboard=True
+    )
+    current_value = detection_mode_label(getattr(bot_data.get(chat_id), 'detection_mode', 'endpoint'))
+    await message.reply(
+        f"Your current 📐 <b>Detection Mode</b> is <b>{current_value}</b>\n"
+        "<b>End points</b>: price at the start of the period -> price now.\n"
+        "<b>Max move</b>: the largest move within the period, even if the price has already retraced.",
+        parse_mode='HTML',
+        reply_markup=keyboard
+    )
+
+
+# Включение сводки сигналов
+@price_router.message(F.text == "📦 Digest Mode")
+@telegram_error_handler
+async def awaiting_digest_mode(message: Message):
+    chat_id = message.chat.id
+    user_data[chat_id] = {'awaiting': 'digest'}
+    keyboard = ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text=label) for label in DIGEST_MODES], [KeyboardButton(text="Cancel")]],
+        resize_keyboard=True,
+        one_time_keyboard=True
+    )
+    current_value = digest_mode_label(getattr(bot_data.get(chat_id), 'digest', 0))
+    await message.reply(
+        f"Your current 📦 <b>Digest Mode</b> is <b>{current_value}</b>\n"
+        "<b>On</b>: alerts that arrive together are merged into one message, so none are lost to the per-minute message limit.\n"
+        "<b>Off</b>: every alert is a separate message.",
+        parse_mode='HTML',
+        reply_markup=keyboard
+    )
+
+
 # Ожидание ввода OI Period
 @price_router.message(F.text == "📈 OI Period")
 @telegram_error_handler
@@ -1107,10 +2786,10 @@ async def awaiting_oi_period(message: Message):
         resize_keyboard=True,
         one_time_keyboard=True
     )
-    current_value = bot_data.get(chat_id, {}).get('oi_period', 'Not set')
+    current_value = getattr(bot_data.get(chat_id), 'oi_period', 'Not set')
     await message.reply(
         f"Your current 📈 <b>OI Period</b> is <b>{current_value}</b>\n"
-        "Please, set your new 📈 <b>OI Period</b> (1-30 minutes):",
+        "Please, set your new 📈 <b>OI Period</b> (1-30 minutes, or 35-1440 in steps of 5):",
         parse_mode='HTML',
         reply_markup=keyboard
     )
@@ -1127,7 +2806,7 @@ async def awaiting_oi_threshold(message: Message):
         resize_keyboard=True,
         one_time_keyboard=True
     )
-    current_value = bot_data.get(chat_id, {}).get('oi_threshold', 'Not set')
+    current_value = getattr(bot_data.get(chat_id), 'oi_threshold', 'Not set')
     await message.reply(
         f"Your current ➗ <b>OI Percentage</b> is <b>{current_value}%</b>\n"
         "Please, set your new ➗ <b>OI Percentage</b> (1-100%):",
@@ -1140,7 +2819,7 @@ async def awaiting_oi_threshold(message: Message):
 @price_router.message(lambda message: message.text and not message.text.startswith('/') and not message.text in [
     "Bot Settings", "Payment Settings", "Contact Support", "Make a payment", "Check profile", "Back", "Cancel",
     "🟢 Pump Period", "➗ Pump Percentage", "🔴 Dump Period", "➗ Dump Percentage", "🔔 Alert Limit",
-    "📈 OI Period", "➗ OI Percentage"
+    "📈 OI Period", "➗ OI Percentage", "📐 Detection Mode", "📦 Digest Mode"
 ])
 @telegram_error_handler
 async def price_set_pref(message: Message):
@@ -1156,13 +2835,15 @@ async def price_set_pref(message: Message):
     
     setting_type_key = user_data[chat_id].get('awaiting')
     setting_type_map = {
-        'pump_index': ('pump_index', int, 1, 30, "Please choose a number from 1 to 30"),
+        'pump_index': ('pump_index', int, 1, LONG_HISTORY_MAX_MINUTES, "Please choose a number from 1 to 30, or a multiple of 5 up to 1440"),
         'pump_threshold': ('pump_threshold', float, 1, 100, "Please choose a number from 1 to 100"),
-        'dump_index': ('dump_index', int, 1, 30, "Please choose a number from 1 to 30"),
+        'dump_index': ('dump_index', int, 1, LONG_HISTORY_MAX_MINUTES, "Please choose a number from 1 to 30, or a multiple of 5 up to 1440"),
         'dump_threshold': ('dump_threshold', float, 1, 100, "Please choose a number from 1 to 100"),
         'alert_limit': ('alert_limit', int, 1, 20, "Please choose a number from 1 to 20, or type 'all' to receive all notifications"),
-        'oi_period': ('oi_period', int, 1, 30, "Please choose a number from 1 to 30"),
-        'oi_threshold': ('oi_threshold', float, 1, 100, "Please choose a number from 1 to 100")
+        'oi_period': ('oi_period', int, 1, LONG_HISTORY_MAX_MINUTES, "Please choose a number from 1 to 30, or a multiple of 5 up to 1440"),
+        'oi_threshold': ('oi_threshold', float, 1, 100, "Please choose a number from 1 to 100"),
+        'detection_mode': ('detection_mode', parse_detection_mode, None, None, "Please choose 'End points' or 'Max move'"),
+        'digest': ('digest', parse_digest_mode, None, None, "Please choose 'On' or 'Off'")
     }
     
     setting_info = setting_type_map.get(setting_type_key)
@@ -1176,8 +2857,10 @@ async def price_set_pref(message: Message):
     else:
         try:
             value = value_processor(query)
-            if not (min_val <= value <= max_val):
+            if min_val is not None and not (min_val <= value <= max_val):
                 raise ValueError("Value out of range")
+            if setting_name in ('pump_index', 'dump_index', 'oi_period') and not is_valid_period(value):
+                raise ValueError("Period is not on the history grid")
         except ValueError:
             await message.reply(error_msg)
             current_time = datetime.now().strftime("%H:%M:%S")
@@ -1185,34 +2868,20 @@ async def price_set_pref(message: Message):
             await debug_bot.send_message(chat_id=DEBUG_CHAT_ID, text=debug_message)
             return
     
-    if chat_id in bot_data:
-        bot_data[chat_id][setting_name] = value
-    else:
-        bot_data[chat_id] = {
-            'pump_index': 2,
-            'pump_threshold': 10,
-            'dump_index': 2,
-            'dump_threshold': 8,
-            'alert_limit': 20,
-            'oi_period': 5,
-            'oi_threshold': 10
-        }
-        bot_data[chat_id][setting_name] = value
-    
-    db_column_map = {
-        'pump_index': 'Pindex',
-        'pump_threshold': 'Ppercent',
-        'dump_index': 'Dindex',
-        'dump_threshold': 'Dpercent',
-        'alert_limit': 'Filter',
-        'oi_period': 'OIperiod',
-        'oi_threshold': 'OIpercent'
-    }
-    db_column = db_column_map[setting_name]
     db = sqlite3.connect(WHITELIST_DB_PATH)
     cursor = db.cursor()
-    cursor.execute(f'UPDATE whitelist SET {db_column} = ? WHERE TelegramID = ?', (value, chat_id))
-    db.commit()
+    if chat_id not in bot_data:
+        bot_data[chat_id] = fetch_user_profile(cursor, chat_id) or UserProfile()
+    setattr(bot_data[chat_id], setting_name, value)
+    index_user_settings(chat_id)
+    
+    db_column = USER_PROFILE_COLUMNS[setting_name]
+    if db_column in whitelist_missing_columns:
+        # Колонку не удалось добавить при старте: настройка действует до перезапуска
+        logger.warning(f"{chat_id}: {setting_name} kept in memory only, whitelist has no column {db_column}")
+    else:
+        cursor.execute(f'UPDATE whitelist SET {db_column} = ? WHERE TelegramID = ?', (value, chat_id))
+        db.commit()
     db.close()
     
     if chat_id in user_data:
@@ -1223,7 +2892,8 @@ async def price_set_pref(message: Message):
             [KeyboardButton(text="🟢 Pump Period"), KeyboardButton(text="➗ Pump Percentage")],
             [KeyboardButton(text="🔴 Dump Period"), KeyboardButton(text="➗ Dump Percentage")],
             [KeyboardButton(text="📈 OI Period"), KeyboardButton(text="➗ OI Percentage")],
-            [KeyboardButton(text="🔔 Alert Limit")],
+            [KeyboardButton(text="🔔 Alert Limit"), KeyboardButton(text="📐 Detection Mode")],
+            [KeyboardButton(text="📦 Digest Mode")],
             [KeyboardButton(text="Back")]
         ],
         resize_keyboard=True,
@@ -1236,9 +2906,15 @@ async def price_set_pref(message: Message):
         'dump_threshold': '➗ Dump Percentage',
         'alert_limit': '🔔 Alert Limit',
         'oi_period': '📈 OI Period',
-        'oi_threshold': '➗ OI Percentage'
+        'oi_threshold': '➗ OI Percentage',
+        'detection_mode': '📐 Detection Mode',
+        'digest': '📦 Digest Mode'
     }
     display_value = 'Unlimited' if (setting_name == 'alert_limit' and value is None) else f"{value}"
+    if setting_name == 'detection_mode':
+        display_value = detection_mode_label(value)
+    elif setting_name == 'digest':
+        display_value = digest_mode_label(value)
     await message.reply(
         f"<b>{setting_display_name[setting_name]} is set to {display_value}</b>",
         parse_mode='HTML',
@@ -1249,20 +2925,46 @@ async def price_set_pref(message: Message):
 # Основной цикл программы
 async def main():
     
-    global user_message_counts, message_queue, total_messages_queued, total_messages_sent, blocked_users
-    global last_message_time, user_flood_timeout, fetch_errors, last_error_message_time, notification_counters
+    global user_message_counts, total_messages_queued, total_messages_sent, blocked_users
+    global last_message_time, fetch_errors, last_error_message_time
     
     # Инициализация глобальных переменных
     user_message_counts = {}
-    message_queue = []
     total_messages_queued = 0
     total_messages_sent = 0
     blocked_users = set()
     last_message_time = {}
-    user_flood_timeout = {}
     fetch_errors = []
     last_error_message_time = 0
-    notification_counters = defaultdict(lambda: defaultdict(int))  # Явно инициализируем здесь
+    # Миграция whitelist до загрузки пользователей. Если колонку добавить не удалось, бот работает дальше:
+    # профили читаются без нее (режим endpoint, сводка выключена), а в дебаг-чат уходит предупреждение
+    try:
+        whitelist_db = sqlite3.connect(WHITELIST_DB_PATH)
+        try:
+            ensure_whitelist_columns(whitelist_db)
+        finally:
+            whitelist_db.close()
+    except sqlite3.Error as e:
+        logger.error(f"Failed to open whitelist for migration: {e}")
+        whitelist_missing_columns.update(WHITELIST_EXTRA_COLUMNS)
+    if whitelist_missing_columns:
+        warning_message = f"Whitelist migration incomplete, using defaults for: {', '.join(sorted(whitelist_missing_columns))}"
+        print(warning_message)
+        await debug_bot.send_message(chat_id=DEBUG_CHAT_ID, text=warning_message)
+    # Счетчики уведомлений за сегодня переживают перезапуск
+    try:
+        restored = notification_counters.open()
+        logger.info(f"Restored {restored} alert counters for {notification_counters.day}")
+    except sqlite3.Error as e:
+        logger.error(f"Alert counters database unavailable, counting in memory only: {e}")
+        notification_counters.db = None
+    # Неотправленные сообщения прошлого запуска возвращаются в очередь (устаревшие отбрасываются)
+    try:
+        restored = outbound_queue.restore(time.time())
+        logger.info(f"Restored {restored} queued messages")
+    except sqlite3.Error as e:
+        logger.error(f"Outbound journal unavailable, queue lives in memory only: {e}")
+        outbound_queue.journal.db = None
     
     # Подключение роутеров
     price_dp.include_router(price_router)
@@ -1272,6 +2974,8 @@ async def main():
     await price_bot.delete_webhook(drop_pending_updates=True)
     await debug_bot.delete_webhook(drop_pending_updates=True)
     load_user_data()
+    # История из снимка: после перезапуска сигналы по длинным периодам работают сразу
+    restore_history()
     price_polling_task = asyncio.create_task(price_dp.start_polling(price_bot))
     debug_polling_task = asyncio.create_task(debug_dp.start_polling(debug_bot))
     
@@ -1280,14 +2984,25 @@ async def main():
     delay = 60 - now.second - now.microsecond / 1000000.0
     await asyncio.sleep(delay)
     await reinitialize_pairs()
+    # Заполняем историю до первой проверки условий
+    await backfill_history()
+    # Рынки из кэша обновляются в фоне, не задерживая опрос тикеров
+    market_refresh_task = asyncio.create_task(market_refresh_loop())
+    
+    # Запуск потоков тикеров (после реинициализации, чтобы были известны id пар)
+    stream_tasks = []
+    if STREAM_MODE:
+        stream_tasks = [asyncio.create_task(run_ticker_stream(exchange)) for exchange in STREAM_URLS]
     
     try:
         while True:
             try:
                 current_time = datetime.now()
+                cycle_boundary = next_minute_boundary()
                 fetch_errors = []
                 start_time = current_time.strftime("%H:%M:%S")
                 price_fetched_count = await price_fetch_and_compare_prices()
+                await snapshot_history()
                 current_time_sec = time.time()
                 
                 if fetch_errors and (current_time_sec - last_error_message_time > ERROR_MESSAGE_INTERVAL):
@@ -1297,7 +3012,9 @@ async def main():
                     last_error_message_time = current_time_sec
                 
                 await price_check_and_send_notifications()
-                await process_message_queue()
+                # Медленный опрос бирж плюс полная рассылка не должны сдвигать следующий цикл:
+                # рассылка заканчивается к границе минуты, остаток уходит в следующем цикле
+                await process_message_queue(deadline=min(DELIVERY_DEADLINE, cycle_boundary - time.time()))
                 end_time = datetime.now().strftime("%H:%M:%S")
                 
                 # Получение количества активных пользователей
@@ -1317,27 +3034,33 @@ async def main():
                     f"{start_time} -> {end_time} - Data collected\n"
                     f"Binance Prices: {price_fetched_count['binance']} Fetched\n"
                     f"Bybit Prices: {price_fetched_count['bybit']} Fetched\n"
-                    f"Queued: {total_messages_queued} | Sent: {total_messages_sent}\n"
+                    f"OI Stale: Binance {len(oi_stale['binance'])} | Bybit {len(oi_stale['bybit'])}\n"
+                    f"Queued: {total_messages_queued} | Sent: {total_messages_sent} | Expired: {outbound_queue.expired}\n"
                     f"Active Users: {active_users_count}"
+                    f"{degraded_exchanges_summary()}"
                 )
                 print(debug_message)
                 await debug_bot.send_message(chat_id=DEBUG_CHAT_ID, text=debug_message)
                 
-                if current_time.minute % 60 == 0:
+                # Раз в час, а также сразу после листинга/делистинга, найденного фоновым обновлением рынков
+                if current_time.minute % 60 == 0 or any(market_changes.values()):
                     await reinitialize_pairs()
                 
-                # Сброс временных данных
+                # Сброс временных данных (очередь не сбрасывается: в ней ждут сообщения под retry_after,
+                # сверх лимита минуты и остаток рассылки, не успевший до DELIVERY_DEADLINE)
                 user_message_counts = {}
-                message_queue = []
+                outbound_queue.expired = 0
                 total_messages_queued = 0
                 total_messages_sent = 0
                 blocked_users = set()
                 last_message_time = {}
-                user_flood_timeout = {}
                 
-                now = datetime.now()
-                delay = 60 - now.second - now.microsecond / 1000000.0
-                await asyncio.sleep(delay)
+                if STREAM_MODE:
+                    # Внутри минуты проверяем условия по ценам из потока
+                    await stream_evaluate_until_next_minute(cycle_boundary)
+                else:
+                    # Ждем границу минуты цикла; если цикл за нее затянулся, следующий начинается сразу
+                    await asyncio.sleep(max(0, cycle_boundary - time.time()))
             except Exception as e:
                 error_message = f"An unexpected error occurred in the main loop: {e}\nTraceback:\n{traceback.format_exc()}"
                 logger.error(error_message)
@@ -1350,8 +3073,18 @@ async def main():
     finally:
         price_polling_task.cancel()
         debug_polling_task.cancel()
+        market_refresh_task.cancel()
+        for task in stream_tasks:
+            task.cancel()
         await binance_exchange.close()
         await bybit_exchange.close()
+        notification_counters.close()
+        outbound_queue.close()
+        # Полный снимок (включая незакрытый 5-минутный интервал) для следующего запуска
+        try:
+            await snapshot_history(force=True)
+        except Exception as e:
+            logger.error(f"Failed to snapshot history on shutdown: {e}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,44 @@
+import asyncio
+import os
+import tempfile
+import time
+
+# Кадры из stream_frames_sample.jsonl (как их отдает ws_replay_server.py) должны доходить до истории цен,
+# хотя метки биржи в них из прошлого.
+#
+#   python -m pytest -q test_stream_replay.py
+
+# Бот читает токены и пути баз при импорте; для проверки достаточно заглушек
+os.environ.setdefault("PRICE_TELEGRAM_TOKEN", "0:test")
+os.environ.setdefault("DEBUG_BOT_TOKEN", "0:test")
+os.environ.setdefault("DEBUG_CHAT_ID", "0")
+os.environ.setdefault("OUTBOUND_JOURNAL_DB_PATH", os.path.join(tempfile.mkdtemp(), "outbound_journal.db"))
+os.environ.setdefault("ALERT_COUNTERS_DB_PATH", os.path.join(tempfile.mkdtemp(), "alert_counters.db"))
+import bot_modified_Search_Open_Interest as bot
+from ws_replay_server import load_frames
+
+SAMPLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stream_frames_sample.jsonl")
+
+
+def test_replayed_frame_reaches_price_history(monkeypatch):
+    _, frame = load_frames(SAMPLE_PATH)['binance'][0]
+    item = frame[0]
+    pair = f"{item['s'][:-4]}/USDT:USDT"
+    now_ms = int(time.time() * 1000)
+    assert item['E'] < now_ms - 60000  # Кадр записан давно
+
+    store = bot.SeriesStore(rows=4)
+    store.append(pair, now_ms - 60000, 80000.0)
+    monkeypatch.setattr(bot, 'STREAM_MODE', True)
+    monkeypatch.setitem(bot.market_ids, 'binance', {item['s']: pair})
+    monkeypatch.setitem(bot.stream_prices, 'binance', {})
+    monkeypatch.setitem(bot.stream_last_message, 'binance', 0)
+    monkeypatch.setitem(bot.prices, 'binance', store)
+
+    assert bot.handle_stream_frame('binance', frame) == 1
+    bot.stream_last_message['binance'] = time.time()
+    updated_count = asyncio.run(bot.apply_stream_prices())
+
+    assert updated_count['binance'] == 1
+    assert store.latest(pair) == float(item['c'])
+    assert store.lag(pair, 1) is None  # Внутри минуты обновляется последняя точка, новая не добавляется
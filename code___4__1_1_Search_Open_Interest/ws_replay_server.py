@@ -0,0 +1,126 @@
+import asyncio
+import argparse
+import json
+import time
+import aiohttp
+from aiohttp import web
+
+# Локальная замена websocket-потоков бирж для проверки потокового режима бота.
+#
+# Запись кадров с биржи:
+#   python ws_replay_server.py record binance frames.jsonl --limit 200
+#   python ws_replay_server.py record bybit frames.jsonl --limit 200 --symbols BTCUSDT ETHUSDT
+# Воспроизведение:
+#   python ws_replay_server.py replay frames.jsonl --port 8765
+# и запуск бота с переменными окружения:
+#   STREAM_MODE=1
+#   BINANCE_STREAM_URL=ws://127.0.0.1:8765/binance
+#   BYBIT_STREAM_URL=ws://127.0.0.1:8765/bybit
+#
+# Формат файла: одна строка JSON на кадр {"exchange": ..., "delay": сек от предыдущего кадра, "frame": ...}
+
+LIVE_URLS = {
+    'binance': "wss://fstream.binance.com/ws/!miniTicker@arr",
+    'bybit': "wss://stream.bybit.com/v5/public/linear"
+}
+
+
+# Запись кадров с биржи в файл
+async def record(exchange, path, limit, symbols):
+    written = 0
+    last_time = time.time()
+    async with aiohttp.ClientSession() as session:
+        async with session.ws_connect(LIVE_URLS[exchange]) as ws:
+            if exchange == 'bybit':
+                for i in range(0, len(symbols), 10):
+                    await ws.send_json({'op': 'subscribe', 'args': [f"tickers.{s}" for s in symbols[i:i + 10]]})
+            with open(path, 'a') as f:
+                async for msg in ws:
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        break
+                    payload = json.loads(msg.data)
+                    # Служебные ответы (подписка, pong) не записываем
+                    if isinstance(payload, dict) and 'topic' not in payload:
+                        continue
+                    now = time.time()
+                    f.write(json.dumps({'exchange': exchange, 'delay': round(now - last_time, 3), 'frame': payload}) + "\n")
+                    last_time = now
+                    written += 1
+                    if written >= limit:
+                        break
+    print(f"Recorded {written} {exchange} frames to {path}")
+
+
+# Загрузка записанных кадров по биржам
+def load_frames(path):
+    frames = {'binance': [], 'bybit': []}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                item = json.loads(line)
+                frames[item['exchange']].append((item.get('delay', 0), item['frame']))
+    return frames
+
+
+# Обработчик подключения: проигрывает кадры биржи по кругу с исходными задержками
+def make_handler(exchange, frames, speed, loop_frames):
+    async def handler(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+
+        async def reader():
+            # Отвечаем на подписку и ping Bybit так же, как биржа
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    payload = json.loads(msg.data)
+                    if payload.get('op') == 'ping':
+                        await ws.send_json({'success': True, 'ret_msg': 'pong', 'op': 'ping'})
+                    elif payload.get('op') == 'subscribe':
+                        await ws.send_json({'success': True, 'ret_msg': '', 'op': 'subscribe'})
+
+        reader_task = asyncio.create_task(reader())
+        try:
+            while not ws.closed:
+                for delay, frame in frames[exchange]:
+                    await asyncio.sleep(delay / speed)
+                    if ws.closed:
+                        break
+                    await ws.send_json(frame)
+                if not loop_frames:
+                    break
+        finally:
+            reader_task.cancel()
+        return ws
+    return handler
+
+
+def replay(path, host, port, speed, loop_frames):
+    frames = load_frames(path)
+    app = web.Application()
+    for exchange in frames:
+        app.router.add_get(f"/{exchange}", make_handler(exchange, frames, speed, loop_frames))
+    print(f"Replaying {len(frames['binance'])} binance and {len(frames['bybit'])} bybit frames on ws://{host}:{port}/<exchange>")
+    web.run_app(app, host=host, port=port, print=None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+    rec = sub.add_parser('record')
+    rec.add_argument('exchange', choices=['binance', 'bybit'])
+    rec.add_argument('path')
+    rec.add_argument('--limit', type=int, default=200)
+    rec.add_argument('--symbols', nargs='*', default=['BTCUSDT', 'ETHUSDT'])
+    rep = sub.add_parser('replay')
+    rep.add_argument('path')
+    rep.add_argument('--host', default='127.0.0.1')
+    rep.add_argument('--port', type=int, default=8765)
+    rep.add_argument('--speed', type=float, default=1.0)
+    rep.add_argument('--once', action='store_true')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        asyncio.run(record(args.exchange, args.path, args.limit, args.symbols))
+    else:
+        replay(args.path, args.host, args.port, args.speed, not args.once)
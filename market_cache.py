@@ -0,0 +1,44 @@
+import json
+import os
+import time
+
+# Market cache shared by the check scripts and the bot (code___4__1_1_Search_Open_Interest).
+# Each exchange has its own file, {MARKET_CACHE_PATH without .json}_{exchange}.json, holding
+# {'updated': ..., 'markets': {...}}. Writers only ever replace their own exchange's file, so a script run
+# while the bot refreshes its markets cannot lose the other exchange's entry.
+
+# The bot runs from its own directory, so by default the cache is resolved there rather than
+# against the current working directory
+MARKET_CACHE_PATH = os.getenv(
+    "MARKET_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "code___4__1_1_Search_Open_Interest", "market_cache.json")
+)
+MARKET_CACHE_TTL = int(os.getenv("MARKET_CACHE_TTL", 24 * 3600))
+
+
+def market_cache_path(exchange_name):
+    return f"{os.path.splitext(MARKET_CACHE_PATH)[0]}_{exchange_name}.json"
+
+
+# Cached markets of the exchange if the cache is fresh, otherwise None
+def load_market_cache(exchange_name):
+    try:
+        with open(market_cache_path(exchange_name)) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - cached.get('updated', 0) >= MARKET_CACHE_TTL:
+        return None
+    return cached['markets']
+
+
+# Write through a temp file (named per process) so the bot never reads a half-written cache
+def save_market_cache(exchange_name, usdt_perpetual):
+    path = market_cache_path(exchange_name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({
+            'updated': time.time(),
+            'markets': {symbol: {k: v for k, v in market.items() if k != 'info'} for symbol, market in usdt_perpetual.items()}
+        }, f, default=str)
+    os.replace(tmp_path, path)